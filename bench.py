@@ -0,0 +1,591 @@
+"""Developer benchmarks for the streaming pipeline.
+
+    python bench.py latency [--profile normal|low|all] [--seconds 10]
+    python bench.py encoders [--seconds 10]
+    python bench.py convert [--blocks 20000] [--blocksize 1024]
+    python bench.py dsp [--blocks 20000] [--blocksize 1024]
+    python bench.py load [--clients 1,10,50] [--codec wav] [--seconds 10] [--burst 0]
+                         [--send sendmsg|join] [--framing raw|chunked]
+    python bench.py sonos [--zones 5] [--describe-delay 0.1]
+
+These import main.py, so they need the same packages as the app itself.
+"""
+import argparse
+import asyncio
+import http.server
+import math
+import multiprocessing
+import statistics
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import numpy as np
+
+import main
+
+try:
+    import resource  # Unix only; used for encoder CPU time
+except ImportError:
+    resource = None
+
+
+def _child_cpu_seconds() -> float:
+    if resource is None:
+        return float("nan")
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure_encoder_latency(profile_name: str, seconds: float) -> dict:
+    """Feed real-time PCM into the encoder exactly as the hub does and time each MP3 frame out.
+
+    For frame k the latency is the time between writing the last sample that frame
+    covers and the frame arriving on the encoder's stdout.
+    """
+    profile = main.LATENCY_PROFILES[profile_name]
+    blocksize = profile["blocksize"]
+    rate = main.SAMPLE_RATE
+    cpu_before = _child_cpu_seconds()
+    ffmpeg = subprocess.Popen(
+        main.build_encoder_command(main.CODECS["mp3"], profile),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        bufsize=0,
+    )
+
+    # Sample index -> monotonic time it was handed to the encoder.
+    written_at: list[tuple[int, float]] = []
+    frame_times: list[float] = []
+
+    def reader():
+        framer = main.Mp3Framer()
+        while True:
+            chunk = ffmpeg.stdout.read(profile["read_chunk"])
+            if not chunk:
+                break
+            now = time.monotonic()
+            frame_times.extend(now for _ in framer.feed(chunk))
+
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+
+    t_sine = np.arange(blocksize) / rate
+    total_blocks = int(seconds * rate / blocksize)
+    start = time.monotonic()
+    for i in range(total_blocks):
+        # Pace like a capture device: a block becomes available once it has been "recorded".
+        due = start + (i + 1) * blocksize / rate
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        phase = i * blocksize / rate
+        block = (0.3 * np.sin(2 * np.pi * 440.0 * (t_sine + phase)) * 32767).astype(np.int16)
+        pcm = np.repeat(block[:, None], main.CHANNELS, axis=1)
+        ffmpeg.stdin.write(pcm.tobytes())
+        written_at.append(((i + 1) * blocksize, time.monotonic()))
+    wall = time.monotonic() - start
+    ffmpeg.stdin.close()
+    t.join()
+    ffmpeg.wait()
+    cpu = _child_cpu_seconds() - cpu_before
+
+    latencies = []
+    w = 0
+    for k, arrived in enumerate(frame_times):
+        last_sample = (k + 1) * main.MP3_SAMPLES_PER_FRAME
+        while w < len(written_at) and written_at[w][0] < last_sample:
+            w += 1
+        if w >= len(written_at):
+            break  # frame was flushed at end of input
+        latencies.append(arrived - written_at[w][1])
+
+    capture_ms = 1000.0 * blocksize / rate
+    encoder_ms = 1000.0 * statistics.median(latencies) if latencies else float("nan")
+    p95_ms = 1000.0 * sorted(latencies)[int(0.95 * (len(latencies) - 1))] if latencies else float("nan")
+    return {
+        "profile": profile_name,
+        "capture_ms": capture_ms,
+        "encoder_median_ms": encoder_ms,
+        "encoder_p95_ms": p95_ms,
+        "end_to_end_ms": capture_ms + encoder_ms + 1000.0 * profile["writer_poll"],
+        "encoder_cpu_pct": 100.0 * cpu / wall,
+        "frames": len(frame_times),
+    }
+
+
+def cmd_latency(args) -> None:
+    names = list(main.LATENCY_PROFILES) if args.profile == "all" else [args.profile]
+    print(f"{'profile':<8} {'capture':>8} {'encoder':>8} {'p95':>8} {'server':>8} {'cpu':>6}")
+    for name in names:
+        r = measure_encoder_latency(name, args.seconds)
+        print(
+            f"{r['profile']:<8} {r['capture_ms']:>6.1f}ms {r['encoder_median_ms']:>6.1f}ms "
+            f"{r['encoder_p95_ms']:>6.1f}ms {r['end_to_end_ms']:>6.1f}ms {r['encoder_cpu_pct']:>5.1f}%"
+        )
+
+
+def measure_encoder_backend(backend: str, seconds: float) -> dict:
+    """Time-to-first-frame and CPU per audio second for one MP3 encoder backend, fed as fast as possible."""
+    codec = main.CODECS["mp3"]
+    profile = main.LATENCY_PROFILES["normal"]
+    first_frame: list[float] = []
+    done = threading.Event()
+    framer = main.Mp3Framer()
+
+    def on_output(chunk):
+        if framer.feed(chunk) and not first_frame:
+            first_frame.append(time.perf_counter())
+
+    rate = main.SAMPLE_RATE
+    block = (np.random.default_rng(0).standard_normal((profile["blocksize"], main.CHANNELS)) * 3000).astype(np.int16)
+    data = memoryview(block).cast("B")
+    blocks = int(seconds * rate / profile["blocksize"])
+
+    cpu_before = time.process_time() + _child_cpu_seconds()
+    start = time.perf_counter()
+    if backend == "lame":
+        encoder = main.LameEncoder(codec, profile, on_output, done.set)
+    else:
+        encoder = main.FfmpegEncoder(codec, profile, on_output, done.set)
+    for _ in range(blocks):
+        encoder.write(data)
+    if backend == "lame":
+        encoder.close()
+    else:
+        encoder._proc.stdin.close()
+        done.wait()
+        encoder._proc.wait()
+    cpu = time.process_time() + _child_cpu_seconds() - cpu_before
+    return {
+        "backend": backend,
+        "first_frame_ms": 1000.0 * (first_frame[0] - start) if first_frame else float("nan"),
+        "cpu_ms_per_audio_s": 1000.0 * cpu / seconds,
+    }
+
+
+def cmd_encoders(args) -> None:
+    backends = ["ffmpeg"] + (["lame"] if main.lameenc is not None else [])
+    print(f"{'backend':<8} {'first frame':>12} {'cpu/audio s':>12}")
+    for backend in backends:
+        r = measure_encoder_backend(backend, args.seconds)
+        print(f"{r['backend']:<8} {r['first_frame_ms']:>10.1f}ms {r['cpu_ms_per_audio_s']:>10.1f}ms")
+
+
+def _legacy_convert(data, channels):
+    # The per-block conversion the soundcard pump used before PcmConverter.
+    if getattr(data, "ndim", 1) == 1:
+        data = np.expand_dims(data, axis=1)
+    if data.shape[1] == 1 and channels == 2:
+        data = np.repeat(data, 2, axis=1)
+    elif data.shape[1] >= 2 and channels == 1:
+        data = data[:, :1]
+    pcm = np.clip(data, -1.0, 1.0)
+    pcm = (pcm * 32767.0).astype(np.int16)
+    return pcm.tobytes()
+
+
+def _time_per_block(fn, blocks: int) -> tuple[float, float]:
+    """Return (microseconds per block, bytes allocated per block)."""
+    for _ in range(100):
+        fn()
+    start = time.perf_counter()
+    for _ in range(blocks):
+        fn()
+    us = 1e6 * (time.perf_counter() - start) / blocks
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    for _ in range(100):
+        fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return us, peak
+
+
+def cmd_convert(args) -> None:
+    rng = np.random.default_rng(0)
+    print(f"{'input':<8} {'path':<18} {'us/block':>9} {'peak alloc':>11}")
+    for in_channels in (2, 1):
+        data = (rng.standard_normal((args.blocksize, in_channels)) * 0.3).astype(np.float32)
+        plain = main.PcmConverter(args.blocksize, main.CHANNELS)
+        dithered = main.PcmConverter(args.blocksize, main.CHANNELS, dither=True)
+        paths = [
+            ("legacy", lambda: _legacy_convert(data, main.CHANNELS)),
+            ("PcmConverter", lambda: memoryview(plain.convert(data))),
+            ("PcmConverter+TPDF", lambda: memoryview(dithered.convert(data))),
+        ]
+        for name, fn in paths:
+            us, peak = _time_per_block(fn, args.blocks)
+            label = "stereo" if in_channels == 2 else "mono"
+            print(f"{label:<8} {name:<18} {us:>9.1f} {peak:>10}B")
+
+
+def cmd_dsp(args) -> None:
+    # Every stage on, at settings that make each one do real work.
+    main.CHANNEL_MAP, main.GAIN_DB, main.LOUDNESS_TARGET_LUFS = "swap", 6.0, -16.0
+    main.LIMITER, main.LIMITER_CEILING_DB = True, -1.0
+    rng = np.random.default_rng(0)
+    budget_us = 1e6 * args.blocksize / main.SAMPLE_RATE
+    print(f"{'stage':<12} {'input':<7} {'us/block':>9} {'% realtime':>11} {'peak alloc':>11}")
+    for level, label in ((0.05, "quiet"), (0.8, "loud")):
+        data = (rng.standard_normal((args.blocksize, main.CHANNELS)) * level).astype(np.float32)
+        work = np.empty_like(data)
+        chain = main.DspChain(main.CHANNELS)
+
+        def stage_fn(stage):
+            def fn():
+                np.copyto(work, data)
+                stage.process(work)
+            return fn
+
+        paths = [(name, stage_fn(stage)) for name, stage in chain.stages.items()]
+        paths.append(("chain", lambda: memoryview(chain.process(data))))
+        for name, fn in paths:
+            us, peak = _time_per_block(fn, args.blocks)
+            print(f"{name:<12} {label:<7} {us:>9.1f} {100 * us / budget_us:>10.2f}% {peak:>10}B")
+
+
+class MarkerSource(main.SyntheticSource):
+    """Silence with a numbered marker frame once per second, for end-to-end latency.
+
+    Marker n is one frame with left = 32767 and right = n. Only lossless streams
+    (WAV) keep it intact.
+    """
+
+    def __init__(self, hub, profile):
+        super().__init__(hub, profile)
+        # Marker number -> monotonic time its block was handed to the encoders.
+        self.marker_times: dict[int, float] = {}
+
+    def generate(self, out):
+        out.fill(0)
+        n = out.shape[0]
+        first = -(-self.position // main.SAMPLE_RATE)
+        for k in range(first, (self.position + n - 1) // main.SAMPLE_RATE + 1):
+            i = k * main.SAMPLE_RATE - self.position
+            out[i, 0] = 32767
+            out[i, 1] = k % 32768
+            self.marker_times[k % 32768] = time.monotonic()
+
+
+def _nearest_rank(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def _send_syscalls() -> float:
+    """Send calls on stream sockets so far (send_syscalls_total over every stream)."""
+    return sum(value for (name, _), value in list(main.METRICS._counters.items()) if name == "send_syscalls_total")
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, KiB on Linux
+
+
+async def _listen_one(port: int, path: str, warmup: float, seconds: float, lossless: bool, version: str) -> dict:
+    started = time.monotonic()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} {version}\r\n\r\n".encode())
+    await reader.readuntil(b"\r\n\r\n")
+    first = await reader.read(65536)
+    result = {"ttfb": time.monotonic() - started, "bytes": 0, "markers": {}}
+    window_start = started + warmup
+    window_end = window_start + seconds
+    # WAV body: 44-byte header, then interleaved int16 stereo.
+    pending = first[44:] if lossless else b""
+    while time.monotonic() < window_end:
+        chunk = await reader.read(65536)
+        if not chunk:
+            break
+        now = time.monotonic()
+        if now >= window_start:
+            result["bytes"] += len(chunk)
+        if lossless:
+            pending += chunk
+            usable = len(pending) - len(pending) % 4
+            pcm = np.frombuffer(pending[:usable], dtype=np.int16).reshape(-1, 2)
+            pending = pending[usable:]
+            for i in np.flatnonzero(pcm[:, 0] == 32767):
+                result["markers"].setdefault(int(pcm[i, 1]), now)
+    writer.close()
+    return result
+
+
+def _listen(port: int, path: str, clients: int, warmup: float, seconds: float, lossless: bool, version: str,
+            conn) -> None:
+    async def run():
+        return await asyncio.gather(*(
+            _listen_one(port, path, warmup, seconds, lossless, version) for _ in range(clients)
+        ), return_exceptions=True)
+    results = asyncio.run(run())
+    conn.send([r for r in results if isinstance(r, dict)])
+    conn.close()
+
+
+def measure_load(port: int, path: str, clients: int, warmup: float, seconds: float) -> dict:
+    """Run `clients` listeners in a child process against the in-process server."""
+    hub = main.HUBS[path]
+    # Chunk size lines would land in the middle of the PCM, so markers are only read from raw bodies.
+    chunked = main.STREAM_FRAMING == "chunked"
+    lossless = hub.codec_name == "wav" and not chunked
+    parent, child = multiprocessing.Pipe(duplex=False)
+    proc = multiprocessing.get_context("spawn").Process(
+        target=_listen, args=(port, path, clients, warmup, seconds, lossless, "HTTP/1.1" if chunked else "HTTP/1.0", child)
+    )
+    proc.start()
+    time.sleep(warmup)
+    source = main.CAPTURES[main.DEFAULT_SOURCE]._source
+    encoder = hub._encoder
+    external = isinstance(encoder, main.FfmpegEncoder)
+    cpu_before = time.process_time() + ((encoder.cpu_seconds() or 0.0) if external else 0.0)
+    syscalls_before = _send_syscalls()
+    time.sleep(seconds)
+    cpu = time.process_time() + ((encoder.cpu_seconds() or 0.0) if external else 0.0) - cpu_before
+    syscalls = _send_syscalls() - syscalls_before
+    rss = _rss_bytes()
+    results = parent.recv()
+    proc.join()
+
+    latencies = []
+    for r in results:
+        for n, arrived in r["markers"].items():
+            captured = source.marker_times.get(n) if isinstance(source, MarkerSource) else None
+            if captured is not None and arrived >= captured:
+                latencies.append(arrived - captured)
+    ttfbs = sorted(r["ttfb"] for r in results)
+    total_bytes = sum(r["bytes"] for r in results)
+    return {
+        "clients": len(results),
+        "cpu_pct": 100.0 * cpu / seconds,
+        "cpu_ms_per_client_s": 1000.0 * cpu / seconds / max(1, len(results)),
+        "rss_mb": rss / 1e6,
+        "syscalls_s": syscalls / seconds,
+        "mbit_s": 8.0 * total_bytes / seconds / 1e6,
+        "min_client_kbit_s": 8.0 * min((r["bytes"] for r in results), default=0) / seconds / 1e3,
+        "ttfb_median_ms": 1000.0 * statistics.median(ttfbs) if ttfbs else float("nan"),
+        "ttfb_max_ms": 1000.0 * ttfbs[-1] if ttfbs else float("nan"),
+        "latency_median_ms": 1000.0 * statistics.median(latencies) if latencies else float("nan"),
+        "latency_p95_ms": 1000.0 * _nearest_rank(latencies, 0.95) if latencies else float("nan"),
+    }
+
+
+def cmd_load(args) -> None:
+    main.SOURCE_TYPES["marker"] = MarkerSource
+    main.apply_config({
+        "audio_mode": "marker" if args.codec == "wav" else "synthetic",
+        "device": "noise",
+        "burst_seconds": args.burst,
+        "hub_linger": 0,
+        "stream_framing": args.framing,
+    })
+    # "join" is the path used where sendmsg() is missing: one joined copy per write.
+    main.USE_SENDMSG = args.send == "sendmsg"
+    main.configure_sources({})
+    server = main.AsyncStreamServer(("127.0.0.1", 0))
+    server.bind()
+    port = server.address[1]
+    threading.Thread(target=lambda: asyncio.run(server.serve_forever()), daemon=True).start()
+    path = main.stream_path(main.DEFAULT_SOURCE, args.codec)
+
+    print(f"{args.codec} on {path}, burst {args.burst:.1f}s, {args.seconds:.0f}s per run, {args.send}, {args.framing}"
+          + ("" if args.codec == "wav" and args.framing == "raw" else " (latency needs --codec wav --framing raw)"))
+    print(f"{'clients':>7} {'cpu':>6} {'cpu/client':>11} {'sends/s':>8} {'rss':>7} {'total':>10} {'min client':>11} "
+          f"{'ttfb med/max':>15} {'latency med/p95':>16}")
+    for clients in (int(n) for n in args.clients.split(",")):
+        r = measure_load(port, path, clients, args.warmup, args.seconds)
+        print(
+            f"{r['clients']:>7} {r['cpu_pct']:>5.1f}% {r['cpu_ms_per_client_s']:>7.2f}ms/s {r['syscalls_s']:>8.0f} "
+            f"{r['rss_mb']:>5.0f}MB "
+            f"{r['mbit_s']:>6.1f}Mbit/s {r['min_client_kbit_s']:>7.0f}kbit/s "
+            f"{r['ttfb_median_ms']:>6.0f}/{r['ttfb_max_ms']:<5.0f}ms {r['latency_median_ms']:>6.0f}/{r['latency_p95_ms']:<6.0f}ms"
+        )
+        time.sleep(0.5)  # let the hub stop so every run starts cold
+
+
+class FakeSonos:
+    """Stand-in Sonos household on 127.0.0.1: one SSDP responder answering for `zones` players.
+
+    Each player has its own HTTP port serving a device description (after `describe_delay`,
+    like a busy player) and the AVTransport control URL. On Play it fetches the stream it was
+    given, as a real player would, and records when the first audio byte arrives.
+    """
+
+    def __init__(self, zones: int, describe_delay: float):
+        self.describe_delay = describe_delay
+        self.played: dict[str, str] = {}  # room -> URI it was told to play
+        self.first_audio: dict[str, float] = {}  # room -> monotonic time of the first body byte
+        self._servers = []
+        for n in range(1, zones + 1):
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler(f"Room {n}", n))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._servers.append(server)
+        self._ssdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._ssdp.bind(("127.0.0.1", 0))
+        self.ssdp_address = self._ssdp.getsockname()
+        threading.Thread(target=self._answer_searches, daemon=True).start()
+
+    def _answer_searches(self) -> None:
+        while True:
+            data, addr = self._ssdp.recvfrom(4096)
+            if b"M-SEARCH" not in data or main.SONOS_SEARCH_TARGET.encode() not in data:
+                continue
+            for n, server in enumerate(self._servers, 1):
+                self._ssdp.sendto((
+                    "HTTP/1.1 200 OK\r\nCACHE-CONTROL: max-age = 1800\r\nEXT:\r\n"
+                    f"LOCATION: http://127.0.0.1:{server.server_address[1]}/xml/device_description.xml\r\n"
+                    "SERVER: Linux UPnP/1.0 Sonos/80.1-55014 (ZPS1)\r\n"
+                    f"ST: {main.SONOS_SEARCH_TARGET}\r\n"
+                    f"USN: uuid:RINCON_FAKE{n:012d}::{main.SONOS_SEARCH_TARGET}\r\n\r\n"
+                ).encode(), addr)
+
+    def _handler(self, room: str, n: int):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body: str) -> None:
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", 'text/xml; charset="utf-8"')
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                time.sleep(fake.describe_delay)
+                self._reply(200, (
+                    '<?xml version="1.0"?><root xmlns="urn:schemas-upnp-org:device-1-0"><device>'
+                    "<deviceType>urn:schemas-upnp-org:device:ZonePlayer:1</deviceType>"
+                    f"<friendlyName>127.0.0.1 - Fake - RINCON_FAKE{n:012d}</friendlyName>"
+                    f"<modelName>Fake One</modelName><roomName>{room}</roomName>"
+                    f"<UDN>uuid:RINCON_FAKE{n:012d}</UDN></device></root>"
+                ))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                action = self.headers.get("SOAPACTION", "").strip('"').rpartition("#")[2]
+                if self.path != main.SONOS_AVTRANSPORT_PATH or action not in ("SetAVTransportURI", "Play"):
+                    self._reply(500, "<errorCode>401</errorCode>")
+                    return
+                if action == "SetAVTransportURI":
+                    fake.played[room] = re.search(r"<CurrentURI>(.*?)</CurrentURI>", body).group(1)
+                else:
+                    threading.Thread(target=fake._listen, args=(room,), daemon=True).start()
+                self._reply(200, f'<s:Envelope><s:Body><u:{action}Response/></s:Body></s:Envelope>')
+
+        return Handler
+
+    def _listen(self, room: str) -> None:
+        url = urllib.parse.urlsplit(self.played[room])
+        with socket.create_connection((url.hostname, url.port)) as sock:
+            sock.sendall(f"GET {url.path} HTTP/1.1\r\nIcy-MetaData: 1\r\n\r\n".encode())
+            data = b""
+            # Until the first byte after the response head.
+            while b"\r\n\r\n" not in data or data.endswith(b"\r\n\r\n"):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+            self.first_audio[room] = time.monotonic()
+
+    def close(self) -> None:
+        for server in self._servers:
+            server.shutdown()
+        self._ssdp.close()
+
+
+def cmd_sonos(args) -> None:
+    main.apply_config({"audio_mode": "synthetic", "device": "sine:440", "hub_linger": 0})
+    main.configure_sources({})
+    server = main.AsyncStreamServer(("127.0.0.1", 0))
+    server.bind()
+    main.PORT = server.address[1]
+    threading.Thread(target=lambda: asyncio.run(server.serve_forever()), daemon=True).start()
+    fake = FakeSonos(args.zones, args.describe_delay)
+    target = f"Room {args.zones}"
+
+    def search(stop_when=None):
+        return asyncio.run(main.ssdp_search(interfaces=["127.0.0.1"], address=fake.ssdp_address, stop_when=stop_when))
+
+    print(f"{args.zones} fake zones, {1000 * args.describe_delay:.0f} ms per description")
+    started = time.monotonic()
+    zones = search()
+    print(f"full search: {len(zones)} zones in {1000 * (time.monotonic() - started):.0f} ms "
+          f"(window {1000 * main.SSDP_SEARCH_SECONDS:.0f} ms; descriptions fetched in parallel)")
+
+    # Launch to audio: search until the wanted room shows up, then play on it.
+    started = time.monotonic()
+    zones = search(lambda zone: zone.matches(target))
+    found = time.monotonic()
+    zone = next(zone for zone in zones if zone.matches(target))
+    ok = main.play_on_zone(zone)
+    played = time.monotonic()
+    while ok and target not in fake.first_audio and time.monotonic() - played < 10:
+        time.sleep(0.005)
+    audio = fake.first_audio.get(target)
+    print(f"'{target}': found {1000 * (found - started):.0f} ms, SetAVTransportURI+Play {1000 * (played - found):.0f} ms, "
+          + (f"first audio byte {1000 * (audio - played):.0f} ms, total {1000 * (audio - started):.0f} ms"
+             if audio else "no audio"))
+    print(f"URI: {fake.played.get(target)}")
+    fake.close()
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("latency", help="capture + encoder latency and encoder CPU per latency profile")
+    p.add_argument("--profile", default="all", choices=["all", *main.LATENCY_PROFILES])
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.set_defaults(func=cmd_latency)
+
+    p = sub.add_parser("encoders", help="MP3 encoder backends: time-to-first-frame and CPU")
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.set_defaults(func=cmd_encoders)
+
+    p = sub.add_parser("convert", help="float32 -> int16 capture conversion cost per block")
+    p.add_argument("--blocks", type=int, default=20000)
+    p.add_argument("--blocksize", type=int, default=1024)
+    p.set_defaults(func=cmd_convert)
+
+    p = sub.add_parser("dsp", help="block DSP cost per stage and for the whole chain")
+    p.add_argument("--blocks", type=int, default=20000)
+    p.add_argument("--blocksize", type=int, default=1024)
+    p.set_defaults(func=cmd_dsp)
+
+    p = sub.add_parser("load", help="local server + N simulated listeners: CPU, memory, throughput, TTFB, latency")
+    p.add_argument("--clients", default="1,10,50", help="comma-separated client counts, one run each")
+    p.add_argument("--codec", default="wav", choices=list(main.CODECS))
+    p.add_argument("--seconds", type=float, default=10.0, help="measured time per run")
+    p.add_argument("--warmup", type=float, default=2.0, help="unmeasured time after clients connect")
+    p.add_argument("--burst", type=float, default=0.0, help="burst_seconds for the run (adds to latency)")
+    p.add_argument("--send", default="sendmsg", choices=["sendmsg", "join"],
+                   help="scatter-gather sendmsg, or one joined copy per write as on Windows")
+    p.add_argument("--framing", default="raw", choices=["raw", "chunked"])
+    p.set_defaults(func=cmd_load)
+
+    p = sub.add_parser("sonos", help="discovery and play-on-zone against fake Sonos players: time to first audio")
+    p.add_argument("--zones", type=int, default=5)
+    p.add_argument("--describe-delay", type=float, default=0.1, help="seconds each fake player takes to answer")
+    p.set_defaults(func=cmd_sonos)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,31 +1,44 @@
-import sounddevice as sd
 import numpy as np
+import asyncio
+import contextlib
 import threading
-import socketserver
+import collections
 import socket
-import http.server
 import subprocess
 import sys
 import requests
+import urllib.parse
 import time
+import ipaddress
 import json
+import math
+import mmap
+import re
 import os
 import platform
 import shutil
+import signal
+import tempfile
+import argparse
 from typing import Optional
+from http import HTTPStatus
 from pathlib import Path
+from xml.sax.saxutils import escape as xml_escape
+import xml.etree.ElementTree as ET
 import ctypes
 import warnings
-import tkinter as tk
-from tkinter import simpledialog, messagebox
-import pystray
-from pystray import MenuItem as item, Menu
-from PIL import Image, ImageDraw
+
+# sounddevice (PortAudio) and soundcard are imported on first use, see _sounddevice()/_soundcard():
+# loading them scans the audio devices, which is slow at login and fails on headless machines.
+# tkinter, pystray and PIL are likewise only imported by the settings dialog and tray icon.
+sd = None
+sc = None
+_soundcard_tried = False
 
 try:
-    import soundcard as sc  # Better Windows loopback capture than PortAudio WASAPI loopback
+    import lameenc  # Optional in-process MP3 encoder; ffmpeg is used when it is missing
 except Exception:
-    sc = None
+    lameenc = None
 
 # soundcard can be chatty about discontinuities; those are common under load and usually harmless.
 warnings.filterwarnings(
@@ -86,6 +99,15 @@ FFMPEG_PATH = resolve_ffmpeg_path()
 # - macOS/Linux: store config in user config directory (still "single app file" distribution)
 
 REGISTRY_KEY_PATH = r"Software\SonosStreamer"
+CONFIG_KEYS = (
+    "domain", "host", "password", "audio_mode", "public_enabled", "latency_profile", "encoder_backend", "dither",
+    "slow_client_policy", "lag_budget", "burst_seconds", "hub_linger", "device", "sources",
+    "idle_suspend", "silence_threshold", "sample_rate", "drift_correction", "station_name",
+    "ddns_provider", "ip_lookup_url", "quality_ladder", "timeshift", "timeshift_dir",
+    "gain", "loudness_target", "limiter", "limiter_ceiling", "channel_map",
+    "tcp_nodelay", "send_buffer", "stream_framing",
+)
+BOOL_CONFIG_KEYS = ("public_enabled", "dither", "drift_correction", "limiter", "tcp_nodelay")
 
 def _get_user_config_path() -> Path:
     home = Path.home()
@@ -119,11 +141,11 @@ def load_config() -> dict:
 
             with winreg.OpenKey(winreg.HKEY_CURRENT_USER, REGISTRY_KEY_PATH) as key:
                 out: dict = {}
-                for name in ("domain", "host", "password", "audio_mode", "public_enabled"):
+                for name in CONFIG_KEYS:
                     try:
                         value, _ = winreg.QueryValueEx(key, name)
                         if isinstance(value, str) and value:
-                            if name == "public_enabled":
+                            if name in BOOL_CONFIG_KEYS:
                                 out[name] = value.strip() in ("1", "true", "True", "yes", "on")
                             else:
                                 out[name] = value
@@ -167,12 +189,18 @@ def save_config(config: dict) -> None:
             import winreg
 
             with winreg.CreateKey(winreg.HKEY_CURRENT_USER, REGISTRY_KEY_PATH) as key:
-                for name in ("domain", "host", "password", "audio_mode", "public_enabled"):
-                    value = config.get(name)
-                    if name == "public_enabled":
+                for name in CONFIG_KEYS:
+                    # A key left out keeps its stored value (or its default, e.g. limiter on),
+                    # rather than being written as "0".
+                    if name not in config:
+                        continue
+                    value = config[name]
+                    if name in BOOL_CONFIG_KEYS:
                         winreg.SetValueEx(key, name, 0, winreg.REG_SZ, "1" if bool(value) else "0")
                     elif isinstance(value, str):
                         winreg.SetValueEx(key, name, 0, winreg.REG_SZ, value)
+                    elif isinstance(value, (dict, list, tuple)):
+                        winreg.SetValueEx(key, name, 0, winreg.REG_SZ, json.dumps(value))
             return
         except Exception:
             # Fall back to file-based config below
@@ -182,28 +210,9 @@ def save_config(config: dict) -> None:
     config_path.parent.mkdir(parents=True, exist_ok=True)
     config_path.write_text(json.dumps(config), encoding="utf-8")
 
-def get_public_ip():
-    try:
-        response = requests.get('https://api.ipify.org?format=json')
-        return response.json()['ip']
-    except:
-        return None
-
-def update_ddns(ip):
-    if not DDNS_DOMAIN or not DDNS_PASSWORD:
-        return
-    url = f"https://dynamicdns.park-your-domain.com/update?host={DDNS_HOST}&domain={DDNS_DOMAIN}&password={DDNS_PASSWORD}&ip={ip}"
-    try:
-        response = requests.get(url)
-        print(f"DDNS response: {response.text.strip()}")
-        if response.status_code == 200 and "<ErrCount>0</ErrCount>" in response.text:
-            print(f"DDNS updated to {ip}")
-            return
-        print(f"DDNS update failed: {response.text}")
-    except Exception as e:
-        print(f"DDNS update error: {e}")
-
 def create_icon():
+    from PIL import Image, ImageDraw
+
     # Create a simple icon
     image = Image.new('RGB', (64, 64), color='blue')
     draw = ImageDraw.Draw(image)
@@ -217,37 +226,297 @@ def on_exit(icon, item):
     icon.stop()
     os._exit(0)  # Force exit
 
+def on_find_speakers(icon, item):
+    def find():
+        discover_zones(max_age=0)
+        icon.update_menu()
+    threading.Thread(target=find, daemon=True).start()
+
+def _play_action(zone):
+    return lambda icon, item: threading.Thread(target=play_on_zone, args=(zone,), daemon=True).start()
+
 def setup_tray():
+    import pystray
+    from pystray import MenuItem as item, Menu
+
+    def zone_items():
+        zones = sorted(SONOS_ZONES.values(), key=lambda zone: (zone.name.lower(), zone.ip))
+        if not zones:
+            return [item('No speakers found', None, enabled=False)]
+        return [item(f"{zone.name} ({zone.ip})", _play_action(zone)) for zone in zones]
+
     icon = pystray.Icon("Sonos Streamer", create_icon(), menu=Menu(
+        item('Play on', Menu(zone_items)),
+        item('Find speakers', on_find_speakers),
         item('Settings', on_settings),
         item('Exit', on_exit)
     ))
+    # Fill "Play on" in the background, so the menu is ready by the time it is opened.
+    on_find_speakers(icon, None)
     icon.run()
 
-# DDNS Configuration (defaults, will be overridden by config)
-config = load_config()
-DDNS_DOMAIN = config.get('domain', 'yourdomain.com')
-DDNS_HOST = config.get('host', '@')
-DDNS_PASSWORD = config.get('password', 'your_ddns_password')
-DDNS_UPDATE_INTERVAL = 300  # seconds (5 minutes)
-PUBLIC_ENABLED = bool(config.get('public_enabled', False))
+# DDNS Configuration (defaults, overridden by apply_config() at startup)
+DDNS_DOMAIN = 'yourdomain.com'
+DDNS_HOST = '@'
+DDNS_PASSWORD = 'your_ddns_password'
+DDNS_UPDATE_INTERVAL = 300  # seconds (5 minutes); also how long a looked-up public IP stays cached
+# A DDNS_PROVIDERS name, or an update URL template with {host}, {domain}, {password} and {ip}.
+DDNS_PROVIDER = 'namecheap'
+# Public IP lookup: answers with JSON {"ip": ...} or the bare address.
+IP_LOOKUP_URL = 'https://api.ipify.org?format=json'
+PUBLIC_ENABLED = False
 
 # Audio capture configuration
 # - "vbcable": uses VB-Audio Cable (Windows) / BlackHole (macOS)
 # - "loopback": uses Windows WASAPI loopback (no VB-Cable required)
-AUDIO_MODE = config.get('audio_mode', 'loopback' if IS_WINDOWS else 'vbcable')
+# - "monitor": Linux PulseAudio/PipeWire monitor of an output (what it plays), via soundcard
+# - "synthetic": generated test signal, no device (see SyntheticSource)
+AUDIO_MODE = 'loopback' if IS_WINDOWS else 'vbcable'
+# Explicit capture device: a PortAudio input index or part of its name. In "monitor" and
+# "loopback" modes it names the output to capture instead. Empty uses the mode's default.
+AUDIO_DEVICE = ''
+# More capture sources, each served on its own paths (/stream/<name>, /stream/<name>.aac, ...):
+# name -> {"audio_mode": ..., "device": ...}. Missing keys fall back to the settings above.
+SOURCES: dict[str, dict] = {}
+
+# Latency profiles trade delay against CPU (more, smaller writes) and the risk of dropouts.
+# - blocksize: capture block in frames
+# - device_latency: PortAudio latency hint for the sounddevice path
+# - pcm_write_frames: largest PCM block handed to the encoder in one write
+# - writer_poll: seconds the encoder writer sleeps when the PCM ring is empty
+# - read_chunk: bytes read from the encoder per call
+# - send_max_frames: most encoded frames sent to a client per write
+# - send_interval: seconds a live client waits after a write so the next one carries several
+#   encoder batches (fewer syscalls and wakeups per client); 0 sends each batch as it comes
+# - input_args / output_args: extra ffmpeg options around "-i" and the encoder
+# - low_latency_codec_args: also apply each codec's own low-latency options (see CODECS)
+LATENCY_PROFILES = {
+    "normal": {
+        "blocksize": 1024,
+        "device_latency": "high",
+        "pcm_write_frames": 2048,
+        "writer_poll": 0.005,
+        "read_chunk": 4096,
+        "send_max_frames": 64,
+        "send_interval": 0.05,
+        "input_args": [],
+        "output_args": [],
+        "low_latency_codec_args": False,
+    },
+    "low": {
+        "blocksize": 256,
+        "device_latency": "low",
+        "pcm_write_frames": 256,
+        "writer_poll": 0.002,
+        "read_chunk": 1024,
+        "send_max_frames": 4,
+        "send_interval": 0.0,
+        # "-fflags nobuffer" measured ~90 ms *worse* on raw PCM input, so it is not used.
+        "input_args": [],
+        "output_args": ["-flush_packets", "1"],
+        "low_latency_codec_args": True,
+    },
+}
+LATENCY_PROFILE = 'normal'
+
+# Encoder backend for MP3:
+# - "auto": in-process LAME (lameenc) when installed, else ffmpeg
+# - "lame": same as auto, but says so explicitly
+# - "ffmpeg": always use the ffmpeg subprocess
+ENCODER_BACKEND = 'auto'
+
+# TPDF dither when converting float capture (soundcard loopback) to 16-bit.
+DITHER = False
+
+# Slow clients: once a client is more than LAG_BUDGET_SECONDS behind live it is either
+# skipped forward to live ("skip") or dropped ("disconnect"), so it never holds anyone back.
+SLOW_CLIENT_POLICY = 'skip'
+LAG_BUDGET_SECONDS = 3.0
+# Where a skipped client lands: this far behind live, so its player has something to chew on.
+SKIP_TO_LIVE_CUSHION_SECONDS = 0.5
+
+# Instant start: a new client first gets this much already-encoded audio in one burst,
+# so the player fills its buffer at LAN speed. It also becomes that client's delay.
+BURST_SECONDS = 2.0
+# Keep capture and encoder running this long after the last client leaves, so the
+# next connection (e.g. a Sonos zone switch) finds a ready backlog. 0 stops immediately.
+HUB_LINGER_SECONDS = 30.0
+
+# Stream sockets: TCP_NODELAY sends each batch of frames right away instead of holding it
+# until the previous one is acknowledged (Nagle); SEND_BUFFER_BYTES is the per-client kernel
+# send buffer (SO_SNDBUF; 0 keeps the OS default). STREAM_FRAMING "chunked" answers HTTP/1.1
+# requests with Transfer-Encoding: chunked; "raw" sends the body as-is until the connection
+# closes, which every player understands.
+TCP_NODELAY = True
+SEND_BUFFER_BYTES = 65536
+STREAM_FRAMING = 'raw'
+
+# Idle suspend: after this many seconds of capture below SILENCE_THRESHOLD_DB (peak, dBFS),
+# encoders stop being fed and clients get prebuilt silent frames instead; the first loud
+# block resumes encoding. 0 disables it.
+IDLE_SUSPEND_SECONDS = 30.0
+SILENCE_THRESHOLD_DB = -60.0
+
+# Stream sample rate: "44100", "48000", or "auto" for the capture device's own rate
+# (when it is one of those), so a 48 kHz device is not resampled by the OS or ffmpeg.
+SAMPLE_RATE_SETTING = "44100"
+SUPPORTED_SAMPLE_RATES = (44100, 48000)
+
+# Lock the stream to the host clock: estimate the capture clock's drift and resample
+# by the difference, so latency stays put over days (see DriftCorrector).
+DRIFT_CORRECTION = False
+
+# Level processing on the capture (see DspChain): fixed gain in dB, loudness normalization
+# to a target in LUFS (None: off; -16 suits most listening), a look-ahead limiter instead
+# of hard clipping, and an optional channel map ("swap", "mono", "left", "right", or a
+# list of input channels such as [1, 0]).
+GAIN_DB = 0.0
+LOUDNESS_TARGET_LUFS: Optional[float] = None
+LIMITER = True
+LIMITER_CEILING_DB = -1.0
+CHANNEL_MAP = ''
+
+# Bitrate ladder (kbps): extra rungs of MP3, AAC and Opus served as e.g. /stream?q=64, each
+# encoded once and shared by everyone on that rung. The codec's own bitrate is the plain URL.
+QUALITY_LADDER = (320, 192, 128, 96, 64)
+
+# Timeshift: keep this many seconds of each running stream in a memory-mapped ring file, so
+# players can start behind live (/stream?offset=-30s) or pick up where they dropped
+# (/stream?offset=resume). 0 disables it. The files are temporary and live in TIMESHIFT_DIR
+# (empty: the system temp directory; prefer a disk over a RAM-backed /tmp for long buffers).
+TIMESHIFT_SECONDS = 0.0
+TIMESHIFT_DIR = ''
+# How long a dropped client can come back with ?offset=resume (the stream keeps running meanwhile).
+TIMESHIFT_RESUME_SECONDS = 600.0
+# Never serve frames this close to being overwritten, on top of SEND_TIMEOUT and one read
+# (a view into the file stays in use until the client has taken it).
+TIMESHIFT_GUARD_SECONDS = 2.0
+TIMESHIFT_READ_BYTES = 65536  # most bytes sent from the timeshift file per write
+
+# Station name announced to players (icy-name, ICY StreamTitle); extra sources append their name.
+STATION_NAME = 'Sonos Streamer'
+
+def apply_config(config: dict) -> None:
+    """Set the module settings from a loaded config; keys that are missing keep their current value."""
+    global DDNS_DOMAIN, DDNS_HOST, DDNS_PASSWORD, PUBLIC_ENABLED, AUDIO_MODE, LATENCY_PROFILE
+    global ENCODER_BACKEND, DITHER, SLOW_CLIENT_POLICY, LAG_BUDGET_SECONDS, BURST_SECONDS, HUB_LINGER_SECONDS
+    global AUDIO_DEVICE, SOURCES, IDLE_SUSPEND_SECONDS, SILENCE_THRESHOLD_DB
+    global SAMPLE_RATE, SAMPLE_RATE_SETTING, DRIFT_CORRECTION, STATION_NAME, DDNS_PROVIDER, IP_LOOKUP_URL
+    global QUALITY_LADDER, TIMESHIFT_SECONDS, TIMESHIFT_DIR
+    global GAIN_DB, LOUDNESS_TARGET_LUFS, LIMITER, LIMITER_CEILING_DB, CHANNEL_MAP
+    global TCP_NODELAY, SEND_BUFFER_BYTES, STREAM_FRAMING
+    DDNS_DOMAIN = config.get('domain', DDNS_DOMAIN)
+    DDNS_HOST = config.get('host', DDNS_HOST)
+    DDNS_PASSWORD = config.get('password', DDNS_PASSWORD)
+    DDNS_PROVIDER = str(config.get('ddns_provider', DDNS_PROVIDER) or '').strip() or 'namecheap'
+    IP_LOOKUP_URL = str(config.get('ip_lookup_url', IP_LOOKUP_URL) or '').strip() or IP_LOOKUP_URL
+    PUBLIC_ENABLED = bool(config.get('public_enabled', PUBLIC_ENABLED))
+    AUDIO_MODE = config.get('audio_mode', AUDIO_MODE)
+    AUDIO_DEVICE = str(config.get('device', AUDIO_DEVICE) or '')
+    SOURCES = parse_sources(config.get('sources', SOURCES))
+    LATENCY_PROFILE = config.get('latency_profile', LATENCY_PROFILE)
+    ENCODER_BACKEND = config.get('encoder_backend', ENCODER_BACKEND)
+    DITHER = bool(config.get('dither', DITHER))
+    SLOW_CLIENT_POLICY = config.get('slow_client_policy', SLOW_CLIENT_POLICY)
+    LAG_BUDGET_SECONDS = float(config.get('lag_budget', LAG_BUDGET_SECONDS))
+    BURST_SECONDS = float(config.get('burst_seconds', BURST_SECONDS))
+    HUB_LINGER_SECONDS = float(config.get('hub_linger', HUB_LINGER_SECONDS))
+    TCP_NODELAY = bool(config.get('tcp_nodelay', TCP_NODELAY))
+    SEND_BUFFER_BYTES = max(0, int(config.get('send_buffer', SEND_BUFFER_BYTES)))
+    STREAM_FRAMING = str(config.get('stream_framing', STREAM_FRAMING) or '').lower().strip() or 'raw'
+    IDLE_SUSPEND_SECONDS = float(config.get('idle_suspend', IDLE_SUSPEND_SECONDS))
+    SILENCE_THRESHOLD_DB = float(config.get('silence_threshold', SILENCE_THRESHOLD_DB))
+    DRIFT_CORRECTION = bool(config.get('drift_correction', DRIFT_CORRECTION))
+    STATION_NAME = str(config.get('station_name', STATION_NAME) or '').strip() or 'Sonos Streamer'
+    QUALITY_LADDER = parse_quality_ladder(config.get('quality_ladder', QUALITY_LADDER))
+    TIMESHIFT_SECONDS = float(config.get('timeshift', TIMESHIFT_SECONDS))
+    TIMESHIFT_DIR = str(config.get('timeshift_dir', TIMESHIFT_DIR) or '')
+    GAIN_DB = float(config.get('gain', GAIN_DB) or 0.0)
+    loudness_target = config.get('loudness_target', LOUDNESS_TARGET_LUFS)
+    LOUDNESS_TARGET_LUFS = None if loudness_target in (None, '') else float(loudness_target)
+    LIMITER = bool(config.get('limiter', LIMITER))
+    LIMITER_CEILING_DB = min(0.0, float(config.get('limiter_ceiling', LIMITER_CEILING_DB)))
+    CHANNEL_MAP = config.get('channel_map', CHANNEL_MAP) or ''
+    if isinstance(CHANNEL_MAP, str) and CHANNEL_MAP.strip().startswith('['):
+        # Registry values hold the JSON text of a list.
+        CHANNEL_MAP = json.loads(CHANNEL_MAP)
+    SAMPLE_RATE_SETTING = str(config.get('sample_rate', SAMPLE_RATE_SETTING)).strip().lower()
+    if SAMPLE_RATE_SETTING.isdigit() and int(SAMPLE_RATE_SETTING) in SUPPORTED_SAMPLE_RATES:
+        SAMPLE_RATE = int(SAMPLE_RATE_SETTING)
+    # "auto" is settled by resolve_sample_rate() once the capture device is known.
+    # The capture source depends on AUDIO_MODE.
+    _audio_source_cache.clear()
+
+SOURCE_NAME_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-")
+AUDIO_MODES = ("loopback", "vbcable", "monitor", "default", "synthetic")
+
+def parse_source_spec(spec: str) -> dict:
+    """Parse "[mode:]device", e.g. "monitor:HDMI" or "USB Audio", into a source dict."""
+    mode, sep, device = spec.partition(":")
+    if sep and mode.strip().lower() in AUDIO_MODES:
+        return {"audio_mode": mode.strip().lower(), "device": device.strip()}
+    return {"device": spec.strip()}
+
+def parse_sources(value) -> dict[str, dict]:
+    """Named sources from config: a dict (JSON config) or its JSON text (registry)."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value) if value.strip() else {}
+        except ValueError:
+            print("Ignoring invalid 'sources' setting:", value)
+            return {}
+    sources: dict[str, dict] = {}
+    for name, spec in (value or {}).items():
+        if not name or not set(name) <= SOURCE_NAME_CHARS:
+            print(f"Ignoring source '{name}': use letters, digits, '-' or '_'.")
+            continue
+        sources[name] = parse_source_spec(spec) if isinstance(spec, str) else dict(spec)
+    return sources
+
+def parse_quality_ladder(value) -> tuple[int, ...]:
+    """Ladder rungs in kbps from config: a list, or text like "320,192,96,64" or "320|192|96|64"."""
+    if isinstance(value, str):
+        # Registry values hold the JSON text of a list.
+        value = value.strip("[] ").replace("|", ",").split(",")
+    rungs = []
+    for item in value or ():
+        text = str(item).strip().lower().rstrip("k")
+        if not text:
+            continue
+        if not text.isdigit() or not 8 <= int(text) <= 512:
+            print(f"Ignoring quality ladder rung '{item}': use a bitrate in kbps, 8 to 512.")
+            continue
+        rungs.append(int(text))
+    return tuple(sorted(set(rungs), reverse=True))
+
+def get_latency_profile() -> dict:
+    return LATENCY_PROFILES.get((LATENCY_PROFILE or "").lower().strip(), LATENCY_PROFILES["normal"])
 
 def show_settings():
+    import tkinter as tk
+    from tkinter import messagebox
+
     root = tk.Tk()
     root.title("Sonos Streamer Settings")
-    root.geometry("350x250")
+    root.geometry("350x330")
     
-    # Get IPs
+    # Get IPs; the public one is looked up off the UI thread unless it is already cached.
     local_ip = socket.gethostbyname(socket.gethostname())
-    public_ip = get_public_ip() or "Unable to fetch"
-    
+    public_ip = cached_public_ip()
+    public_ip_var = tk.StringVar(value=f"Public IP: {public_ip or 'fetching...'}")
+    if public_ip is None:
+        lookup: list = []
+        threading.Thread(target=lambda: lookup.append(get_public_ip()), daemon=True).start()
+
+        def show_public_ip():
+            if not lookup:
+                root.after(200, show_public_ip)
+            else:
+                public_ip_var.set(f"Public IP: {lookup[0] or 'Unable to fetch'}")
+        root.after(200, show_public_ip)
+
     tk.Label(root, text=f"Local IP: {local_ip}").pack()
-    tk.Label(root, text=f"Public IP: {public_ip}").pack()
+    tk.Label(root, textvariable=public_ip_var).pack()
     tk.Label(root, text="").pack()  # Spacer
     
     tk.Label(root, text="Domain:").pack()
@@ -274,48 +543,595 @@ def show_settings():
     for label, value in modes:
         # On macOS, loopback generally requires a virtual device anyway, but we keep the option visible.
         tk.Radiobutton(root, text=label, variable=audio_mode_var, value=value).pack(anchor="w")
+
+    tk.Label(root, text="Latency:").pack()
+    latency_profile_var = tk.StringVar(value=LATENCY_PROFILE)
+    profiles = [("Normal (most robust)", "normal"), ("Low latency (more CPU)", "low")]
+    for label, value in profiles:
+        tk.Radiobutton(root, text=label, variable=latency_profile_var, value=value).pack(anchor="w")
     
     def save():
-        global DDNS_DOMAIN, DDNS_HOST, DDNS_PASSWORD, AUDIO_MODE, PUBLIC_ENABLED
+        global DDNS_DOMAIN, DDNS_HOST, DDNS_PASSWORD, AUDIO_MODE, PUBLIC_ENABLED, LATENCY_PROFILE
         DDNS_DOMAIN = domain_entry.get()
         DDNS_HOST = host_entry.get()
         DDNS_PASSWORD = password_entry.get()
         AUDIO_MODE = audio_mode_var.get()
         PUBLIC_ENABLED = bool(public_enabled_var.get())
+        LATENCY_PROFILE = latency_profile_var.get()
+        # Keep settings that have no field in this dialog.
         config = {
+            **load_config(),
             'domain': DDNS_DOMAIN,
             'host': DDNS_HOST,
             'password': DDNS_PASSWORD,
             'audio_mode': AUDIO_MODE,
             'public_enabled': PUBLIC_ENABLED,
+            'latency_profile': LATENCY_PROFILE,
         }
         save_config(config)
+        _audio_source_cache.clear()
+        if PUBLIC_ENABLED:
+            # Publish the new record now rather than at the next scheduled check.
+            DDNS_UPDATER.start()
+            DDNS_UPDATER.poke()
         messagebox.showinfo("Settings", "Settings saved!")
         root.destroy()
     
     tk.Button(root, text="Save", command=save).pack()
     root.mainloop()
 
-def ddns_thread():
-    last_ip = None
-    while True:
-        ip = get_public_ip()
-        if ip and ip != last_ip:
-            update_ddns(ip)
-            last_ip = ip
-        time.sleep(DDNS_UPDATE_INTERVAL)
+# --- DDNS ---
+# Public mode keeps a DDNS record pointing at this machine. The public IP is looked up
+# at most once per DDNS_UPDATE_INTERVAL (cached, shared with the settings dialog), or
+# straight away when the local address changes or the settings are saved; the record is
+# only updated when the IP differs from the last one published, which is remembered
+# across restarts. Failed lookups/updates are retried with exponential backoff.
+
+# Update URL template and the text a successful response contains (None: any 2xx).
+DDNS_PROVIDERS = {
+    "namecheap": {
+        "url": "https://dynamicdns.park-your-domain.com/update?host={host}&domain={domain}&password={password}&ip={ip}",
+        "ok": "<ErrCount>0</ErrCount>",
+    },
+    "duckdns": {
+        "url": "https://www.duckdns.org/update?domains={domain}&token={password}&ip={ip}",
+        "ok": "OK",
+    },
+}
+DDNS_HTTP_TIMEOUT = (5.0, 10.0)  # (connect, read) seconds
+DDNS_RETRY_MIN_SECONDS = 30.0
+DDNS_RETRY_MAX_SECONDS = 3600.0
+DDNS_LOCAL_CHECK_SECONDS = 15.0  # how often the local address is compared
+
+_http_session_lock = threading.Lock()
+_http_session: Optional[requests.Session] = None
+_public_ip_lock = threading.Lock()
+_public_ip: Optional[str] = None
+_public_ip_at = 0.0
+
+def http_session() -> requests.Session:
+    """Shared session, so repeated lookups and updates reuse their connections."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=2)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+def cached_public_ip() -> Optional[str]:
+    """Last looked-up public IP if it is still fresh, without any network access."""
+    if _public_ip is not None and time.monotonic() - _public_ip_at < DDNS_UPDATE_INTERVAL:
+        return _public_ip
+    return None
+
+def get_public_ip(max_age: Optional[float] = None) -> Optional[str]:
+    """Public IP from IP_LOOKUP_URL, reusing a lookup younger than `max_age` (default DDNS_UPDATE_INTERVAL)."""
+    global _public_ip, _public_ip_at
+    max_age = DDNS_UPDATE_INTERVAL if max_age is None else max_age
+    # Held during the lookup, so concurrent callers share one request.
+    with _public_ip_lock:
+        if _public_ip is not None and time.monotonic() - _public_ip_at < max_age:
+            return _public_ip
+        try:
+            response = http_session().get(IP_LOOKUP_URL, timeout=DDNS_HTTP_TIMEOUT)
+            response.raise_for_status()
+            try:
+                text = str(response.json()["ip"])
+            except (ValueError, KeyError, TypeError):
+                text = response.text.strip()
+            ip = str(ipaddress.ip_address(text))
+        except Exception as e:
+            print(f"Public IP lookup failed: {e}")
+            return None
+        _public_ip, _public_ip_at = ip, time.monotonic()
+        return ip
+
+def ddns_update_url(ip: str) -> str:
+    provider = DDNS_PROVIDERS.get(DDNS_PROVIDER.lower(), {"url": DDNS_PROVIDER})
+    values = {"host": DDNS_HOST, "domain": DDNS_DOMAIN, "password": DDNS_PASSWORD, "ip": ip}
+    return provider["url"].format(**{k: urllib.parse.quote(str(v), safe="") for k, v in values.items()})
+
+def update_ddns(ip: str) -> bool:
+    """Point the DDNS record at `ip`; True on success."""
+    if not DDNS_DOMAIN or not DDNS_PASSWORD:
+        return False
+    ok_text = DDNS_PROVIDERS.get(DDNS_PROVIDER.lower(), {}).get("ok")
+    try:
+        response = http_session().get(ddns_update_url(ip), timeout=DDNS_HTTP_TIMEOUT)
+        print(f"DDNS response: {response.text.strip()}")
+        if response.ok and (ok_text is None or ok_text in response.text):
+            print(f"DDNS updated to {ip}")
+            return True
+        print(f"DDNS update failed: HTTP {response.status_code}")
+    except Exception as e:
+        print(f"DDNS update error: {e}")
+    return False
+
+def local_address(peer: str = "192.0.2.1") -> Optional[str]:
+    """Address of the interface that routes to `peer` (default: the internet); connecting a UDP socket sends nothing."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect((peer, 9))  # TEST-NET-1 by default, never actually contacted
+            return probe.getsockname()[0]
+    except OSError:
+        return None
+
+class DdnsUpdater:
+    """Background thread that keeps the DDNS record current (see the section comment)."""
+
+    def __init__(self, state_path: Optional[Path] = None):
+        self._state_path = state_path
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # What was last published: {"ip", "provider", "domain", "host"}.
+        self.published: dict = {}
+        self.retry_delay = DDNS_RETRY_MIN_SECONDS
+
+    @property
+    def state_path(self) -> Path:
+        return self._state_path or _get_user_config_path().with_name("ddns_state.json")
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self.published = self._load_state()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake.set()
+
+    def poke(self) -> None:
+        """Look up the public IP and publish it now (e.g. after the settings changed)."""
+        self._wake.set()
+
+    def sync(self, fresh_lookup: bool = False) -> bool:
+        """Publish the current public IP unless it is already published; True when up to date."""
+        ip = get_public_ip(max_age=0 if fresh_lookup else None)
+        if ip is None:
+            return False
+        target = {"ip": ip, "provider": DDNS_PROVIDER, "domain": DDNS_DOMAIN, "host": DDNS_HOST}
+        if target == self.published:
+            return True
+        if not update_ddns(ip):
+            return False
+        self.published = target
+        self._save_state()
+        return True
+
+    def _run(self) -> None:
+        local = local_address()
+        next_sync = 0.0
+        fresh_lookup = False
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            if fresh_lookup or now >= next_sync:
+                if self.sync(fresh_lookup):
+                    self.retry_delay = DDNS_RETRY_MIN_SECONDS
+                    next_sync = now + DDNS_UPDATE_INTERVAL
+                else:
+                    print(f"DDNS: retrying in {self.retry_delay:.0f} s")
+                    next_sync = now + self.retry_delay
+                    self.retry_delay = min(self.retry_delay * 2, DDNS_RETRY_MAX_SECONDS)
+                fresh_lookup = False
+            if self._wake.wait(min(DDNS_LOCAL_CHECK_SECONDS, max(0.0, next_sync - time.monotonic()))):
+                self._wake.clear()
+                fresh_lookup = True
+                continue
+            # A new local address (other network, new DHCP lease) likely means a new public one.
+            address = local_address()
+            if address != local:
+                local = address
+                fresh_lookup = True
+
+    def _load_state(self) -> dict:
+        try:
+            state = json.loads(self.state_path.read_text(encoding="utf-8"))
+            return state if isinstance(state, dict) else {}
+        except Exception:
+            return {}
+
+    def _save_state(self) -> None:
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            self.state_path.write_text(json.dumps(self.published), encoding="utf-8")
+        except Exception as e:
+            print(f"Could not save DDNS state: {e}")
+
+DDNS_UPDATER = DdnsUpdater()
+
+# --- Sonos ---
+# Find the Sonos players on the LAN and start this stream on one, instead of building a
+# TuneIn custom station by hand. An SSDP M-SEARCH goes out from every local interface at
+# once and every player's description is fetched in parallel; the answers land in
+# SONOS_ZONES, reused for SONOS_CACHE_SECONDS. Each zone remembers which of our addresses
+# it answered on, so the URL it is given is one it can reach. Playing is two UPnP
+# AVTransport calls: SetAVTransportURI with an x-rincon-mp3radio:// URL (Sonos's scheme
+# for an endless MP3 stream) and Play.
+
+SSDP_ADDRESS = ("239.255.255.250", 1900)
+SONOS_SEARCH_TARGET = "urn:schemas-upnp-org:device:ZonePlayer:1"
+SSDP_SEARCH_SECONDS = 2.0    # how long answers are collected (players reply within MX = 1 s)
+SONOS_CACHE_SECONDS = 300.0
+SONOS_HTTP_TIMEOUT = (2.0, 5.0)  # (connect, read) seconds
+SONOS_AVTRANSPORT_PATH = "/MediaRenderer/AVTransport/Control"
+SONOS_AVTRANSPORT_SERVICE = "urn:schemas-upnp-org:service:AVTransport:1"
+# UPnP error codes Sonos answers with, for messages a person can act on.
+SONOS_ERRORS = {
+    701: "transition not available",
+    714: "unsupported stream format",
+    800: "the player is part of a group; play on the group's coordinator or ungroup it",
+}
+
+class SonosZone:
+    """One Sonos player found by SSDP."""
+
+    def __init__(self, name: str, ip: str, location: str, udn: str, model: str = "", local_ip: Optional[str] = None):
+        self.name = name
+        self.ip = ip
+        self.location = location  # device description URL
+        self.udn = udn
+        self.model = model
+        # Our address on the interface the player answered on.
+        self.local_ip = local_ip
+
+    @property
+    def control_url(self) -> str:
+        parts = urllib.parse.urlsplit(self.location)
+        return f"{parts.scheme}://{parts.netloc}{SONOS_AVTRANSPORT_PATH}"
+
+    def stream_url(self, path: str = "/stream") -> str:
+        """The stream as this player should fetch it, on an address it can reach."""
+        host = self.local_ip or local_address(self.ip) or socket.gethostbyname(socket.gethostname())
+        return f"x-rincon-mp3radio://{host}:{PORT}{path}"
+
+    def matches(self, spec: str) -> bool:
+        """True for the player's IP, or a room name equal to or starting with `spec` (any case)."""
+        spec = spec.strip().lower()
+        return spec == self.ip or self.name.lower().startswith(spec)
+
+SONOS_ZONES: dict[str, SonosZone] = {}  # UDN -> zone
+_sonos_zones_at: Optional[float] = None
+_sonos_lock = threading.Lock()
+
+def local_interfaces() -> list[str]:
+    """IPv4 addresses to search from: the default route's, then any others the host name resolves to."""
+    addresses = []
+    primary = local_address()
+    if primary:
+        addresses.append(primary)
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            ip = info[4][0]
+            if ip not in addresses and not ipaddress.ip_address(ip).is_loopback:
+                addresses.append(ip)
+    except OSError:
+        pass
+    return addresses
+
+def ssdp_search_message(target: str = SONOS_SEARCH_TARGET) -> bytes:
+    return (
+        "M-SEARCH * HTTP/1.1\r\n"
+        f"HOST: {SSDP_ADDRESS[0]}:{SSDP_ADDRESS[1]}\r\n"
+        'MAN: "ssdp:discover"\r\n'
+        "MX: 1\r\n"
+        f"ST: {target}\r\n\r\n"
+    ).encode("ascii")
+
+def parse_ssdp_response(data: bytes) -> dict[str, str]:
+    """Headers of an SSDP answer (lower-case names); empty unless it is a 200 response."""
+    lines = data.decode("latin-1", "replace").split("\r\n")
+    if not lines[0].startswith("HTTP/1.1 200"):
+        return {}
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+def fetch_zone(location: str, local_ip: Optional[str]) -> Optional[SonosZone]:
+    """Read a player's device description; None if it can't be read or is not a Sonos player."""
+    try:
+        response = http_session().get(location, timeout=SONOS_HTTP_TIMEOUT)
+        response.raise_for_status()
+        device = ET.fromstring(response.content).find("{urn:schemas-upnp-org:device-1-0}device")
+    except Exception as e:
+        print(f"Sonos description {location}: {e}")
+        return None
+    if device is None:
+        return None
+
+    def text(tag: str) -> str:
+        return (device.findtext("{urn:schemas-upnp-org:device-1-0}" + tag) or "").strip()
+    udn = text("UDN")
+    if not udn:
+        return None
+    ip = urllib.parse.urlsplit(location).hostname or ""
+    name = text("roomName") or text("friendlyName") or ip
+    return SonosZone(name, ip, location, udn, text("modelName"), local_ip)
+
+class _SsdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, on_response, local_ip: str):
+        self._on_response = on_response
+        self._local_ip = local_ip
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self._on_response(data, self._local_ip)
+
+async def ssdp_search(
+    timeout: float = SSDP_SEARCH_SECONDS, interfaces: Optional[list[str]] = None,
+    address: tuple[str, int] = SSDP_ADDRESS, stop_when=None,
+) -> list[SonosZone]:
+    """Search for Sonos players from every interface at once and describe each in parallel.
+
+    Returns as soon as a described zone satisfies `stop_when`, else after `timeout` plus
+    whatever descriptions are still being fetched.
+    """
+    loop = asyncio.get_running_loop()
+    found: dict[str, SonosZone] = {}
+    seen: set[str] = set()
+    pending: set[asyncio.Future] = set()
+    enough = asyncio.Event()
+
+    async def describe(location: str, local_ip: str) -> None:
+        zone = await loop.run_in_executor(None, fetch_zone, location, local_ip)
+        if zone is not None:
+            found[zone.udn] = zone
+            if stop_when is not None and stop_when(zone):
+                enough.set()
+
+    def on_response(data: bytes, local_ip: str) -> None:
+        headers = parse_ssdp_response(data)
+        location = headers.get("location")
+        if not location or location in seen:
+            return
+        if headers.get("st") != SONOS_SEARCH_TARGET and "sonos" not in headers.get("server", "").lower():
+            return
+        seen.add(location)
+        task = loop.create_task(describe(location, local_ip))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    message = ssdp_search_message()
+    transports = []
+    for local_ip in interfaces if interfaces is not None else local_interfaces():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(local_ip))
+            sock.bind((local_ip, 0))
+            sock.setblocking(False)
+            transport, _ = await loop.create_datagram_endpoint(lambda ip=local_ip: _SsdpProtocol(on_response, ip), sock=sock)
+        except OSError as e:
+            sock.close()
+            print(f"SSDP search on {local_ip}: {e}")
+            continue
+        transports.append(transport)
+        # Twice, since UDP may drop one.
+        transport.sendto(message, address)
+        transport.sendto(message, address)
+    try:
+        if transports:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(enough.wait(), timeout)
+    finally:
+        for transport in transports:
+            transport.close()
+    if pending and not enough.is_set():
+        await asyncio.wait(pending, timeout=sum(SONOS_HTTP_TIMEOUT))
+    return sorted(found.values(), key=lambda zone: (zone.name.lower(), zone.ip))
+
+def discover_zones(max_age: float = SONOS_CACHE_SECONDS, wanted: Optional[str] = None) -> list[SonosZone]:
+    """Sonos zones from SONOS_ZONES if younger than `max_age`, else from a new search.
+
+    With `wanted` (a room name or IP), the cache is used if it holds a match, whatever its
+    age, and a new search stops at the first match.
+    """
+    global _sonos_zones_at
+    # Held during the search, so the tray and the command line share one.
+    with _sonos_lock:
+        if wanted is not None:
+            cached = any(zone.matches(wanted) for zone in SONOS_ZONES.values())
+        else:
+            cached = _sonos_zones_at is not None and time.monotonic() - _sonos_zones_at < max_age
+        if cached:
+            return sorted(SONOS_ZONES.values(), key=lambda zone: (zone.name.lower(), zone.ip))
+        stop_when = (lambda zone: zone.matches(wanted)) if wanted is not None else None
+        zones = asyncio.run(ssdp_search(stop_when=stop_when))
+        if stop_when is None:
+            SONOS_ZONES.clear()
+            _sonos_zones_at = time.monotonic()
+        SONOS_ZONES.update((zone.udn, zone) for zone in zones)
+        return zones
+
+def _didl_radio_metadata(title: str) -> str:
+    """DIDL-Lite describing a radio station, so Sonos shows `title` and treats the stream as live."""
+    return (
+        '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
+        'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '
+        'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
+        '<item id="R:0/0/0" parentID="R:0/0" restricted="true">'
+        f"<dc:title>{xml_escape(title)}</dc:title>"
+        "<upnp:class>object.item.audioItem.audioBroadcast</upnp:class>"
+        '<desc id="cdudn" nameSpace="urn:schemas-rinconnetworks-com:metadata-1-0/">SA_RINCON65031_</desc>'
+        "</item></DIDL-Lite>"
+    )
+
+def upnp_action(url: str, service: str, action: str, arguments: dict[str, str]) -> str:
+    """Call a UPnP action over SOAP and return the response body; raises RuntimeError on a UPnP fault."""
+    body = "".join(f"<{name}>{xml_escape(str(value))}</{name}>" for name, value in arguments.items())
+    envelope = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+        f'<u:{action} xmlns:u="{service}">{body}</u:{action}>'
+        "</s:Body></s:Envelope>"
+    )
+    response = http_session().post(url, data=envelope.encode("utf-8"), timeout=SONOS_HTTP_TIMEOUT, headers={
+        "Content-Type": 'text/xml; charset="utf-8"',
+        "SOAPACTION": f'"{service}#{action}"',
+    })
+    if response.status_code == 500:
+        match = re.search(r"<errorCode>(\d+)</errorCode>", response.text)
+        code = int(match.group(1)) if match else None
+        raise RuntimeError(f"{action} failed: UPnP error {code} ({SONOS_ERRORS.get(code, 'unknown')})")
+    response.raise_for_status()
+    return response.text
+
+def play_on_zone(zone: SonosZone, path: str = "/stream") -> bool:
+    """Point `zone` at this stream and start it; True on success."""
+    uri = zone.stream_url(path)
+    try:
+        upnp_action(zone.control_url, SONOS_AVTRANSPORT_SERVICE, "SetAVTransportURI", {
+            "InstanceID": 0, "CurrentURI": uri, "CurrentURIMetaData": _didl_radio_metadata(STATION_NAME),
+        })
+        upnp_action(zone.control_url, SONOS_AVTRANSPORT_SERVICE, "Play", {"InstanceID": 0, "Speed": 1})
+    except Exception as e:
+        print(f"Could not play on {zone.name} ({zone.ip}): {e}")
+        return False
+    print(f"Playing on {zone.name} ({zone.ip}): {uri}")
+    return True
+
+def play_on(spec: str, path: str = "/stream") -> bool:
+    """Start this stream on the zone named (or addressed) `spec`; True on success.
+
+    A room can be several players (a stereo pair, a home theatre); only its coordinator
+    accepts the stream, so each one is tried in turn.
+    """
+    zones = [zone for zone in discover_zones(wanted=spec) if zone.matches(spec)]
+    if not zones:
+        print(f"No Sonos zone matches '{spec}'. Found: {', '.join(z.name for z in SONOS_ZONES.values()) or 'none'}")
+        return False
+    return any(play_on_zone(zone, path) for zone in zones)
+
+# --- Audio devices ---
+
+def _sounddevice():
+    """Import sounddevice (PortAudio) on first use."""
+    global sd
+    if sd is None:
+        import sounddevice
+        sd = sounddevice
+    return sd
+
+def _soundcard():
+    """Import soundcard on first use; None when it is not installed or cannot load."""
+    global sc, _soundcard_tried
+    if not _soundcard_tried:
+        _soundcard_tried = True
+        try:
+            import soundcard  # Better Windows loopback capture than PortAudio WASAPI loopback
+            sc = soundcard
+        except Exception:
+            sc = None
+    return sc
+
+# Enumerating devices walks every host API (and wakes some drivers), so do it once.
+_device_cache: dict = {}
+
+def query_devices(refresh: bool = False) -> tuple[list, list]:
+    """Return (devices, hostapis) as PortAudio reports them, cached after the first call."""
+    if refresh or not _device_cache:
+        sounddevice = _sounddevice()
+        _device_cache["devices"] = list(sounddevice.query_devices())
+        _device_cache["hostapis"] = list(sounddevice.query_hostapis())
+    return _device_cache["devices"], _device_cache["hostapis"]
+
+def restart_portaudio() -> None:
+    """Re-initialise PortAudio and forget the cached device list.
+
+    PortAudio only enumerates devices when it initialises, so a cable or interface that
+    was unplugged and plugged back in stays invisible (or keeps a stale index) until then.
+    Every open PortAudio stream is invalidated, so only call this with none open.
+    """
+    sounddevice = _sounddevice()
+    sounddevice._terminate()
+    sounddevice._initialize()
+    _device_cache.clear()
 
 def _find_device_containing(name_substring: str, min_input_channels: int = 2) -> Optional[int]:
-    for idx, dev in enumerate(sd.query_devices()):
+    devices, _ = query_devices()
+    for idx, dev in enumerate(devices):
         if name_substring in dev.get("name", "") and dev.get("max_input_channels", 0) >= min_input_channels:
             return idx
     return None
 
-def _find_wasapi_output_device() -> Optional[int]:
-    """Return a device index that belongs to the Windows WASAPI host API."""
+def find_input_device(spec: str) -> Optional[int]:
+    """PortAudio input device by index ("3") or case-insensitive part of its name."""
+    devices, _ = query_devices()
+    spec = spec.strip()
+    if spec.isdigit():
+        idx = int(spec)
+        if idx < len(devices) and devices[idx].get("max_input_channels", 0) > 0:
+            return idx
+        return None
+    for idx, dev in enumerate(devices):
+        if spec.lower() in str(dev.get("name", "")).lower() and dev.get("max_input_channels", 0) > 0:
+            return idx
+    return None
+
+def uses_soundcard_capture(audio_mode: Optional[str] = None) -> bool:
+    """Windows loopback and Linux monitor capture go through soundcard rather than PortAudio."""
+    requested = (AUDIO_MODE if audio_mode is None else audio_mode or "").lower().strip()
+    return requested == "monitor" or (IS_WINDOWS and requested == "loopback")
+
+def list_audio_devices() -> None:
+    """Print what --device can select."""
+    try:
+        devices, hostapis = query_devices()
+        print("PortAudio inputs (--device INDEX or part of the name):")
+        for idx, dev in enumerate(devices):
+            if dev.get("max_input_channels", 0) > 0:
+                hostapi = hostapis[dev["hostapi"]]["name"] if dev.get("hostapi", -1) < len(hostapis) else "?"
+                print(f"  {idx:>3}  {dev['name']}  ({hostapi}, {dev['max_input_channels']} ch)")
+    except Exception as e:
+        print("PortAudio unavailable:", e)
+    soundcard = _soundcard()
+    if soundcard is None:
+        print("soundcard is not installed: monitor/loopback capture unavailable.")
+        return
+    try:
+        print("Outputs for --audio-mode monitor/loopback (--device part of the name):")
+        for speaker in soundcard.all_speakers():
+            print(f"       {speaker.name}")
+        print("Monitor sources:")
+        for mic in soundcard.all_microphones(include_loopback=True):
+            if getattr(mic, "isloopback", False):
+                print(f"       {mic.name}")
+    except Exception as e:
+        print("soundcard error:", e)
+
+def _find_wasapi_output_device(name: str = "") -> Optional[int]:
+    """Return a device index that belongs to the Windows WASAPI host API (the one named like `name`, if given)."""
     try:
-        hostapis = sd.query_hostapis()
-        devices = sd.query_devices()
+        devices, hostapis = query_devices()
     except Exception:
         return None
 
@@ -329,6 +1145,13 @@ def _find_wasapi_output_device() -> Optional[int]:
     if wasapi_hostapi_idx is None:
         return None
 
+    if name:
+        for idx, dev in enumerate(devices):
+            if (dev.get("hostapi") == wasapi_hostapi_idx and dev.get("max_output_channels", 0) > 0
+                    and name.lower() in str(dev.get("name", "")).lower()):
+                return idx
+        return None
+
     try:
         default_out = hostapis[wasapi_hostapi_idx].get("default_output_device", None)
         if isinstance(default_out, int) and default_out >= 0:
@@ -344,8 +1167,7 @@ def _find_wasapi_output_device() -> Optional[int]:
 def _find_wasapi_loopback_input_device(min_input_channels: int = 2) -> Optional[int]:
     """Some PortAudio/WASAPI setups expose loopback as a dedicated *input* device."""
     try:
-        hostapis = sd.query_hostapis()
-        devices = sd.query_devices()
+        devices, hostapis = query_devices()
     except Exception:
         return None
 
@@ -367,15 +1189,44 @@ def _find_wasapi_loopback_input_device(min_input_channels: int = 2) -> Optional[
             return idx
     return None
 
-def resolve_audio_source():
-    """Return (device_index, extra_settings, mode_label, setup_hint, stream_channels)."""
+def resolve_audio_source(audio_mode: Optional[str] = None, device: Optional[str] = None):
+    """Return (device_index, extra_settings, mode_label, setup_hint, stream_channels).
+
+    audio_mode/device default to the AUDIO_MODE/AUDIO_DEVICE settings.
+    """
 
     # Prefer explicit user choice.
-    requested = (AUDIO_MODE or "").lower().strip()
+    requested = (AUDIO_MODE if audio_mode is None else audio_mode or "").lower().strip()
+    device = AUDIO_DEVICE if device is None else device
+
+    # Generated audio (see SOURCE_TYPES): nothing to look up.
+    if requested in SOURCE_TYPES:
+        return (None, None, f"{requested} ({device or 'default'})", "Generated audio, no capture device used.", CHANNELS)
+
+    # 0) Monitor of an output (PulseAudio/PipeWire): captures what the speakers play.
+    if requested == "monitor":
+        if _soundcard() is None:
+            raise RuntimeError("Monitor capture requires the 'soundcard' package (pip install soundcard).")
+        return (
+            None,
+            None,
+            f"monitor of {device or 'default output'}",
+            "Capturing what the output plays; no virtual cable needed.",
+            CHANNELS,
+        )
+
+    # An explicit input device wins over the mode's own device search.
+    if device and not uses_soundcard_capture(requested):
+        idx = find_input_device(device)
+        if idx is None:
+            raise RuntimeError(f"Input device '{device}' not found (see --list-devices).")
+        dev = query_devices()[0][idx]
+        ch = max(1, int(min(CHANNELS, dev.get("max_input_channels", CHANNELS))))
+        return (idx, None, str(dev.get("name", idx)), "Using the selected input device.", ch)
 
     # 1) Windows WASAPI loopback (no extra driver)
     if IS_WINDOWS and requested == "loopback":
-        if sc is None:
+        if _soundcard() is None:
             raise RuntimeError(
                 "Windows loopback capture requires the 'soundcard' package. Rebuild the EXE with soundcard included or switch Audio capture to 'Virtual Cable / BlackHole'."
             )
@@ -391,7 +1242,7 @@ def resolve_audio_source():
     if IS_WINDOWS:
         idx = _find_device_containing("CABLE Output")
         if idx is not None:
-            dev = sd.query_devices(idx)
+            dev = query_devices()[0][idx]
             ch = int(min(CHANNELS, dev.get("max_input_channels", CHANNELS)))
             ch = max(1, ch)
             return (
@@ -407,7 +1258,7 @@ def resolve_audio_source():
     if IS_MAC:
         idx = _find_device_containing("BlackHole")
         if idx is not None:
-            dev = sd.query_devices(idx)
+            dev = query_devices()[0][idx]
             ch = int(min(CHANNELS, dev.get("max_input_channels", CHANNELS)))
             ch = max(1, ch)
             return (
@@ -428,191 +1279,3043 @@ def resolve_audio_source():
         CHANNELS,
     )
 
-device_index, device_extra_settings, device_mode_label, device_setup_hint, stream_channels = resolve_audio_source()
+_audio_source_cache: dict = {}
 
-# HTTP streaming handler
-class StreamHandler(http.server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path != "/stream":
-            self.send_error(404)
-            return
+def get_audio_source(audio_mode: Optional[str] = None, device: Optional[str] = None) -> tuple:
+    """resolve_audio_source(), worked out once per source; apply_config() and Settings reset it."""
+    key = (audio_mode, device)
+    if key not in _audio_source_cache:
+        _audio_source_cache[key] = resolve_audio_source(audio_mode, device)
+    return _audio_source_cache[key]
 
-        self.send_response(200)
-        self.send_header("Content-Type", "audio/mpeg")
-        self.send_header("Cache-Control", "no-cache")
-        self.end_headers()
-
-        # Start ffmpeg encoder
-        ffmpeg = subprocess.Popen(
-            [
-                FFMPEG_PATH,
-                "-f", "s16le",
-                "-ar", str(SAMPLE_RATE),
-                "-ac", str(CHANNELS),
-                "-i", "pipe:0",
-                "-acodec", "libmp3lame",
-                "-b:a", BITRATE,
-                "-f", "mp3",
-                "pipe:1",
-            ],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-            bufsize=0,
-            creationflags=subprocess.CREATE_NO_WINDOW if hasattr(subprocess, 'CREATE_NO_WINDOW') else 0,
-        )
+def native_sample_rate(audio_mode: Optional[str] = None, device: Optional[str] = None) -> Optional[int]:
+    """The capture device's own rate for a source, or None if unknown (Linux monitor, synthetic)."""
+    requested = (AUDIO_MODE if audio_mode is None else audio_mode or "").lower().strip()
+    if IS_WINDOWS and requested == "loopback":
+        # Loopback delivers the output's shared-mode mix rate, which PortAudio's WASAPI
+        # entry for that output reports.
+        try:
+            device_index = _find_wasapi_output_device(AUDIO_DEVICE if device is None else device)
+            if device_index is None:
+                return None
+            return int(round(float(query_devices()[0][device_index]["default_samplerate"])))
+        except Exception:
+            return None
+    if requested in SOURCE_TYPES or uses_soundcard_capture(requested):
+        return None
+    device_index = get_audio_source(audio_mode, device)[0]
+    try:
+        if device_index is None:
+            info = _sounddevice().query_devices(kind="input")
+        else:
+            info = query_devices()[0][device_index]
+        return int(round(float(info["default_samplerate"])))
+    except Exception:
+        return None
 
-        stop_event = threading.Event()
+def resolve_sample_rate() -> None:
+    """Settle SAMPLE_RATE for sample_rate "auto" from the main source's device."""
+    global SAMPLE_RATE
+    if SAMPLE_RATE_SETTING != "auto":
+        return
+    rate = native_sample_rate()
+    if rate in SUPPORTED_SAMPLE_RATES:
+        SAMPLE_RATE = rate
+    elif rate is None:
+        print(f"Sample rate auto: the capture device's rate is unknown, using {SAMPLE_RATE} Hz")
+    else:
+        print(f"Sample rate auto: the capture device runs at {rate} Hz, using {SAMPLE_RATE} Hz")
 
-        def loopback_pump_soundcard():
-            # Uses Windows loopback capture from the default speaker device.
-            com_initialized = False
-            try:
-                if IS_WINDOWS:
-                    # soundcard uses Windows Core Audio (COM). Threads must initialize COM.
-                    # COINIT_APARTMENTTHREADED = 2
-                    hr = ctypes.windll.ole32.CoInitializeEx(None, 2)
-                    # S_OK (0) or S_FALSE (1) are success; RPC_E_CHANGED_MODE can be ignored.
-                    if hr in (0, 1):
-                        com_initialized = True
-                if sc is None:
-                    raise RuntimeError("soundcard package is not available")
-                speaker = sc.default_speaker()
-                mic = sc.get_microphone(speaker.name, include_loopback=True)
-                # soundcard records float32 in [-1, 1]
-                with mic.recorder(samplerate=SAMPLE_RATE) as rec:
-                    while not stop_event.is_set():
-                        data = rec.record(numframes=1024)
-                        if data is None:
-                            continue
-
-                        # Ensure 2D array
-                        if getattr(data, "ndim", 1) == 1:
-                            data = np.expand_dims(data, axis=1)
-
-                        # Ensure requested channel count
-                        if data.shape[1] == 1 and CHANNELS == 2:
-                            data = np.repeat(data, 2, axis=1)
-                        elif data.shape[1] >= 2 and CHANNELS == 1:
-                            data = data[:, :1]
-
-                        pcm = np.clip(data, -1.0, 1.0)
-                        pcm = (pcm * 32767.0).astype(np.int16)
-                        try:
-                            ffmpeg.stdin.write(pcm.tobytes())
-                        except (BrokenPipeError, OSError, ValueError):
-                            # Client/encoder went away.
-                            stop_event.set()
-                            break
-            except Exception as e:
-                # If capture fails, stop the stream.
-                print("Loopback capture error:", e)
-            finally:
-                if IS_WINDOWS and com_initialized:
-                    try:
-                        ctypes.windll.ole32.CoUninitialize()
-                    except Exception:
-                        pass
-                # Do not close ffmpeg stdin here; main thread owns ffmpeg lifecycle.
+# --- Startup ---
 
-        def audio_callback(indata, frames, time, status):
-            if status:
-                print(status, file=sys.stderr)
-            try:
-                data = indata
-                # Ensure 2D
-                if getattr(data, "ndim", 1) == 1:
-                    data = np.expand_dims(data, axis=1)
-                # Upmix/downmix to match encoder CHANNELS
-                if data.shape[1] == 1 and CHANNELS == 2:
-                    data = np.repeat(data, 2, axis=1)
-                elif data.shape[1] >= 2 and CHANNELS == 1:
-                    data = data[:, :1]
-                ffmpeg.stdin.write(data.tobytes())
-            except BrokenPipeError:
-                raise sd.CallbackStop()
+class StartupTimings:
+    """Wall time of each startup phase, printed at startup and exported on /metrics."""
 
+    def __init__(self):
+        self.phases: list[tuple[str, float]] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
         try:
-            if IS_WINDOWS and (AUDIO_MODE or "").lower().strip() == "loopback":
-                t = threading.Thread(target=loopback_pump_soundcard, daemon=True)
-                t.start()
-                while True:
-                    chunk = ffmpeg.stdout.read(4096)
-                    if not chunk:
-                        break
-                    try:
-                        self.wfile.write(chunk)
-                    except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError, OSError):
-                        break
-            else:
-                with sd.InputStream(
-                    samplerate=SAMPLE_RATE,
-                    device=device_index,
-                    channels=stream_channels,
-                    dtype="int16",
-                    callback=audio_callback,
-                    extra_settings=device_extra_settings,
-                ):
-                    while True:
-                        chunk = ffmpeg.stdout.read(4096)
-                        if not chunk:
-                            break
-                        try:
-                            self.wfile.write(chunk)
-                        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError, OSError):
-                            break
-        except Exception as e:
-            # Treat common client disconnects as normal.
-            msg = str(e)
-            if "10053" in msg or "10054" in msg:
-                pass
-            else:
-                print("Client disconnected:", e)
+            yield
         finally:
-            stop_event.set()
-            try:
-                try:
-                    ffmpeg.stdin.close()
-                except Exception:
-                    pass
-                ffmpeg.kill()
-            except Exception:
-                pass
+            self.phases.append((name, time.perf_counter() - started))
 
-    def log_message(self, *args):
-        return
+    def summary(self) -> str:
+        parts = [f"{name} {1000.0 * seconds:.0f} ms" for name, seconds in self.phases]
+        total = sum(seconds for _, seconds in self.phases)
+        return ", ".join(parts + [f"total {1000.0 * total:.0f} ms"])
 
+STARTUP = StartupTimings()
 
-class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    daemon_threads = True
+# --- Broadcast hub ---
+# One capture is shared by every stream. Each codec endpoint has one encoder,
+# started by its first client. Encoder output is split into whole frames and
+# kept in a bounded ring; each client reads from the ring at its own cursor.
 
+FRAME_RING_SECONDS = 10
+MP3_SAMPLES_PER_FRAME = 1152
+# Ogg page length for Opus: 100 ms keeps the muxer from holding a second of audio; the
+# "low" latency profile cuts it to 20 ms.
+OPUS_PAGE_SECONDS = 0.1
+OPUS_LOW_LATENCY_PAGE_SECONDS = 0.02
+PCM_RING_SECONDS = 2.0
+PCM_UNDERRUN_SECONDS = 0.1
 
-if __name__ == "__main__":
-    # Show settings if not configured
-    if DDNS_DOMAIN == 'yourdomain.com' or not DDNS_PASSWORD:
-        show_settings()
-        # Reload config
-        config = load_config()
-        DDNS_DOMAIN = config.get('domain', 'yourdomain.com')
-        DDNS_HOST = config.get('host', '@')
-        DDNS_PASSWORD = config.get('password', 'your_ddns_password')
-        AUDIO_MODE = config.get('audio_mode', AUDIO_MODE)
-        PUBLIC_ENABLED = bool(config.get('public_enabled', PUBLIC_ENABLED))
-    
-    local_ip = socket.gethostbyname(socket.gethostname())
-    print(f"Streaming at http://{local_ip}:{PORT}/stream")
-    if PUBLIC_ENABLED and DDNS_DOMAIN != 'yourdomain.com':
-        public_url = f"http://{DDNS_HOST}.{DDNS_DOMAIN}:{PORT}/stream" if DDNS_HOST != '@' else f"http://{DDNS_DOMAIN}:{PORT}/stream"
-        print(f"Public URL: {public_url}")
-    print(f"Audio capture: {device_mode_label}")
-    print(device_setup_hint)
-    
-    # Start DDNS update thread (public mode only)
-    if PUBLIC_ENABLED:
-        threading.Thread(target=ddns_thread, daemon=True).start()
-    
-    # Start tray icon
-    threading.Thread(target=setup_tray, daemon=True).start()
-    
-    server = ThreadedHTTPServer(("", PORT), StreamHandler)
-    server.serve_forever()
+# Codec registry: one streaming endpoint per entry.
+# - path / content_type: HTTP route and response type
+# - encoder: ffmpeg encoder name, or None to serve raw PCM without an encoder
+# - bitrate / args / format: ffmpeg output options
+# - low_latency_args: extra options used with the "low" latency profile
+# - framing: how the encoded byte stream is split into frames (see FRAMERS)
+# - frame_samples: audio samples per frame, used to size the frame ring
+# - page_seconds / low_latency_page_seconds: instead of frame_samples, for formats whose
+#   ring entries are pages of a fixed duration (normal and "low" latency profile)
+CODECS = {
+    "mp3": {
+        "path": "/stream",
+        "content_type": "audio/mpeg",
+        "encoder": "libmp3lame",
+        "bitrate": BITRATE,
+        "args": ["-id3v2_version", "0", "-write_xing", "0"],
+        "format": "mp3",
+        # No bit reservoir: every frame is self-contained and leaves the encoder as soon as it is coded.
+        "low_latency_args": ["-reservoir", "0"],
+        "framing": "mp3",
+        "frame_samples": MP3_SAMPLES_PER_FRAME,
+    },
+    "aac": {
+        "path": "/stream.aac",
+        "content_type": "audio/aac",
+        "encoder": "aac",
+        "bitrate": "96k",
+        "args": [],
+        "format": "adts",
+        "low_latency_args": [],
+        "framing": "adts",
+        "frame_samples": 1024,
+    },
+    "opus": {
+        "path": "/stream.opus",
+        "content_type": "audio/ogg; codecs=opus",
+        "encoder": "libopus",
+        "bitrate": "96k",
+        # Opus only runs at 48 kHz.
+        "args": ["-ar", "48000", "-application", "audio", "-page_duration", str(round(OPUS_PAGE_SECONDS * 1e6))],
+        "format": "ogg",
+        "low_latency_args": ["-frame_duration", "10", "-page_duration", str(round(OPUS_LOW_LATENCY_PAGE_SECONDS * 1e6))],
+        "framing": "ogg",
+        "page_seconds": OPUS_PAGE_SECONDS,
+        "low_latency_page_seconds": OPUS_LOW_LATENCY_PAGE_SECONDS,
+    },
+    "flac": {
+        "path": "/stream.flac",
+        "content_type": "audio/flac",
+        "encoder": "flac",
+        "bitrate": None,
+        "args": ["-compression_level", "0", "-frame_size", str(MP3_SAMPLES_PER_FRAME)],
+        "format": "flac",
+        "low_latency_args": [],
+        "framing": "flac",
+        "frame_samples": MP3_SAMPLES_PER_FRAME,
+    },
+    "wav": {
+        "path": "/stream.wav",
+        "content_type": "audio/wav",
+        "encoder": None,
+        "bitrate": None,
+        "args": [],
+        "format": None,
+        "low_latency_args": [],
+        "framing": "pcm",
+        "frame_samples": MP3_SAMPLES_PER_FRAME,
+    },
+}
+
+def build_encoder_command(codec: dict, profile: dict) -> list[str]:
+    """ffmpeg command line that reads s16le PCM on stdin and writes `codec` on stdout."""
+    cmd = [
+        FFMPEG_PATH,
+        # Raw PCM needs no probing; the default analyzeduration holds back seconds of audio at startup.
+        "-probesize", "32",
+        "-analyzeduration", "0",
+        *profile["input_args"],
+        "-f", "s16le",
+        "-ar", str(SAMPLE_RATE),
+        "-ac", str(CHANNELS),
+        "-i", "pipe:0",
+        "-acodec", codec["encoder"],
+    ]
+    if codec["bitrate"]:
+        cmd += ["-b:a", codec["bitrate"]]
+    cmd += codec["args"]
+    cmd += profile["output_args"]
+    if profile["low_latency_codec_args"]:
+        cmd += codec["low_latency_args"]
+    cmd += ["-f", codec["format"], "pipe:1"]
+    return cmd
+
+def codec_frame_seconds(codec: dict, profile: dict) -> float:
+    """Audio per frame-ring entry of `codec` when encoded with the latency `profile`."""
+    if "page_seconds" in codec:
+        return codec["low_latency_page_seconds"] if profile["low_latency_codec_args"] else codec["page_seconds"]
+    return codec["frame_samples"] / SAMPLE_RATE
+
+def estimate_pipeline_latency_ms(profile: dict) -> float:
+    """Buffering the server itself adds: one capture block, one writer poll, one whole MP3 frame and the send interval.
+
+    The encoder's own delay is measured separately with `python bench.py latency`.
+    """
+    frames = profile["blocksize"] + MP3_SAMPLES_PER_FRAME
+    return 1000.0 * (frames / SAMPLE_RATE + profile["writer_poll"] + profile["send_interval"])
+
+# --- Framers ---
+# A framer splits an encoder's byte stream into whole frames (or Ogg pages),
+# so the ring only ever holds units a client can start playing from.
+# `header` holds stream-level bytes a late joiner needs before any frame.
+
+_MP3_BITRATES_V1_L3 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0)
+_MP3_BITRATES_V2_L3 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0)
+_MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG-1
+    2: (22050, 24000, 16000),  # MPEG-2
+    0: (11025, 12000, 8000),   # MPEG-2.5
+}
+
+def _mp3_frame_length(header) -> int:
+    """Return the byte length of the Layer III frame starting with `header`, or 0 if invalid."""
+    if header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return 0
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    if version == 1 or layer != 1:
+        return 0
+    bitrate_idx = (header[2] >> 4) & 0x0F
+    rate_idx = (header[2] >> 2) & 0x03
+    if rate_idx == 3:
+        return 0
+    padding = (header[2] >> 1) & 0x01
+    if version == 3:
+        kbps = _MP3_BITRATES_V1_L3[bitrate_idx]
+        coeff = 144
+    else:
+        kbps = _MP3_BITRATES_V2_L3[bitrate_idx]
+        coeff = 72
+    if not kbps:
+        return 0
+    return coeff * kbps * 1000 // _MP3_SAMPLE_RATES[version][rate_idx] + padding
+
+class Framer:
+    """Base framer: subclasses return the length of the frame at `pos`."""
+
+    header = b""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def _frame_length(self, buf: bytearray, pos: int) -> Optional[int]:
+        """Length of the frame at `pos`; 0 if `pos` is not a frame start, None if more data is needed."""
+        raise NotImplementedError
+
+    def feed(self, data: bytes) -> list[bytes]:
+        buf = self._buf
+        buf += data
+        frames: list[bytes] = []
+        pos = 0
+        while pos < len(buf):
+            length = self._frame_length(buf, pos)
+            if length is None:
+                break
+            if not length:
+                # Resync on the next possible frame start.
+                nxt = buf.find(b"\xff", pos + 1)
+                pos = nxt if nxt >= 0 else len(buf)
+                continue
+            if len(buf) - pos < length:
+                break
+            frames.append(bytes(buf[pos:pos + length]))
+            pos += length
+        del buf[:pos]
+        return frames
+
+class Mp3Framer(Framer):
+    """Split an MP3 byte stream into whole frames, skipping anything that is not audio."""
+
+    def _frame_length(self, buf, pos):
+        if len(buf) - pos < 4:
+            return None
+        return _mp3_frame_length(buf[pos:pos + 4])
+
+class AdtsFramer(Framer):
+    """Split an ADTS (AAC) byte stream into whole frames."""
+
+    def _frame_length(self, buf, pos):
+        if len(buf) - pos < 7:
+            return None
+        if buf[pos] != 0xFF or (buf[pos + 1] & 0xF6) != 0xF0:
+            return 0
+        length = ((buf[pos + 3] & 0x03) << 11) | (buf[pos + 4] << 3) | (buf[pos + 5] >> 5)
+        return length if length >= 7 else 0
+
+class OggFramer(Framer):
+    """Split an Ogg stream into pages; the leading header pages (granule 0) become `header`."""
+
+    def __init__(self):
+        super().__init__()
+        self._in_header = True
+
+    def _frame_length(self, buf, pos):
+        if len(buf) - pos < 27:
+            return None
+        if buf[pos:pos + 4] != b"OggS":
+            nxt = buf.find(b"OggS", pos + 1)
+            if nxt < 0:
+                # Keep a possible partial capture pattern at the end.
+                del buf[pos:max(pos, len(buf) - 3)]
+                return None
+            del buf[pos:nxt]
+            return self._frame_length(buf, pos)
+        segments = buf[pos + 26]
+        if len(buf) - pos < 27 + segments:
+            return None
+        return 27 + segments + sum(buf[pos + 27:pos + 27 + segments])
+
+    def feed(self, data: bytes) -> list[bytes]:
+        pages = super().feed(data)
+        while self._in_header and pages:
+            granule = int.from_bytes(pages[0][6:14], "little")
+            if granule != 0:
+                self._in_header = False
+                break
+            self.header += pages.pop(0)
+        return pages
+
+_FLAC_BLOCK_SIZE_BYTES = {6: 1, 7: 2}
+_FLAC_SAMPLE_RATE_BYTES = {12: 1, 13: 2, 14: 2}
+
+def _crc8(data) -> int:
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+def _flac_frame_header_ok(buf, pos) -> Optional[bool]:
+    """Validate the FLAC frame header at `pos` (including its CRC-8); None if more data is needed."""
+    if len(buf) - pos < 6:
+        return None
+    if buf[pos] != 0xFF or (buf[pos + 1] & 0xFE) != 0xF8:
+        return False
+    block_code = buf[pos + 2] >> 4
+    rate_code = buf[pos + 2] & 0x0F
+    if block_code == 0 or rate_code == 15 or (buf[pos + 3] & 0x01):
+        return False
+    # UTF-8 style coded frame/sample number.
+    first = buf[pos + 4]
+    extra = 0
+    while extra < 7 and first & (0x80 >> extra):
+        extra += 1
+    if extra == 1 or extra > 7:
+        return False
+    length = 5 + max(0, extra - 1)
+    length += _FLAC_BLOCK_SIZE_BYTES.get(block_code, 0) + _FLAC_SAMPLE_RATE_BYTES.get(rate_code, 0)
+    if len(buf) - pos < length + 1:
+        return None
+    return _crc8(buf[pos:pos + length]) == buf[pos + length]
+
+class FlacFramer(Framer):
+    """Split a native FLAC stream into frames; "fLaC" plus the metadata blocks become `header`.
+
+    FLAC frames carry no length, so a frame ends where the next valid frame header starts.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._in_header = True
+
+    def _frame_length(self, buf, pos):
+        if self._in_header:
+            return self._consume_header(buf, pos)
+        ok = _flac_frame_header_ok(buf, pos)
+        if ok is None:
+            return None
+        if not ok:
+            return 0
+        nxt = buf.find(b"\xff", pos + 2)
+        while nxt >= 0:
+            ok = _flac_frame_header_ok(buf, nxt)
+            if ok is None:
+                return None
+            if ok:
+                return nxt - pos
+            nxt = buf.find(b"\xff", nxt + 1)
+        return None
+
+    def _consume_header(self, buf, pos):
+        if len(buf) - pos < 4:
+            return None
+        if buf[pos:pos + 4] != b"fLaC":
+            # No stream marker: treat the data as frames.
+            self._in_header = False
+            return self._frame_length(buf, pos)
+        end = pos + 4
+        while True:
+            if len(buf) - end < 4:
+                return None
+            last = buf[end] & 0x80
+            end += 4 + int.from_bytes(buf[end + 1:end + 4], "big")
+            if last:
+                break
+        if len(buf) < end:
+            return None
+        self.header = bytes(buf[pos:end])
+        self._in_header = False
+        del buf[pos:end]
+        return self._frame_length(buf, pos) if pos < len(buf) else None
+
+class PcmFramer(Framer):
+    """Cut raw s16le PCM into fixed blocks; `header` is a WAV header for an endless stream."""
+
+    def __init__(self):
+        super().__init__()
+        block_align = CHANNELS * 2
+        self._frame_bytes = MP3_SAMPLES_PER_FRAME * block_align
+        # Sizes are 0xFFFFFFFF: "unknown/streaming", which players accept for live WAV.
+        self.header = (
+            b"RIFF" + (0xFFFFFFFF).to_bytes(4, "little") + b"WAVE"
+            + b"fmt " + (16).to_bytes(4, "little")
+            + (1).to_bytes(2, "little")  # PCM
+            + CHANNELS.to_bytes(2, "little")
+            + SAMPLE_RATE.to_bytes(4, "little")
+            + (SAMPLE_RATE * block_align).to_bytes(4, "little")
+            + block_align.to_bytes(2, "little")
+            + (16).to_bytes(2, "little")
+            + b"data" + (0xFFFFFFFF).to_bytes(4, "little")
+        )
+
+    def _frame_length(self, buf, pos):
+        return self._frame_bytes if len(buf) - pos >= self._frame_bytes else None
+
+FRAMERS = {
+    "mp3": Mp3Framer,
+    "adts": AdtsFramer,
+    "ogg": OggFramer,
+    "flac": FlacFramer,
+    "pcm": PcmFramer,
+}
+
+def _mp3_silent_frame(template: bytes) -> Optional[bytes]:
+    """A Layer III frame that decodes to silence, with the template frame's bitrate and mode.
+
+    All-zero side info means no main data (and no bit reservoir use), so the frame can
+    be repeated anywhere in the stream.
+    """
+    header = bytearray(template[:4])
+    header[1] |= 0x01    # protection bit set: no CRC
+    header[2] &= ~0x02   # no padding
+    length = _mp3_frame_length(header)
+    if not length:
+        return None
+    return bytes(header) + bytes(length - 4)
+
+def build_silent_frame(codec: dict, ring: "FrameRing") -> Optional[bytes]:
+    """A frame clients can be sent over and over while the encoder is suspended.
+
+    None for formats whose frames carry sequence numbers or CRCs over changing state
+    (Ogg pages, FLAC frames): those keep encoding.
+    """
+    framing = codec["framing"]
+    if framing == "pcm":
+        return bytes(codec["frame_samples"] * CHANNELS * 2)
+    newest = ring.newest
+    if newest is None:
+        return None
+    if framing == "mp3":
+        return _mp3_silent_frame(newest)
+    if framing == "adts":
+        # Only called after a long silence, so the newest AAC frame is an encoded silent frame.
+        return newest
+    return None
+
+class FrameRing:
+    """Bounded ring of encoded frames addressed by absolute sequence numbers.
+
+    A single writer appends; any number of readers keep their own cursor, either
+    blocking in read() or awaiting wait_async() from the server's event loop.
+    A reader that falls further behind than the ring holds resumes at the oldest frame.
+    An `archive` (TimeshiftStore) receives every frame too, under the same sequence numbers.
+    """
+
+    def __init__(self, capacity: int, archive: Optional["TimeshiftStore"] = None):
+        self._frames: collections.deque[bytes] = collections.deque(maxlen=capacity)
+        self.archive = archive
+        self._next_seq = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        # One future shared by every async reader waiting for the next append.
+        self._async_waiter: Optional[asyncio.Future] = None
+
+    @property
+    def head(self) -> int:
+        """Sequence number of the next frame to be appended."""
+        return self._next_seq
+
+    @property
+    def newest(self) -> Optional[bytes]:
+        """The most recently appended frame, if any."""
+        frames = self._frames
+        return frames[-1] if frames else None
+
+    @property
+    def oldest(self) -> int:
+        """Sequence number of the oldest frame still held."""
+        return self._next_seq - len(self._frames)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def fill(self) -> float:
+        """Fraction of the ring's capacity currently holding frames."""
+        return len(self._frames) / self._frames.maxlen
+
+    def append(self, frames: list[bytes]) -> None:
+        with self._cond:
+            if self.archive is not None:
+                self.archive.append(frames)
+            self._frames.extend(frames)
+            self._next_seq += len(frames)
+            self._cond.notify_all()
+            self._wake_async()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            self._wake_async()
+
+    def _wake_async(self) -> None:
+        waiter, self._async_waiter = self._async_waiter, None
+        if waiter is not None:
+            # One cross-thread wakeup per append, however many clients are waiting.
+            waiter.get_loop().call_soon_threadsafe(_resolve_future, waiter)
+
+    def take(self, cursor: int, max_frames: int = 64) -> tuple[list[bytes], int]:
+        """Non-blocking read: return (frames, new_cursor), with no frames if nothing new."""
+        with self._cond:
+            first = self._next_seq - len(self._frames)
+            cursor = max(cursor, first)
+            count = min(self._next_seq - cursor, max_frames)
+            if count <= 0:
+                return [], cursor
+            start = cursor - first
+            frames = [self._frames[i] for i in range(start, start + count)]
+            return frames, cursor + count
+
+    def read(self, cursor: int, max_frames: int = 64, timeout: Optional[float] = None) -> tuple[list[bytes], int]:
+        """Blocking read. An empty list means the ring was closed or the wait timed out."""
+        with self._cond:
+            if cursor >= self._next_seq and not self._closed:
+                self._cond.wait_for(lambda: cursor < self._next_seq or self._closed, timeout)
+        return self.take(cursor, max_frames)
+
+    async def wait_async(self, cursor: int) -> None:
+        """Return once a frame at or after `cursor` exists, or the ring is closed."""
+        with self._cond:
+            if cursor < self._next_seq or self._closed:
+                return
+            if self._async_waiter is None:
+                self._async_waiter = asyncio.get_running_loop().create_future()
+            waiter = self._async_waiter
+        # Shielded so one client timing out does not cancel the wait for everyone else.
+        await asyncio.shield(waiter)
+
+class TimeshiftStore:
+    """Fixed-size ring file of encoded frames, memory-mapped, with an in-memory frame index.
+
+    Frames are numbered like the FrameRing that feeds it and laid out back to back; one
+    that does not fit before the end of the file starts again at offset 0, and whatever
+    it overwrites is dropped from the index. Reads return views into the mapping, so a
+    client is served from the page cache without copying, and RAM use does not grow
+    with the buffer length.
+    """
+
+    def __init__(self, capacity_bytes: int, capacity_frames: int, directory: str = ""):
+        self._file = tempfile.TemporaryFile(dir=directory or None, prefix="sonos-streamer-timeshift-")
+        self._file.truncate(capacity_bytes)
+        self._map = mmap.mmap(self._file.fileno(), capacity_bytes)
+        self._view = memoryview(self._map)
+        self._capacity = capacity_bytes
+        self._offsets = np.zeros(capacity_frames, dtype=np.int64)
+        self._lengths = np.zeros(capacity_frames, dtype=np.int32)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget everything (a new encoder session starts numbering at 0 again)."""
+        with self._lock:
+            self._next_seq = 0
+            self._oldest = 0
+            self._write_pos = 0
+            # Client address -> (sequence, monotonic time) where its last connection ended.
+            self.positions: dict[str, tuple[int, float]] = {}
+
+    @property
+    def head(self) -> int:
+        return self._next_seq
+
+    @property
+    def oldest(self) -> int:
+        return self._oldest
+
+    def append(self, frames: list[bytes]) -> None:
+        index_size = len(self._offsets)
+        with self._lock:
+            for frame in frames:
+                size = len(frame)
+                if size > self._capacity:
+                    continue
+                pos = self._write_pos
+                wrapped = pos + size > self._capacity
+                if wrapped:
+                    pos = 0
+                end = pos + size
+                # The oldest frames are the next ones in file order: drop those in the way,
+                # those skipped at the tail when wrapping, and the one whose index slot is reused.
+                while self._oldest < self._next_seq:
+                    slot = self._oldest % index_size
+                    start = self._offsets[slot]
+                    if (self._next_seq - self._oldest >= index_size
+                            or (wrapped and start >= self._write_pos)
+                            or (start < end and start + self._lengths[slot] > pos)):
+                        self._oldest += 1
+                    else:
+                        break
+                self._map[pos:end] = frame
+                slot = self._next_seq % index_size
+                self._offsets[slot] = pos
+                self._lengths[slot] = size
+                self._next_seq += 1
+                self._write_pos = end
+
+    def read(self, cursor: int, max_bytes: int, guard_bytes: int = 0) -> tuple[Optional[memoryview], int, int]:
+        """(view, first, next): frames from `cursor` on, contiguous in the file and up to
+        `max_bytes`, with the sequence of the first one and the cursor after the last.
+
+        A cursor on a frame the writer will overwrite within `guard_bytes` moves past it,
+        so the writer is never about to overwrite what a client is being sent. Within
+        twice that, the frames are copied rather than viewed.
+        """
+        index_size = len(self._offsets)
+        with self._lock:
+            cursor = max(cursor, self._oldest)
+            while cursor < self._next_seq and self._ahead_of_writer(cursor % index_size) < guard_bytes:
+                cursor += 1
+            first = cursor
+            if cursor >= self._next_seq:
+                return None, first, cursor
+            start = int(self._offsets[cursor % index_size])
+            end = start + int(self._lengths[cursor % index_size])
+            cursor += 1
+            while cursor < self._next_seq and end - start < max_bytes:
+                slot = cursor % index_size
+                if self._offsets[slot] != end:
+                    break
+                end += int(self._lengths[slot])
+                cursor += 1
+            if self._ahead_of_writer(first % index_size) < 2 * guard_bytes:
+                return memoryview(self._view[start:end].tobytes()), first, cursor
+            return self._view[start:end], first, cursor
+
+    def _ahead_of_writer(self, slot: int) -> int:
+        """Bytes the writer has left to write before it reaches the frame in `slot`."""
+        return (int(self._offsets[slot]) - self._write_pos) % self._capacity
+
+def codec_bytes_per_second(codec: dict) -> int:
+    """Nominal output rate of `codec`: its bitrate, or the raw PCM rate if it has none."""
+    if codec["bitrate"]:
+        return int(codec["bitrate"].rstrip("k")) * 1000 // 8
+    return SAMPLE_RATE * CHANNELS * 2
+
+def create_timeshift_store(codec: dict, seconds: float, frame_seconds: float) -> TimeshiftStore:
+    """Store sized for `seconds` of `codec`: its bitrate (raw PCM rate if it has none) plus headroom."""
+    capacity_bytes = int(seconds * codec_bytes_per_second(codec) * 1.25) + (1 << 20)
+    # Ogg pages are shorter than the nominal frame, so leave index room for twice as many.
+    capacity_frames = int(2 * seconds / frame_seconds) + 64
+    return TimeshiftStore(capacity_bytes, capacity_frames, TIMESHIFT_DIR)
+
+def parse_timeshift_offset(value: str) -> Optional[float]:
+    """Seconds behind live from an ?offset= value: "-30s", "-30", "-5m", "-1h" (the sign is optional)."""
+    match = re.fullmatch(r"-?(\d+(?:\.\d+)?)([smh]?)", value.strip().lower())
+    if match is None:
+        return None
+    return float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600}[match.group(2)]
+
+def _resolve_future(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+class PcmRing:
+    """Preallocated single-producer/single-consumer ring of PCM frames (int16 unless `dtype` says otherwise).
+
+    The producer (the realtime audio callback) only copies into the array and bumps
+    its index; the consumer (the encoder writer thread) reads contiguous views out of it.
+    Each index is only ever written by one side, so no lock is needed.
+    """
+
+    def __init__(self, capacity_frames: int, channels: int, dtype=np.int16):
+        self._buf = np.zeros((capacity_frames, channels), dtype=dtype)
+        self._capacity = capacity_frames
+        self._channels = channels
+        self._write_idx = 0
+        self._read_idx = 0
+        # Set by the capture side when it stops for good.
+        self.closed = False
+        # Blocks dropped because the encoder side fell behind and the ring was full.
+        self.overflows = 0
+        # Times the encoder side ran dry for longer than PCM_UNDERRUN_SECONDS.
+        self.underruns = 0
+
+    @property
+    def available(self) -> int:
+        return self._write_idx - self._read_idx
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def dtype(self):
+        return self._buf.dtype
+
+    @property
+    def written(self) -> int:
+        """Frames written since the ring was created."""
+        return self._write_idx
+
+    def write(self, block, scale=None) -> bool:
+        """Copy a (frames, channels) block in, times `scale` if given; mono is upmixed and extra channels dropped on the fly."""
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        if block.shape[1] > self._channels:
+            block = block[:, :self._channels]
+        n = block.shape[0]
+        if n > self._capacity - (self._write_idx - self._read_idx):
+            self.overflows += 1
+            return False
+        start = self._write_idx % self._capacity
+        first = min(n, self._capacity - start)
+        self._buf[start:start + first] = block[:first]
+        if first < n:
+            self._buf[:n - first] = block[first:]
+        if scale is not None:
+            # Scaled in place: a mixed-type multiply would allocate a cast buffer.
+            np.multiply(self._buf[start:start + first], scale, out=self._buf[start:start + first])
+            if first < n:
+                np.multiply(self._buf[:n - first], scale, out=self._buf[:n - first])
+        self._write_idx += n
+        return True
+
+    def peek(self, max_frames: int):
+        """Return a contiguous view of up to `max_frames` readable frames, or None if empty."""
+        avail = self._write_idx - self._read_idx
+        if avail <= 0:
+            return None
+        start = self._read_idx % self._capacity
+        n = min(avail, max_frames, self._capacity - start)
+        return self._buf[start:start + n]
+
+    def consume(self, frames: int) -> None:
+        self._read_idx += frames
+
+def _process_cpu_seconds(proc: subprocess.Popen) -> Optional[float]:
+    """User+system CPU time of a running child process, where the OS makes that cheap to read."""
+    try:
+        if IS_WINDOWS:
+            creation, exit_time, kernel, user = (ctypes.c_ulonglong() for _ in range(4))
+            ok = ctypes.windll.kernel32.GetProcessTimes(
+                ctypes.c_void_p(int(proc._handle)),
+                ctypes.byref(creation), ctypes.byref(exit_time), ctypes.byref(kernel), ctypes.byref(user),
+            )
+            # FILETIME units are 100 ns.
+            return (kernel.value + user.value) / 1e7 if ok else None
+        with open(f"/proc/{proc.pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        # utime and stime are fields 14 and 15; the split starts at field 3.
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+# --- Encoders ---
+# An encoder takes s16le PCM through write() and hands its output to `on_output`.
+# `on_close` runs once the output ends, whether it was closed or died on its own.
+# ffmpeg is the general backend; MP3 can also be encoded in-process (LameEncoder).
+# cpu_seconds() reports the encoder's CPU time so far, or None where it can't be read.
+
+class FfmpegEncoder:
+    """Encode through an ffmpeg subprocess; a reader thread forwards its stdout."""
+
+    def __init__(self, codec: dict, profile: dict, on_output, on_close):
+        self._proc = subprocess.Popen(
+            build_encoder_command(codec, profile),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+            creationflags=subprocess.CREATE_NO_WINDOW if hasattr(subprocess, 'CREATE_NO_WINDOW') else 0,
+        )
+        threading.Thread(
+            target=self._pump_output, args=(profile["read_chunk"], on_output, on_close), daemon=True
+        ).start()
+
+    def write(self, data: memoryview) -> None:
+        while data:
+            written = self._proc.stdin.write(data)
+            data = data[written:]
+
+    def cpu_seconds(self) -> Optional[float]:
+        return _process_cpu_seconds(self._proc)
+
+    def close(self) -> None:
+        try:
+            try:
+                self._proc.stdin.close()
+            except Exception:
+                pass
+            self._proc.kill()
+        except Exception:
+            pass
+
+    def _pump_output(self, read_chunk: int, on_output, on_close) -> None:
+        try:
+            while True:
+                try:
+                    chunk = self._proc.stdout.read(read_chunk)
+                except (OSError, ValueError):
+                    break
+                if not chunk:
+                    break
+                on_output(chunk)
+        finally:
+            on_close()
+
+class PcmEncoder:
+    """Pass PCM straight through: no encoder process, no encoding CPU, no encoder delay."""
+
+    def __init__(self, codec: dict, profile: dict, on_output, on_close):
+        self._on_output = on_output
+        self._on_close = on_close
+        self._closed = False
+
+    def write(self, data: memoryview) -> None:
+        if self._closed:
+            raise ValueError("encoder is closed")
+        self._on_output(bytes(data))
+
+    def cpu_seconds(self) -> Optional[float]:
+        return 0.0
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._on_close()
+
+class LameEncoder:
+    """Encode MP3 in-process with LAME: no subprocess spawn, no pipes, no reader thread.
+
+    Output is produced on the writer thread and goes straight into the frame ring.
+    """
+
+    # LAME's default algorithm quality, the same one the ffmpeg path gets.
+    QUALITY = 3
+
+    def __init__(self, codec: dict, profile: dict, on_output, on_close):
+        self._enc = lameenc.Encoder()
+        self._enc.set_bit_rate(int(codec["bitrate"].rstrip("k")))
+        self._enc.set_in_sample_rate(SAMPLE_RATE)
+        self._enc.set_channels(CHANNELS)
+        self._enc.set_quality(self.QUALITY)
+        self._enc.silence()
+        self._on_output = on_output
+        self._on_close = on_close
+        self._closed = False
+        self._cpu_seconds = 0.0
+
+    def write(self, data: memoryview) -> None:
+        if self._closed:
+            raise ValueError("encoder is closed")
+        started = time.thread_time()
+        # lameenc only accepts bytes, so this is the one copy left between capture and frames.
+        out = self._enc.encode(bytes(data))
+        self._cpu_seconds += time.thread_time() - started
+        if out:
+            self._on_output(out)
+
+    def cpu_seconds(self) -> Optional[float]:
+        return self._cpu_seconds
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._on_close()
+
+def use_lame_encoder(codec: dict) -> bool:
+    backend = (ENCODER_BACKEND or "auto").lower().strip()
+    return codec["encoder"] == "libmp3lame" and backend in ("auto", "lame") and lameenc is not None
+
+def create_encoder(codec: dict, profile: dict, on_output, on_close):
+    if codec["encoder"] is None:
+        return PcmEncoder(codec, profile, on_output, on_close)
+    if use_lame_encoder(codec):
+        return LameEncoder(codec, profile, on_output, on_close)
+    return FfmpegEncoder(codec, profile, on_output, on_close)
+
+# --- Capture ---
+
+class PcmConverter:
+    """Convert float32 [-1, 1] capture blocks to int16 without allocating per block.
+
+    All arithmetic runs in place (`out=`) on preallocated buffers; mono is upmixed by
+    broadcasting into the stereo buffer and extra channels are dropped through a view.
+    Without dither, samples are truncated like the old astype() path; with `dither`,
+    TPDF noise (difference of two uniform variables, +/-1 LSB) is added before rounding.
+    """
+
+    def __init__(self, max_frames: int, channels: int, dither: bool = False):
+        self._channels = channels
+        self._dither = dither
+        self._rng = np.random.default_rng()
+        self._allocate(max_frames)
+
+    def _allocate(self, frames: int) -> None:
+        self._scratch = np.empty((frames, self._channels), dtype=np.float32)
+        self._out = np.empty((frames, self._channels), dtype=np.int16)
+        if self._dither:
+            self._noise_a = np.empty((frames, self._channels), dtype=np.float32)
+            self._noise_b = np.empty((frames, self._channels), dtype=np.float32)
+
+    def convert(self, data):
+        """Return an int16 view of the converted block; valid until the next call."""
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+        if data.shape[1] > self._channels:
+            data = data[:, :self._channels]
+        n = data.shape[0]
+        if n > self._scratch.shape[0]:
+            self._allocate(n)
+        scratch = self._scratch[:n]
+        if data.shape[1] == 1 and self._channels > 1:
+            # Mono source: scale into the first column, then copy it across.
+            np.multiply(data, 32767.0, out=scratch[:, :1])
+            np.copyto(scratch[:, 1:], scratch[:, :1])
+        else:
+            np.multiply(data, 32767.0, out=scratch)
+        if self._dither:
+            a = self._noise_a[:n]
+            b = self._noise_b[:n]
+            self._rng.random(dtype=np.float32, out=a)
+            self._rng.random(dtype=np.float32, out=b)
+            np.add(scratch, a, out=scratch)
+            np.subtract(scratch, b, out=scratch)
+            np.rint(scratch, out=scratch)
+        np.clip(scratch, -32768.0, 32767.0, out=scratch)
+        out = self._out[:n]
+        np.copyto(out, scratch, casting="unsafe")
+        return out
+
+class AdaptiveResampler:
+    """Band-limited resampler for ratios close to 1, with the ratio settable per block.
+
+    Each output sample is a 16-tap windowed-sinc interpolation at its fractional input
+    position, using a table of 512 sub-sample phases. State (input tail and position)
+    carries across blocks, so the output is continuous whatever the ratio does.
+    """
+
+    TAPS = 16
+    PHASES = 512
+
+    def __init__(self, channels: int, cutoff: float = 0.95):
+        self._channels = channels
+        half = self.TAPS // 2
+        # Tap k of phase p weights input sample floor(pos) - half + 1 + k for pos = floor(pos) + p / PHASES.
+        offsets = np.arange(self.TAPS) - (half - 1) - np.arange(self.PHASES)[:, None] / self.PHASES
+        # Kaiser window evaluated at each tap's true distance, so every phase is centred.
+        window = np.i0(8.0 * np.sqrt(np.clip(1.0 - (offsets / half) ** 2, 0.0, None))) / np.i0(8.0)
+        table = cutoff * np.sinc(cutoff * offsets) * window
+        self._table = (table / table.sum(axis=1, keepdims=True)).astype(np.float32)
+        self._offsets = np.arange(self.TAPS) - (half - 1)
+        # Input not yet fully used, starting `half - 1` samples before the next output position.
+        self._buf = np.zeros((half - 1, channels), dtype=np.float32)
+        self._pos = float(half - 1)
+        self._out = np.empty((0, channels), dtype=np.int16)
+
+    def process(self, block, ratio: float):
+        """Resample an int16 block; `ratio` is output rate / input rate. Returns an int16 view."""
+        half = self.TAPS // 2
+        buf = np.concatenate((self._buf, block.astype(np.float32)))
+        step = 1.0 / ratio
+        # Output positions p need input up to floor(p) + half, so p < len(buf) - half.
+        count = max(0, int(np.ceil((len(buf) - half - self._pos) / step)))
+        positions = self._pos + step * np.arange(count)
+        base = np.floor(positions).astype(np.int64)
+        phase = np.minimum(((positions - base) * self.PHASES).round().astype(np.int64), self.PHASES - 1)
+        index = base[:, None] + self._offsets[None, :]
+        weights = self._table[phase]
+        mixed = np.empty((count, self._channels), dtype=np.float32)
+        for ch in range(self._channels):
+            # Per channel: (count x TAPS) gather, then a row-wise dot with the phase weights.
+            mixed[:, ch] = np.einsum("ot,ot->o", buf[:, ch][index], weights)
+        next_pos = self._pos + step * count
+        keep_from = int(np.floor(next_pos)) - (half - 1)
+        self._buf = buf[keep_from:]
+        self._pos = next_pos - keep_from
+        if self._out.shape[0] < count:
+            self._out = np.empty((count, self._channels), dtype=np.int16)
+        out = self._out[:count]
+        np.clip(np.rint(mixed, out=mixed), -32768.0, 32767.0, out=mixed)
+        np.copyto(out, mixed, casting="unsafe")
+        return out
+
+class DriftCorrector:
+    """Keeps a capture running at exactly SAMPLE_RATE by the host clock.
+
+    The capture is treated as filling a virtual buffer that the host clock drains at
+    SAMPLE_RATE: fill = samples delivered - elapsed * SAMPLE_RATE. The slope of the fill,
+    from an exponentially weighted least-squares fit over about TIME_CONSTANT seconds,
+    is the device's drift; the resampler runs at the inverse ratio, plus a gentle pull
+    that brings the output's own fill back to where it was when correction engaged.
+    A jump in the fill (device stall or restart) restarts the estimate.
+    """
+
+    TIME_CONSTANT = 60.0      # seconds of history in the drift estimate
+    WARMUP_SECONDS = 10.0     # pass through at ratio 1 until the estimate has settled
+    PULL_SECONDS = 60.0       # time to work off an accumulated output offset
+    MAX_PPM = 1000.0
+    RESET_SECONDS = 0.5
+
+    def __init__(self, channels: int):
+        self._resampler = AdaptiveResampler(channels)
+        self.ppm = 0.0
+        self.ratio = 1.0
+        self._restart = False
+        self._reset()
+
+    def restart(self) -> None:
+        """Start over at ratio 1 with the next block (a new device brings a new clock); safe from any thread."""
+        self._restart = True
+
+    def _reset(self) -> None:
+        self._t0: Optional[float] = None
+        self._samples_in = 0
+        self._samples_out = 0
+        self._sums = np.zeros(5)  # weight, t, y, t*t, t*y
+        self._last_t = 0.0
+        self._out_fill: Optional[float] = None
+        self._target: Optional[float] = None
+
+    def process(self, block, now: Optional[float] = None):
+        """Resample `block`; `now` is when its last frame arrived (default: the call time)."""
+        if now is None:
+            now = time.monotonic()
+        if self._restart:
+            self._restart = False
+            self.ppm = 0.0
+            self.ratio = 1.0
+            self._reset()
+        if self._t0 is None:
+            self._t0 = now
+        t = now - self._t0
+        self._samples_in += block.shape[0]
+        fill = self._samples_in - t * SAMPLE_RATE
+        self._estimate(t, fill)
+        out = self._resampler.process(block, self.ratio)
+        self._samples_out += out.shape[0]
+        self._control(t)
+        return out
+
+    def _estimate(self, t: float, fill: float) -> None:
+        w, st, sy, stt, sty = self._sums
+        if w > 0:
+            slope, intercept = self._fit()
+            if abs(fill - (intercept + slope * t)) > self.RESET_SECONDS * SAMPLE_RATE:
+                self._reset()
+                return
+        decay = np.exp(-(t - self._last_t) / self.TIME_CONSTANT)
+        self._last_t = t
+        self._sums = self._sums * decay + np.array([1.0, t, fill, t * t, t * fill])
+
+    def _fit(self) -> tuple[float, float]:
+        w, st, sy, stt, sty = self._sums
+        det = w * stt - st * st
+        if det <= 1e-9:
+            return 0.0, sy / w
+        slope = (w * sty - st * sy) / det
+        return slope, (sy - slope * st) / w
+
+    def _control(self, t: float) -> None:
+        out_fill = self._samples_out - t * SAMPLE_RATE
+        # Smooth over a few seconds: single blocks jitter by the scheduling delay.
+        alpha = 0.01
+        self._out_fill = out_fill if self._out_fill is None else self._out_fill + alpha * (out_fill - self._out_fill)
+        if t < self.WARMUP_SECONDS:
+            return
+        if self._target is None:
+            self._target = self._out_fill
+        slope, _ = self._fit()
+        ppm = 1e6 * slope / SAMPLE_RATE
+        self.ppm = max(-self.MAX_PPM, min(self.MAX_PPM, ppm))
+        pull = (self._out_fill - self._target) / (SAMPLE_RATE * self.PULL_SECONDS)
+        correction = max(-self.MAX_PPM * 1e-6, min(self.MAX_PPM * 1e-6, self.ppm * 1e-6 + pull))
+        self.ratio = 1.0 / (1.0 + correction)
+
+# --- Block DSP ---
+# Level processing on the shared capture, once for every stream: channel map, gain,
+# loudness normalization and a look-ahead limiter. Each stage works in place on a whole
+# float32 block (-1..1, CHANNELS wide) with numpy, keeping its state and scratch buffers
+# between blocks. DSP_STAGES lists stage factories in processing order; a factory returns
+# None when its stage is switched off, so an unused stage costs nothing.
+
+# Output channels as rows of input weights; a list of input indices also works, e.g. [1, 0].
+CHANNEL_MAPS = {
+    "swap": [[0.0, 1.0], [1.0, 0.0]],
+    "mono": [[0.5, 0.5], [0.5, 0.5]],
+    "left": [[1.0, 0.0], [1.0, 0.0]],
+    "right": [[0.0, 1.0], [0.0, 1.0]],
+}
+
+class ChannelMap:
+    """Remap or mix down channels with one matrix product per block."""
+
+    def __init__(self, matrix, channels: int):
+        self._matrix_t = np.ascontiguousarray(np.asarray(matrix, dtype=np.float32).T)
+        self._out = np.empty((0, channels), dtype=np.float32)
+
+    def process(self, block) -> None:
+        n = block.shape[0]
+        if n > self._out.shape[0]:
+            self._out = np.empty((n, block.shape[1]), dtype=np.float32)
+        out = self._out[:n]
+        np.matmul(block, self._matrix_t, out=out)
+        np.copyto(block, out)
+
+class Gain:
+    def __init__(self, db: float):
+        self._factor = np.float32(10 ** (db / 20.0))
+
+    def process(self, block) -> None:
+        np.multiply(block, self._factor, out=block)
+
+# NumPy 2 added out= to the FFTs; older versions allocate the spectrum per block.
+_FFT_OUT = int(np.__version__.split(".")[0]) >= 2
+
+def _biquad_power(b, a, w) -> np.ndarray:
+    """|H|^2 of a biquad at angular frequencies `w` (radians per sample)."""
+    z = np.exp(-1j * w)
+    return np.abs(np.polyval(b[::-1], z) / np.polyval(a[::-1], z)) ** 2
+
+def k_weighting_power(n: int, sample_rate: int) -> np.ndarray:
+    """Per-bin weights turning |rfft(block)|^2 into the block's K-weighted mean square (ITU-R BS.1770).
+
+    The K filter (high shelf + high pass) is evaluated in the frequency domain, which
+    for block-sized windows gives the same loudness without running the IIR sample by sample.
+    """
+    w = 2 * np.pi * np.fft.rfftfreq(n)
+    k = np.tan(np.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = _biquad_power(
+        np.array([vh + vb * k / q + k * k, 2 * (k * k - vh), vh - vb * k / q + k * k]) / a0,
+        np.array([1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]), w)
+    k = np.tan(np.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = _biquad_power(np.array([1.0, -2.0, 1.0]), np.array([1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]), w)
+    # Parseval: bins other than DC and Nyquist stand for two conjugate bins.
+    weights = shelf * high_pass * 2.0 / (n * n)
+    weights[0] /= 2
+    if n % 2 == 0:
+        weights[-1] /= 2
+    return weights
+
+class LoudnessNormalizer:
+    """Steer the short-term loudness (EBU R128 style, K-weighted) towards a target.
+
+    Block loudness is averaged over about 3 s; blocks under the -70 LUFS absolute gate
+    are left out, so silence and fades don't pump the gain up. The gain moves at most
+    SLEW_DB_PER_SECOND, ramped sample by sample across each block.
+    """
+
+    WINDOW_SECONDS = 3.0
+    GATE_LUFS = -70.0
+    MAX_BOOST_DB = 12.0
+    MAX_CUT_DB = 20.0
+    SLEW_DB_PER_SECOND = 6.0
+
+    def __init__(self, target_lufs: float):
+        self.target_lufs = target_lufs
+        self.gain_db = 0.0
+        self.loudness = None  # short-term loudness in LUFS, once measured
+        self._energy = 0.0
+        # Block size -> (K weights per bin, gain ramp); sizes vary by a frame with drift correction.
+        self._shapes: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        self._allocate(0, 1)
+
+    def _allocate(self, n: int, channels: int) -> None:
+        bins = n // 2 + 1
+        self._spectrum = np.empty((bins, channels), dtype=np.complex64)
+        self._power = np.empty((bins, channels), dtype=np.float32)
+        self._bin_power = np.empty(bins, dtype=np.float32)
+        self._gains = np.empty(n, dtype=np.float32)
+
+    def process(self, block) -> None:
+        n = block.shape[0]
+        shape = self._shapes.get(n)
+        if shape is None:
+            weights = k_weighting_power(n, SAMPLE_RATE).astype(np.float32)
+            shape = self._shapes[n] = (weights, np.arange(1, n + 1, dtype=np.float32) / n)
+        weights, ramp = shape
+        if n > self._gains.shape[0] or block.shape[1] != self._power.shape[1]:
+            self._allocate(n, block.shape[1])
+        bins = n // 2 + 1
+        if _FFT_OUT:
+            spectrum = np.fft.rfft(block, axis=0, out=self._spectrum[:bins])
+        else:
+            spectrum = np.fft.rfft(block, axis=0)
+        power = self._power[:bins]
+        np.abs(spectrum, out=power)
+        np.square(power, out=power)
+        bin_power = self._bin_power[:bins]
+        np.sum(power, axis=1, out=bin_power)
+        energy = float(np.dot(weights, bin_power))
+        if energy > 0 and 10 * np.log10(energy) - 0.691 > self.GATE_LUFS:
+            alpha = min(1.0, n / (self.WINDOW_SECONDS * SAMPLE_RATE))
+            self._energy = energy if self.loudness is None else self._energy + alpha * (energy - self._energy)
+            self.loudness = 10 * np.log10(self._energy) - 0.691
+        previous = self.gain_db
+        if self.loudness is not None:
+            wanted = max(-self.MAX_CUT_DB, min(self.MAX_BOOST_DB, self.target_lufs - self.loudness))
+            step = self.SLEW_DB_PER_SECOND * n / SAMPLE_RATE
+            self.gain_db = max(previous - step, min(previous + step, wanted))
+        start, end = 10 ** (previous / 20.0), 10 ** (self.gain_db / 20.0)
+        gains = self._gains[:n]
+        np.multiply(ramp, end - start, out=gains)
+        gains += start
+        np.multiply(block, gains[:, None], out=block)
+
+def _window_minimum(values: np.ndarray, width: int, out: np.ndarray, scratch: np.ndarray) -> None:
+    """Minimum of every `width`-long window of `values` into `out`, in O(n) (van Herk/Gil-Werman).
+
+    Cut into width-long chunks, a window spans the end of one chunk and the start of the
+    next: the min of a suffix minimum and a prefix minimum. `scratch` is (3, m) with m at
+    least len(values) rounded up to a multiple of `width`.
+    """
+    n = len(values)
+    size = -(-n // width) * width
+    padded, prefix, suffix = scratch[0, :size], scratch[1, :size], scratch[2, :size]
+    padded[:n] = values
+    padded[n:] = np.inf
+    chunks = padded.reshape(-1, width)
+    np.minimum.accumulate(chunks, axis=1, out=prefix.reshape(-1, width))
+    np.minimum.accumulate(chunks[:, ::-1], axis=1, out=suffix.reshape(-1, width)[:, ::-1])
+    np.minimum(suffix[:n - width + 1], prefix[width - 1:n], out=out)
+
+class SoftLimiter:
+    """Look-ahead peak limiter: no sample leaves above the ceiling, and no hard clipping.
+
+    The signal is delayed by LOOKAHEAD_SECONDS. Per sample, the gain needed to keep the
+    peak under the ceiling is taken as a minimum over the look-ahead window and then
+    box-averaged over it, so the gain glides down before a peak and is fully reduced at
+    the peak. It comes back up at RELEASE_DB_PER_SECOND. All of that runs as windowed
+    reductions and prefix minima over the block (in dB), with no per-sample Python loop.
+    """
+
+    LOOKAHEAD_SECONDS = 0.005
+    RELEASE_DB_PER_SECOND = 40.0
+
+    def __init__(self, ceiling_db: float, channels: int):
+        self._ceiling = 10 ** (ceiling_db / 20.0)
+        self._ceiling_db = ceiling_db
+        self._lookahead = max(1, int(self.LOOKAHEAD_SECONDS * SAMPLE_RATE))
+        self._release_step = self.RELEASE_DB_PER_SECOND / SAMPLE_RATE
+        L = self._lookahead
+        # History carried across blocks: needed gains, their window minima, the delayed signal.
+        self._needed = np.zeros(L, dtype=np.float64)
+        self._minima = np.zeros(L, dtype=np.float64)
+        self._delay = np.zeros((L, channels), dtype=np.float32)
+        self._gain_db = 0.0
+        self.reduction_db = 0.0  # deepest gain reduction in the last block
+        self._allocate(0, channels)
+
+    def _allocate(self, n: int, channels: int) -> None:
+        L = self._lookahead
+        self._peak = np.empty(n, dtype=np.float32)
+        self._column = np.empty(n, dtype=np.float32)
+        self._needed_all = np.empty(n + L, dtype=np.float64)
+        self._minima_all = np.empty(n + L, dtype=np.float64)
+        self._window_scratch = np.empty((3, n + 2 * L + 1), dtype=np.float64)
+        self._sums = np.empty(n + L, dtype=np.float64)
+        self._smooth = np.empty(n, dtype=np.float64)
+        self._limit = np.empty(n, dtype=np.float64)
+        self._gain = np.empty(n, dtype=np.float32)
+        self._signal = np.empty((n + L, channels), dtype=np.float32)
+        self._steps = np.arange(n, dtype=np.float64) * self._release_step
+
+    def process(self, block) -> None:
+        n = block.shape[0]
+        L = self._lookahead
+        if n > self._peak.shape[0]:
+            self._allocate(n, block.shape[1])
+        peak = self._peak[:n]
+        # Per-sample peak across channels (column by column: much faster than max(axis=1)).
+        np.abs(block[:, 0], out=peak)
+        column = self._column[:n]
+        for channel in range(1, block.shape[1]):
+            np.abs(block[:, channel], out=column)
+            np.maximum(peak, column, out=peak)
+        signal = self._signal[:n + L]
+        signal[:L] = self._delay
+        signal[L:] = block
+        self._delay[:] = signal[n:]
+        if self._gain_db == 0.0 and peak.max() <= self._ceiling and not self._minima.any():
+            # Nothing to limit, none pending: just the delay.
+            self._needed[:] = 0.0
+            self.reduction_db = 0.0
+            np.copyto(block, signal[:n])
+            return
+        needed = self._needed_all[:n + L]
+        needed[:L] = self._needed
+        # Gain (dB, <= 0) that brings each sample's peak down to the ceiling.
+        np.maximum(peak, 1e-9, out=needed[L:], casting="unsafe")
+        np.log10(needed[L:], out=needed[L:])
+        np.multiply(needed[L:], -20.0, out=needed[L:])
+        needed[L:] += self._ceiling_db
+        np.minimum(needed[L:], 0.0, out=needed[L:])
+        self._needed[:] = needed[n:]
+        # Minimum over each look-ahead window, then its average over the same length.
+        minima = self._minima_all[:n + L]
+        minima[:L] = self._minima
+        _window_minimum(needed, L + 1, minima[L:], self._window_scratch)
+        self._minima[:] = minima[n:]
+        sums = np.cumsum(minima, out=self._sums[:n + L])
+        smooth = self._smooth[:n]
+        smooth[0] = sums[L]
+        smooth[1:] = sums[L + 1:] - sums[:n - 1]
+        smooth /= L + 1
+        # Release: the gain may rise by at most one step per sample (a prefix minimum).
+        steps = self._steps[:n]
+        smooth -= steps
+        np.minimum.accumulate(smooth, out=smooth)
+        smooth += steps
+        limit = self._limit[:n]
+        np.add(steps, self._gain_db + self._release_step, out=limit)
+        np.minimum(smooth, limit, out=smooth)
+        self._gain_db = float(smooth[-1])
+        self.reduction_db = float(smooth.min())
+        # Apply the gain (dB to linear) to the delayed signal.
+        np.divide(smooth, 20.0, out=limit)
+        np.power(10.0, limit, out=limit)
+        gain = self._gain[:n]
+        np.copyto(gain, limit, casting="same_kind")
+        np.multiply(signal[:n], gain[:, None], out=block)
+        # Rounding safety only; the gain already keeps peaks at the ceiling.
+        np.clip(block, -self._ceiling, self._ceiling, out=block)
+
+def _channel_map_stage(channels: int):
+    spec = CHANNEL_MAP
+    if not spec:
+        return None
+    if isinstance(spec, str):
+        matrix = CHANNEL_MAPS.get(spec.lower().strip())
+        if matrix is None:
+            print(f"Ignoring channel_map '{spec}': use {', '.join(CHANNEL_MAPS)} or a list of input channels.")
+            return None
+    else:
+        matrix = [[1.0 if i == int(source) else 0.0 for i in range(channels)] for source in spec]
+    if np.shape(matrix) != (channels, channels):
+        print(f"Ignoring channel_map {spec}: it must describe {channels} channels.")
+        return None
+    return ChannelMap(matrix, channels)
+
+# Stage factories, in processing order: (channels) -> stage with process(block), or None.
+DSP_STAGES = {
+    "channel_map": _channel_map_stage,
+    "gain": lambda channels: Gain(GAIN_DB) if GAIN_DB else None,
+    "loudness": lambda channels: LoudnessNormalizer(LOUDNESS_TARGET_LUFS) if LOUDNESS_TARGET_LUFS is not None else None,
+    "limiter": lambda channels: SoftLimiter(LIMITER_CEILING_DB, channels) if LIMITER else None,
+}
+
+class DspChain:
+    """The configured DSP stages plus conversion to int16 (PcmConverter, with DITHER).
+
+    Float capture always runs through it, so the limiter (when on) replaces the hard clip.
+    int16 capture only does when a level-changing stage is on (`active`); otherwise it
+    passes through untouched, bit for bit.
+    """
+
+    def __init__(self, channels: int):
+        self._channels = channels
+        self.stages = {name: stage for name, factory in DSP_STAGES.items()
+                       if (stage := factory(channels)) is not None}
+        self.active = any(name != "limiter" for name in self.stages)
+        self._converter = PcmConverter(1024, channels, dither=DITHER)
+        self._float = np.empty((0, channels), dtype=np.float32)
+
+    def process(self, block):
+        """int16 view of the processed block; valid until the next call."""
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        n = block.shape[0]
+        if n > self._float.shape[0]:
+            self._float = np.empty((n, self._channels), dtype=np.float32)
+        data = self._float[:n]
+        # Up to CHANNELS wide (mono copied across, extra channels dropped), in -1..1.
+        source = block[:, :self._channels]
+        scale = 1.0 / 32768.0 if block.dtype == np.int16 else 1.0
+        np.multiply(source, np.float32(scale), out=data if source.shape[1] == self._channels else data[:, :1])
+        if source.shape[1] < self._channels:
+            np.copyto(data[:, 1:], data[:, :1])
+        for stage in self.stages.values():
+            stage.process(data)
+        return self._converter.convert(data)
+
+# Capture sources feed int16 (or float32 -1..1) blocks of CHANNELS x SAMPLE_RATE into a
+# CaptureHub (hub._deliver) and set `failed` when they stop on their own; the hub's supervisor
+# then reopens them (see CaptureHub._supervise). Device-backed ones
+# are picked by audio mode; SOURCE_TYPES adds modes that need no device.
+
+class CaptureSource:
+    # Sample type of the delivered blocks.
+    dtype = np.int16
+
+    def __init__(self, hub: "CaptureHub", profile: dict):
+        self._hub = hub
+        self._profile = profile
+        self._stop_event = threading.Event()
+        # Why the source stopped by itself (device lost, default output changed), else None.
+        self.failed: Optional[str] = None
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _lost(self, reason: str) -> None:
+        if not self._stop_event.is_set():
+            self.failed = reason
+
+    def _run(self) -> None:
+        raise NotImplementedError
+
+class SoundDeviceSource(CaptureSource):
+    """PortAudio input: VB-Audio Cable, BlackHole, line-in or the default input."""
+
+    def start(self) -> None:
+        device_index, extra_settings, _, _, stream_channels = get_audio_source(self._hub.audio_mode, self._hub.device)
+        self._stream = _sounddevice().InputStream(
+            samplerate=SAMPLE_RATE,
+            blocksize=self._profile["blocksize"],
+            latency=self._profile["device_latency"],
+            device=device_index,
+            channels=stream_channels,
+            dtype="int16",
+            callback=self._audio_callback,
+            finished_callback=self._finished,
+            extra_settings=extra_settings,
+        )
+        self._stream.start()
+
+    def stop(self) -> None:
+        super().stop()
+        try:
+            self._stream.close()
+        except Exception:
+            pass
+
+    def _finished(self) -> None:
+        # PortAudio ended the stream: device unplugged or driver reset.
+        self._lost("input stream stopped")
+
+    def _audio_callback(self, indata, frames, time, status):
+        # Runs on the PortAudio realtime thread: copy into the preallocated rings, nothing else.
+        if status.input_overflow:
+            self._hub.input_overflows += 1
+        self._hub._deliver(indata)
+
+class SoundcardLoopbackSource(CaptureSource):
+    """Loopback capture of an output: WASAPI loopback on Windows, the output's monitor
+    source on PulseAudio/PipeWire. Default speaker unless the source names one, in which
+    case a change of default output (headphones plugged in) reopens the capture."""
+
+    DEFAULT_CHECK_SECONDS = 2.0
+    dtype = np.float32
+
+    def _run(self) -> None:
+        blocksize = self._profile["blocksize"]
+        com_initialized = False
+        try:
+            if IS_WINDOWS:
+                # soundcard uses Windows Core Audio (COM). Threads must initialize COM.
+                # COINIT_APARTMENTTHREADED = 2
+                hr = ctypes.windll.ole32.CoInitializeEx(None, 2)
+                # S_OK (0) or S_FALSE (1) are success; RPC_E_CHANGED_MODE can be ignored.
+                if hr in (0, 1):
+                    com_initialized = True
+            sc = _soundcard()
+            if sc is None:
+                raise RuntimeError("soundcard package is not available")
+            _, device = self._hub.source_settings
+            speaker_name = device or sc.default_speaker().name
+            mic = sc.get_microphone(speaker_name, include_loopback=True)
+            # soundcard records float32 in [-1, 1]; the hub's DspChain limits and converts it.
+            next_check = time.monotonic() + self.DEFAULT_CHECK_SECONDS
+            with mic.recorder(samplerate=SAMPLE_RATE, blocksize=blocksize) as rec:
+                while not self._stop_event.is_set():
+                    data = rec.record(numframes=blocksize)
+                    # Stopped while blocked in record(): the hub has moved on (silence or a
+                    # new source), so this block must not become a second producer.
+                    if data is not None and not self._stop_event.is_set():
+                        self._hub._deliver(data)
+                    # Checked here because soundcard's COM objects belong to this thread.
+                    if not device and time.monotonic() >= next_check:
+                        next_check = time.monotonic() + self.DEFAULT_CHECK_SECONDS
+                        if sc.default_speaker().name != speaker_name:
+                            self._lost("default output changed")
+                            break
+        except Exception as e:
+            self._lost(f"loopback capture error: {e}")
+        finally:
+            if IS_WINDOWS and com_initialized:
+                try:
+                    ctypes.windll.ole32.CoUninitialize()
+                except Exception:
+                    pass
+
+class SyntheticSource(CaptureSource):
+    """Generated audio paced like a real device, for testing without hardware.
+
+    The device string picks the signal: "sine" or "sine:FREQ" (default), "noise",
+    "silence", or "wav:PATH" to loop a 16-bit WAV file at SAMPLE_RATE.
+    """
+
+    def __init__(self, hub: "CaptureHub", profile: dict):
+        super().__init__(hub, profile)
+        _, device = hub.source_settings
+        kind, _, arg = device.partition(":")
+        self._kind = kind.strip().lower() or "sine"
+        self._arg = arg.strip()
+        self._loop: Optional[np.ndarray] = None
+        if self._kind == "wav":
+            self._loop = self._load_wav(self._arg)
+        elif self._kind not in ("sine", "noise", "silence"):
+            raise RuntimeError(f"Unknown synthetic signal '{device}' (sine[:HZ], noise, silence, wav:PATH).")
+        self._rng = np.random.default_rng()
+        # Sample index of the next block; the whole signal is a function of it.
+        self.position = 0
+        # Monotonic time at which sample 0 was "captured".
+        self.started_at = 0.0
+
+    @staticmethod
+    def _load_wav(path: str) -> np.ndarray:
+        import wave
+
+        with wave.open(path, "rb") as f:
+            if f.getsampwidth() != 2 or f.getframerate() != SAMPLE_RATE:
+                raise RuntimeError(f"{path}: need 16-bit PCM at {SAMPLE_RATE} Hz.")
+            channels = f.getnchannels()
+            data = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16).reshape(-1, channels)
+        if channels < CHANNELS:
+            data = np.repeat(data[:, :1], CHANNELS, axis=1)
+        if data.shape[0] == 0:
+            raise RuntimeError(f"{path}: no audio.")
+        return np.ascontiguousarray(data[:, :CHANNELS])
+
+    def generate(self, out: np.ndarray) -> None:
+        """Fill `out` (frames x CHANNELS, int16) with the signal starting at self.position."""
+        n = out.shape[0]
+        if self._kind == "sine":
+            freq = float(self._arg or 440.0)
+            t = (self.position + np.arange(n)) / SAMPLE_RATE
+            out[:] = (0.3 * 32767.0 * np.sin(2.0 * np.pi * freq * t))[:, None]
+        elif self._kind == "noise":
+            out[:] = self._rng.integers(-3000, 3000, size=out.shape, dtype=np.int16)
+        elif self._kind == "wav":
+            idx = (self.position + np.arange(n)) % self._loop.shape[0]
+            out[:] = self._loop[idx]
+        else:
+            out.fill(0)
+
+    def _run(self) -> None:
+        blocksize = self._profile["blocksize"]
+        block = np.zeros((blocksize, CHANNELS), dtype=np.int16)
+        self.started_at = time.monotonic()
+        i = 0
+        while not self._stop_event.is_set():
+            # A block becomes available once it has been "recorded".
+            delay = self.started_at + (i + 1) * blocksize / SAMPLE_RATE - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.generate(block)
+            self.position += blocksize
+            if self._stop_event.is_set():
+                break
+            self._hub._deliver(block)
+            i += 1
+
+# Audio modes served by a CaptureSource class rather than a capture device.
+SOURCE_TYPES = {
+    "synthetic": SyntheticSource,
+}
+
+def create_capture_source(hub: "CaptureHub", profile: dict) -> CaptureSource:
+    audio_mode, _ = hub.source_settings
+    if audio_mode in SOURCE_TYPES:
+        return SOURCE_TYPES[audio_mode](hub, profile)
+    if uses_soundcard_capture(audio_mode):
+        return SoundcardLoopbackSource(hub, profile)
+    return SoundDeviceSource(hub, profile)
+
+# Capture supervision: how often the source is checked, how long without a block counts
+# as a stall, and the reopen backoff (doubling from MIN to MAX, back to MIN once the
+# source has stayed up for RESET).
+CAPTURE_CHECK_SECONDS = 0.5
+CAPTURE_STALL_SECONDS = 2.0
+CAPTURE_RETRY_MIN_SECONDS = 0.5
+CAPTURE_RETRY_MAX_SECONDS = 10.0
+CAPTURE_RETRY_RESET_SECONDS = 30.0
+# Longest a stopping capture waits for its worker to hand over the block in hand.
+CAPTURE_WORKER_JOIN_SECONDS = 1.0
+
+_INT16_SCALE = np.float32(1.0 / 32768.0)
+
+class CaptureHub:
+    """Owns the capture device and fans captured PCM out to every attached encoder ring.
+
+    Capture starts when the first ring attaches and stops when the last one detaches.
+    audio_mode/device left as None follow the AUDIO_MODE/AUDIO_DEVICE settings.
+    """
+
+    def __init__(self, name: str = "default", audio_mode: Optional[str] = None, device: Optional[str] = None):
+        self.name = name
+        self.audio_mode = audio_mode
+        self.device = device
+        self._lock = threading.Lock()
+        # Replaced, never mutated, so the realtime callback can iterate it without a lock.
+        self._rings: tuple[PcmRing, ...] = ()
+        self._source: Optional[CaptureSource] = None
+        # Overflows reported by the capture device itself.
+        self.input_overflows = 0
+        # Timing hook for /metrics: time spent handing blocks to the encoder rings.
+        self.deliver_seconds = 0.0
+        self.deliver_blocks = 0
+        # Silence detection: monotonic time of the last block with a peak above the threshold.
+        self.last_sound_at = time.monotonic()
+        self._silence_peak = 0
+        # Clock drift correction (DRIFT_CORRECTION); created per session, run by the capture worker.
+        self.drift: Optional[DriftCorrector] = None
+        # Level processing and float -> int16 conversion; built per session from the settings.
+        self.dsp: Optional[DspChain] = None
+        # Float capture, level processing and drift correction go through this ring
+        # (float -1..1, or int16 when only drift correction is on) to the capture worker,
+        # so neither the DSP nor the resampler runs on the realtime callback. None: the
+        # session's int16 blocks go straight to the encoder rings.
+        self._raw: Optional[PcmRing] = None
+        # (raw.written, monotonic time) after the latest block; dates blocks for the drift estimate.
+        self._raw_clock = (0, 0.0)
+        self._worker_stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        # Supervisor state: False while the source is down and silence is sent instead.
+        self.up = False
+        self.restarts = 0
+        self._supervisor_stop = threading.Event()
+
+    def attach(self, pcm_ring: PcmRing) -> None:
+        with self._lock:
+            self._rings = self._rings + (pcm_ring,)
+            if len(self._rings) == 1:
+                try:
+                    self._start()
+                except Exception:
+                    self._rings = ()
+                    raise
+
+    def detach(self, pcm_ring: PcmRing) -> None:
+        with self._lock:
+            self._rings = tuple(r for r in self._rings if r is not pcm_ring)
+            if not self._rings:
+                self._stop()
+
+    def _deliver(self, block) -> None:
+        started = time.perf_counter()
+        raw = self._raw
+        if raw is not None:
+            raw.write(block, _INT16_SCALE if block.dtype == np.int16 and raw.dtype != np.int16 else None)
+            self._raw_clock = (raw.written, time.monotonic())
+        else:
+            self._fan_out(block)
+        self.deliver_seconds += time.perf_counter() - started
+        self.deliver_blocks += 1
+
+    def _process(self, raw: PcmRing, stop_event: threading.Event, profile: dict,
+                 dsp: DspChain, drift: Optional[DriftCorrector]) -> None:
+        """Capture worker: run the session's DSP chain and drift correction on what the callback queued."""
+        max_frames = profile["pcm_write_frames"]
+        poll = profile["writer_poll"]
+        read = 0
+        while not stop_event.is_set():
+            view = raw.peek(max_frames)
+            if view is None:
+                time.sleep(poll)
+                continue
+            read += view.shape[0]
+            # When the last frame of the view arrived: the latest block's time, less
+            # whatever the callback has queued behind it since.
+            written, stamp = self._raw_clock
+            arrived = stamp - max(0, written - read) / SAMPLE_RATE
+            block = view
+            if view.dtype != np.int16 or dsp.active:
+                block = dsp.process(view)
+            self._fan_out(block, drift, arrived)
+            raw.consume(view.shape[0])
+
+    def _fan_out(self, block, drift: Optional[DriftCorrector] = None, arrived: Optional[float] = None) -> None:
+        """Hand an int16 block to every encoder ring, through `drift` if given (`arrived` dates the block)."""
+        # Peak of the int16 block; two reductions, no temporaries. Noted before the
+        # block reaches the rings, so an encoder writer never sees loud PCM while
+        # the capture still counts as silent.
+        if block.max() > self._silence_peak or block.min() < -self._silence_peak:
+            self.last_sound_at = time.monotonic()
+        if drift is not None:
+            block = drift.process(block, arrived)
+        for pcm_ring in self._rings:
+            pcm_ring.write(block)
+
+    @property
+    def source_settings(self) -> tuple[str, str]:
+        """(audio_mode, device) this capture uses, after falling back to the global settings."""
+        audio_mode = AUDIO_MODE if self.audio_mode is None else self.audio_mode
+        device = AUDIO_DEVICE if self.device is None else self.device
+        return (audio_mode or "").lower().strip(), device or ""
+
+    def _uses_portaudio(self) -> bool:
+        audio_mode = self.source_settings[0]
+        return audio_mode not in SOURCE_TYPES and not uses_soundcard_capture(audio_mode)
+
+    def silent_for(self) -> float:
+        """Seconds since the capture last carried sound."""
+        return time.monotonic() - self.last_sound_at
+
+    def _start(self) -> None:
+        # Raises (and so fails the request) if the configured source cannot be used.
+        get_audio_source(self.audio_mode, self.device)
+        self._silence_peak = int(32767 * 10 ** (SILENCE_THRESHOLD_DB / 20.0))
+        self.last_sound_at = time.monotonic()
+        self.drift = DriftCorrector(CHANNELS) if DRIFT_CORRECTION else None
+        self.dsp = DspChain(CHANNELS)
+        profile = get_latency_profile()
+        source = create_capture_source(self, profile)
+        self._raw = None
+        self._raw_clock = (0, 0.0)
+        self._worker_stop = threading.Event()
+        self._worker = None
+        if self.dsp.active or source.dtype != np.int16 or self.drift is not None:
+            dtype = np.float32 if self.dsp.active or source.dtype != np.int16 else np.int16
+            self._raw = PcmRing(int(PCM_RING_SECONDS * SAMPLE_RATE), CHANNELS, dtype=dtype)
+        # The worker only once the source is running: a source that fails to open leaves nothing behind.
+        source.start()
+        if self._raw is not None:
+            # Everything per session goes in as arguments: after a quick detach and re-attach the
+            # hub's attributes already belong to the next session.
+            self._worker = threading.Thread(
+                target=self._process, args=(self._raw, self._worker_stop, profile, self.dsp, self.drift), daemon=True
+            )
+            self._worker.start()
+        self._source = source
+        self.up = True
+        self._supervisor_stop = threading.Event()
+        threading.Thread(target=self._supervise, args=(self._supervisor_stop, profile), daemon=True).start()
+
+    def _stop(self) -> None:
+        self._supervisor_stop.set()
+        self._worker_stop.set()
+        # Its last block must reach the rings before the next session's worker can write to them.
+        if self._worker is not None:
+            self._worker.join(CAPTURE_WORKER_JOIN_SECONDS)
+            self._worker = None
+        self.up = False
+        source, self._source = self._source, None
+        if source is not None:
+            source.stop()
+
+    def _open_source(self, profile: dict) -> "CaptureSource":
+        source = create_capture_source(self, profile)
+        source.start()
+        return source
+
+    def _supervise(self, stop_event: threading.Event, profile: dict) -> None:
+        """Watch the source; when it fails or stalls, keep the encoders fed and reopen it."""
+        retry_delay = CAPTURE_RETRY_MIN_SECONDS
+        last_blocks = self.deliver_blocks
+        last_progress = healthy_since = time.monotonic()
+        while not stop_event.wait(CAPTURE_CHECK_SECONDS):
+            now = time.monotonic()
+            if self.deliver_blocks != last_blocks:
+                last_blocks, last_progress = self.deliver_blocks, now
+            source = self._source
+            reason = source.failed if source is not None else "no source"
+            if reason is None and now - last_progress > CAPTURE_STALL_SECONDS:
+                reason = f"no audio for {now - last_progress:.1f} s"
+            if reason is None:
+                if now - healthy_since > CAPTURE_RETRY_RESET_SECONDS:
+                    retry_delay = CAPTURE_RETRY_MIN_SECONDS
+                continue
+            retry_delay = self._recover(source, reason, stop_event, profile, retry_delay)
+            last_blocks = self.deliver_blocks
+            last_progress = healthy_since = time.monotonic()
+
+    def _recover(self, source, reason: str, stop_event: threading.Event, profile: dict, retry_delay: float) -> float:
+        """Send silence at the capture's pace and retry the source with backoff; return the next delay."""
+        print(f"Capture '{self.name}' lost ({reason}); sending silence while reconnecting")
+        self.up = False
+        if source is not None:
+            source.stop()
+        blocksize = profile["blocksize"]
+        silence = np.zeros((blocksize, CHANNELS), dtype=np.int16)
+        started = time.monotonic()
+        sent = 0
+        next_try = started + retry_delay
+        while not stop_event.is_set():
+            delay = started + (sent + 1) * blocksize / SAMPLE_RATE - time.monotonic()
+            if delay > 0 and stop_event.wait(delay):
+                break
+            self._deliver(silence)
+            sent += 1
+            if time.monotonic() < next_try:
+                continue
+            retry_delay = min(retry_delay * 2, CAPTURE_RETRY_MAX_SECONDS)
+            with self._lock:
+                if stop_event.is_set():
+                    break
+                # The device may have come back under a new index or name.
+                _audio_source_cache.pop((self.audio_mode, self.device), None)
+                if self._uses_portaudio() and not any(
+                    capture._uses_portaudio() and capture._source is not None
+                    for capture in CAPTURES.values() if capture is not self
+                ):
+                    try:
+                        restart_portaudio()
+                    except Exception as e:
+                        print(f"Capture '{self.name}': could not restart PortAudio: {e}")
+                try:
+                    self._source = self._open_source(profile)
+                except Exception:
+                    next_try = time.monotonic() + retry_delay
+                    continue
+                self.up = True
+                self.restarts += 1
+                # A new device brings a new clock.
+                if self.drift is not None:
+                    self.drift.restart()
+            print(f"Capture '{self.name}' restored")
+            break
+        return retry_delay
+
+class BroadcastHub:
+    """One codec endpoint: encoder + frame ring, started by the first client and stopped after the last."""
+
+    def __init__(self, codec_name: str, capture: CaptureHub, bitrate_kbps: Optional[int] = None):
+        self.codec_name = codec_name
+        # A ladder rung is the same codec at another bitrate.
+        self.codec = CODECS[codec_name] if bitrate_kbps is None else {**CODECS[codec_name], "bitrate": f"{bitrate_kbps}k"}
+        self.source = capture.name
+        # Metric labels for everything this hub serves.
+        self.labels = {"stream": codec_name, "source": capture.name}
+        if self.codec["bitrate"]:
+            self.labels["bitrate"] = self.codec["bitrate"]
+        self._capture = capture
+        # Re-entrant: an encoder may report that it closed while _stop() is closing it.
+        self._lock = threading.RLock()
+        self._clients = 0
+        self._ring: Optional[FrameRing] = None
+        self._framer: Optional[Framer] = None
+        self._encoder = None
+        self._pcm_ring: Optional[PcmRing] = None
+        self._stop_event = threading.Event()
+        self._linger_timer: Optional[threading.Timer] = None
+        # Counters of finished sessions, so /metrics totals survive encoder restarts.
+        self._totals = {"pcm_overflows": 0, "pcm_underruns": 0, "encoder_cpu_seconds": 0.0}
+        # Timing hook for /metrics: time spent in encoder.write() on the writer thread.
+        self.encode_seconds = 0.0
+        self.encode_calls = 0
+        # Idle suspend (see IDLE_SUSPEND_SECONDS): encoder not fed, clients get silent frames.
+        self.suspended = False
+        self.suspended_seconds = 0.0
+        # Created on first start when TIMESHIFT_SECONDS is set; emptied for every new session.
+        self.timeshift: Optional[TimeshiftStore] = None
+        # Audio per ring entry; set again on every start, as Ogg pages follow the latency profile.
+        self._frame_seconds = codec_frame_seconds(self.codec, get_latency_profile())
+
+    @property
+    def header(self) -> bytes:
+        """Stream header a client must receive before its first frame (empty for MP3/AAC)."""
+        framer = self._framer
+        return framer.header if framer is not None else b""
+
+    @property
+    def clients(self) -> int:
+        return self._clients
+
+    @property
+    def ring(self) -> Optional[FrameRing]:
+        return self._ring
+
+    @property
+    def frame_seconds(self) -> float:
+        return self._frame_seconds
+
+    @property
+    def bitrate_kbps(self) -> Optional[int]:
+        bitrate = self.codec["bitrate"]
+        return int(bitrate.rstrip("k")) if bitrate else None
+
+    @property
+    def title(self) -> str:
+        """Station title players show for this stream."""
+        return STATION_NAME if self.source == DEFAULT_SOURCE else f"{STATION_NAME} - {self.source}"
+
+    def counters(self) -> dict:
+        """Cumulative counters and current fill levels for /metrics."""
+        totals = dict(self._totals)
+        pcm_ring, encoder, ring = self._pcm_ring, self._encoder, self._ring
+        if pcm_ring is not None and encoder is not None:
+            totals["pcm_overflows"] += pcm_ring.overflows
+            totals["pcm_underruns"] += pcm_ring.underruns
+            totals["encoder_cpu_seconds"] += encoder.cpu_seconds() or 0.0
+        live = pcm_ring is not None and encoder is not None
+        totals["pcm_ring_fill"] = pcm_ring.available / pcm_ring.capacity if live else 0.0
+        totals["frame_ring_fill"] = ring.fill if ring is not None else 0.0
+        return totals
+
+    def subscribe(self, backlog_seconds: float = 0.0) -> tuple[FrameRing, int]:
+        """Register a client and return the ring plus its starting cursor.
+
+        The cursor sits up to `backlog_seconds` behind live (as far back as the ring goes),
+        always on a frame boundary.
+        """
+        with self._lock:
+            self._cancel_linger()
+            if self._ring is None:
+                self._start()
+            self._clients += 1
+            ring = self._ring
+            backlog_frames = int(backlog_seconds / self.frame_seconds)
+            return ring, max(ring.oldest, ring.head - backlog_frames)
+
+    def unsubscribe(self) -> None:
+        with self._lock:
+            self._clients = max(0, self._clients - 1)
+            if self._clients == 0:
+                # With timeshift, keep the session (and so the buffer) long enough to resume into.
+                linger = max(HUB_LINGER_SECONDS, TIMESHIFT_RESUME_SECONDS if self.timeshift is not None else 0)
+                if linger > 0 and self._ring is not None:
+                    self._linger_timer = threading.Timer(linger, self._linger_expired)
+                    self._linger_timer.daemon = True
+                    self._linger_timer.start()
+                else:
+                    self._stop()
+
+    def shutdown(self) -> None:
+        """Stop capture and encoder now, whoever is still listening (process exit)."""
+        with self._lock:
+            self._clients = 0
+            if self._ring is not None:
+                self._stop()
+
+    def _cancel_linger(self) -> None:
+        if self._linger_timer is not None:
+            self._linger_timer.cancel()
+            self._linger_timer = None
+
+    def _linger_expired(self) -> None:
+        with self._lock:
+            self._linger_timer = None
+            if self._clients == 0:
+                self._stop()
+
+    def stats(self) -> dict:
+        """Capture/encoder counters for the current (or last) session."""
+        pcm_ring = self._pcm_ring
+        if pcm_ring is None:
+            return {}
+        return {
+            "pcm_buffered_frames": pcm_ring.available,
+            "pcm_overflows": pcm_ring.overflows,
+            "pcm_underruns": pcm_ring.underruns,
+            "input_overflows": self._capture.input_overflows,
+        }
+
+    def _start(self) -> None:
+        profile = get_latency_profile()
+        codec = self.codec
+        stop_event = threading.Event()
+        framer = FRAMERS[codec["framing"]]()
+        frame_seconds = codec_frame_seconds(codec, profile)
+        if TIMESHIFT_SECONDS > 0:
+            # Shorter entries than the store was sized for need a bigger index.
+            if self.timeshift is None or frame_seconds < self._frame_seconds:
+                self.timeshift = create_timeshift_store(codec, TIMESHIFT_SECONDS, frame_seconds)
+            else:
+                self.timeshift.reset()
+        self._frame_seconds = frame_seconds
+        ring = FrameRing(int(FRAME_RING_SECONDS / frame_seconds) + 1, self.timeshift)
+        pcm_ring = PcmRing(int(PCM_RING_SECONDS * SAMPLE_RATE), CHANNELS)
+
+        def on_output(chunk: bytes) -> None:
+            frames = framer.feed(chunk)
+            # While suspended the writer supplies silent frames; the encoder's last
+            # in-flight frames are silence too and would only add delay.
+            if frames and not self.suspended:
+                ring.append(frames)
+
+        def on_close() -> None:
+            # Encoder went away (stopped, or capture failed): end every client on this ring.
+            with self._lock:
+                if self._ring is ring:
+                    self._stop()
+            ring.close()
+
+        encoder = create_encoder(codec, profile, on_output, on_close)
+        try:
+            self._capture.attach(pcm_ring)
+        except Exception:
+            stop_event.set()
+            encoder.close()
+            raise
+
+        self._encoder = encoder
+        self._framer = framer
+        self._stop_event = stop_event
+        self._ring = ring
+        self._pcm_ring = pcm_ring
+        self.suspended = False
+        threading.Thread(
+            target=self._pump_pcm_to_encoder, args=(pcm_ring, encoder, ring, stop_event, profile), daemon=True
+        ).start()
+
+    def _stop(self) -> None:
+        self._cancel_linger()
+        ring, encoder, pcm_ring = self._ring, self._encoder, self._pcm_ring
+        if encoder is not None:
+            self._totals["pcm_overflows"] += pcm_ring.overflows
+            self._totals["pcm_underruns"] += pcm_ring.underruns
+            self._totals["encoder_cpu_seconds"] += encoder.cpu_seconds() or 0.0
+        self._ring = None
+        self._encoder = None
+        self._stop_event.set()
+        if pcm_ring is not None:
+            self._capture.detach(pcm_ring)
+        if encoder is not None:
+            encoder.close()
+        if ring is not None:
+            ring.close()
+        stats = self.stats()
+        if stats.get("pcm_overflows") or stats.get("pcm_underruns") or stats.get("input_overflows"):
+            print(
+                "Capture stats ({source}/{codec}): overflows={pcm_overflows}, underruns={pcm_underruns}, "
+                "device overflows={input_overflows}".format(source=self.source, codec=self.codec_name, **stats)
+            )
+
+    def _pump_pcm_to_encoder(
+        self, pcm_ring: PcmRing, encoder, ring: FrameRing, stop_event: threading.Event, profile: dict
+    ) -> None:
+        # Drains captured PCM into the encoder so a stalled encoder never blocks the capture side.
+        dry_since: Optional[float] = None
+        counted = False
+        started = False
+        write_frames = profile["pcm_write_frames"]
+        poll = profile["writer_poll"]
+        frame_samples = round(self.frame_seconds * SAMPLE_RATE)
+        silent_frame: Optional[bytes] = None
+        # PCM frames consumed while suspended that no silent frame covers yet.
+        owed = 0
+        try:
+            while not stop_event.is_set():
+                view = pcm_ring.peek(write_frames)
+                if view is None:
+                    if pcm_ring.closed:
+                        break
+                    if started:
+                        now = time.monotonic()
+                        if dry_since is None:
+                            dry_since = now
+                        elif not counted and now - dry_since > PCM_UNDERRUN_SECONDS:
+                            pcm_ring.underruns += 1
+                            counted = True
+                    time.sleep(poll)
+                    continue
+                started = True
+                dry_since = None
+                counted = False
+                n = view.shape[0]
+                if IDLE_SUSPEND_SECONDS > 0 and self._capture.silent_for() >= IDLE_SUSPEND_SECONDS:
+                    if silent_frame is None:
+                        silent_frame = build_silent_frame(self.codec, ring)
+                    if silent_frame is not None:
+                        # Idle: leave the encoder blocked on its input and keep clients
+                        # fed with silent frames at the capture's own pace.
+                        self.suspended = True
+                        owed += n
+                        count = owed // frame_samples
+                        if count:
+                            ring.append([silent_frame] * count)
+                            owed -= count * frame_samples
+                        self.suspended_seconds += n / SAMPLE_RATE
+                        pcm_ring.consume(n)
+                        continue
+                elif self.suspended:
+                    self.suspended = False
+                    silent_frame = None
+                    owed = 0
+                write_started = time.perf_counter()
+                encoder.write(memoryview(view).cast("B"))
+                self.encode_seconds += time.perf_counter() - write_started
+                self.encode_calls += 1
+                pcm_ring.consume(n)
+        except (BrokenPipeError, OSError, ValueError):
+            # Encoder went away.
+            pass
+        finally:
+            encoder.close()
+
+# --- HLS ---
+# Packed-audio HLS (RFC 8216) over the shared MP3/AAC frame rings: a segmenter cuts the
+# ring into in-memory segments, each a single bytes object served as-is to every client,
+# with a rolling playlist rebuilt once per segment. Nothing is encoded per client, and
+# segments carry Cache-Control so a proxy or CDN in front of the public URL can share them.
+# The segmenter subscribes to its hub on the first request and lets go once nobody has
+# asked for HLS_IDLE_SECONDS.
+
+HLS_CODECS = {"mp3": "mp3", "aac": "aac"}  # codec -> segment file extension
+HLS_SEGMENT_SECONDS = 2.0
+HLS_PLAYLIST_SEGMENTS = 6
+HLS_KEPT_SEGMENTS = 10  # a few more than listed, for players that fetch a little late
+HLS_IDLE_SECONDS = 30.0
+_HLS_PTS_WRAP = 1 << 33  # MPEG-TS 90 kHz timestamps are 33 bits
+
+def _syncsafe(value: int) -> bytes:
+    return bytes((value >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+def hls_timestamp_tag(pts: int) -> bytes:
+    """ID3 tag with the segment's start time, which packed-audio segments must begin with."""
+    payload = b"com.apple.streaming.transportStreamTimestamp\x00" + (pts % _HLS_PTS_WRAP).to_bytes(8, "big")
+    frame = b"PRIV" + _syncsafe(len(payload)) + b"\x00\x00" + payload
+    return b"ID3\x04\x00\x00" + _syncsafe(len(frame)) + frame
+
+class HlsSegmenter:
+    """Rolling HLS playlist and segments for one MP3/AAC hub."""
+
+    def __init__(self, hub: BroadcastHub, path: str):
+        self.hub = hub
+        # Playlist URL; segments live next to it as <base>-<sequence>.<ext>.
+        self.path = path
+        self.extension = HLS_CODECS[hub.codec_name]
+        self._segment_prefix = path.rsplit("/", 1)[-1][:-len(".m3u8")] + "-"
+        self._segments: collections.deque[tuple[int, float, bytes]] = collections.deque(maxlen=HLS_KEPT_SEGMENTS)
+        self._playlist = b""
+        self._task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._last_request = 0.0
+
+    async def playlist(self) -> Optional[bytes]:
+        """Current playlist, starting the segmenter if needed; None if no segment could be cut."""
+        self._last_request = time.monotonic()
+        if self._task is None or self._task.done():
+            self._ready = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if not self._ready.is_set():
+            ready = asyncio.ensure_future(self._ready.wait())
+            await asyncio.wait({ready, self._task}, timeout=HLS_SEGMENT_SECONDS * 3,
+                               return_when=asyncio.FIRST_COMPLETED)
+            ready.cancel()
+        return self._playlist if self._ready.is_set() else None
+
+    def segment(self, sequence: int) -> Optional[bytes]:
+        self._last_request = time.monotonic()
+        for seq, _, data in self._segments:
+            if seq == sequence:
+                return data
+        return None
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        hub = self.hub
+        try:
+            # Start with as much backlog as the playlist lists, so a warm hub serves a full playlist at once.
+            ring, cursor = await loop.run_in_executor(
+                None, hub.subscribe, HLS_SEGMENT_SECONDS * HLS_PLAYLIST_SEGMENTS)
+        except Exception as e:
+            print("Audio capture error:", e)
+            return
+        frame_seconds = hub.frame_seconds
+        frames_per_segment = max(1, round(HLS_SEGMENT_SECONDS / frame_seconds))
+        # Numbered from the wall clock, so a restarted segmenter never reuses a URL a cache still holds.
+        sequence = int(time.time() / HLS_SEGMENT_SECONDS)
+        origin = cursor
+        pending: list[bytes] = []
+        segment_start = cursor
+        try:
+            while time.monotonic() - self._last_request < HLS_IDLE_SECONDS:
+                frames, new_cursor = ring.take(cursor, frames_per_segment - len(pending))
+                if not frames:
+                    if ring.closed:
+                        break
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(ring.wait_async(cursor), HLS_SEGMENT_SECONDS)
+                    continue
+                if new_cursor - len(frames) != cursor:
+                    # Fell out of the ring: drop the partial segment and restart at the new position.
+                    pending = []
+                    segment_start = new_cursor - len(frames)
+                pending += frames
+                cursor = new_cursor
+                if len(pending) < frames_per_segment:
+                    continue
+                pts = round((segment_start - origin) * frame_seconds * 90000)
+                data = b"".join([hls_timestamp_tag(pts), hub.header, *pending])
+                self._segments.append((sequence, len(pending) * frame_seconds, data))
+                self._playlist = self._build_playlist()
+                self._ready.set()
+                METRICS.inc("hls_segments_total", **hub.labels)
+                sequence += 1
+                pending = []
+                segment_start = cursor
+        finally:
+            self._ready.clear()
+            self._segments.clear()
+            self._playlist = b""
+            await loop.run_in_executor(None, hub.unsubscribe)
+
+    def _build_playlist(self) -> bytes:
+        listed = list(self._segments)[-HLS_PLAYLIST_SEGMENTS:]
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{math.ceil(max(duration for _, duration, _ in listed))}",
+            f"#EXT-X-MEDIA-SEQUENCE:{listed[0][0]}",
+        ]
+        for seq, duration, _ in listed:
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(f"{self._segment_prefix}{seq}.{self.extension}")
+        return ("\n".join(lines) + "\n").encode("ascii")
+
+DEFAULT_SOURCE = "default"
+# Source name -> its capture, URL path -> hub, and playlist path -> HLS segmenter.
+# Filled by configure_sources().
+CAPTURES: dict[str, CaptureHub] = {}
+HUBS: dict[str, BroadcastHub] = {}
+HLS: dict[str, HlsSegmenter] = {}
+
+def stream_path(source: str, codec_name: str) -> str:
+    """URL of a codec on a source: /stream.aac on the default source, /stream/<source>.aac on others."""
+    path = CODECS[codec_name]["path"]
+    if source == DEFAULT_SOURCE:
+        return path
+    return f"/stream/{source}{path[len('/stream'):]}"
+
+def ladder_rungs(codec_name: str) -> tuple[int, ...]:
+    """QUALITY_LADDER bitrates this codec gets an extra hub for (its own bitrate is the plain URL)."""
+    codec = CODECS[codec_name]
+    if not codec["bitrate"]:
+        return ()
+    rungs = [kbps for kbps in QUALITY_LADDER if f"{kbps}k" != codec["bitrate"]]
+    if codec["framing"] == "mp3":
+        # MPEG-1 Layer III only has these rates.
+        rungs = [kbps for kbps in rungs if kbps in _MP3_BITRATES_V1_L3[1:-1]]
+    return tuple(rungs)
+
+def find_hub(path: str, quality: Optional[str] = None) -> Optional[BroadcastHub]:
+    """Hub for a stream URL; `quality` is the ?q= ladder rung in kbps ("64" or "64k")."""
+    hub = HUBS.get(path)
+    if hub is None or not quality:
+        return hub
+    kbps = quality.strip().lower().rstrip("k")
+    if hub.bitrate_kbps is not None and kbps == str(hub.bitrate_kbps):
+        return hub
+    return HUBS.get(f"{path}?q={kbps}")
+
+def configure_sources(sources: dict[str, dict]) -> None:
+    """One capture per source (the default one plus SOURCES), each with a hub per codec and ladder rung.
+
+    Call before serving; it replaces the existing captures and hubs.
+    """
+    CAPTURES.clear()
+    HUBS.clear()
+    HLS.clear()
+    CAPTURES[DEFAULT_SOURCE] = CaptureHub(DEFAULT_SOURCE)
+    for name, spec in sources.items():
+        CAPTURES[name] = CaptureHub(name, spec.get("audio_mode"), spec.get("device"))
+    for source, capture in CAPTURES.items():
+        for codec_name in CODECS:
+            path = stream_path(source, codec_name)
+            HUBS[path] = BroadcastHub(codec_name, capture)
+            if codec_name in HLS_CODECS:
+                HLS[path + ".m3u8"] = HlsSegmenter(HUBS[path], path + ".m3u8")
+            for kbps in ladder_rungs(codec_name):
+                HUBS[f"{path}?q={kbps}"] = BroadcastHub(codec_name, capture, kbps)
+
+configure_sources({})
+
+# --- Metrics ---
+# Prometheus text exposition on /metrics. Counters that live on the realtime path
+# (capture, encoder writer) are plain attributes on their owners and are read at
+# scrape time; only the HTTP side records into METRICS directly.
+
+METRICS_PREFIX = "sonos_streamer_"
+METRIC_HELP = {
+    "bytes_sent_total": "Bytes sent to stream clients.",
+    "send_seconds_total": "Time spent writing to client sockets.",
+    "send_syscalls_total": "Send calls on stream client sockets (one sendmsg carries a whole batch of frames).",
+    "time_to_first_byte_seconds": "Time from request to the first audio byte sent.",
+    "slow_client_actions_total": "Slow-client actions: skip to live, disconnect, send timeout, ring overrun.",
+    "skipped_frames_total": "Frames slow clients never received because they were skipped forward.",
+    "hls_segments_total": "HLS segments cut from the frame rings.",
+    "hls_requests_total": "HLS playlist and segment requests.",
+}
+TTFB_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class ClientStats:
+    """Live numbers for one connected stream client."""
+
+    def __init__(self, address: str, labels: dict):
+        self.address = address
+        # The hub's labels: stream, source and bitrate.
+        self.labels = labels
+        self.bytes_sent = 0
+        self.lag_seconds = 0.0
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+class Metrics:
+    """Process-wide counters, histograms and the connected-client table."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._histograms: dict[tuple[str, tuple], Histogram] = {}
+        self._clients: dict[int, ClientStats] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...], **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+    def add_client(self, client: ClientStats) -> None:
+        with self._lock:
+            self._clients[id(client)] = client
+
+    def remove_client(self, client: ClientStats) -> None:
+        with self._lock:
+            self._clients.pop(id(client), None)
+
+    def render(self) -> str:
+        """Render everything, including values read live from the capture and hubs."""
+        lines: list[str] = []
+
+        def family(name: str, kind: str, help_text: str, samples) -> None:
+            full = METRICS_PREFIX + name
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, value in samples:
+                lines.append(f"{full}{_format_labels(labels)} {value}")
+
+        hubs = list(HUBS.values())
+        captures = list(CAPTURES.values())
+        counters = [(hub.labels, hub.counters()) for hub in hubs]
+        with self._lock:
+            clients = list(self._clients.values())
+            counter_items = sorted(self._counters.items())
+            histogram_items = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [
+                (key, list(hist.buckets), list(hist.counts), hist.total, hist.count)
+                for key, hist in histogram_items
+            ]
+
+        family("clients", "gauge", "Connected stream clients.",
+               [(hub.labels, hub.clients) for hub in hubs])
+        family("client_bytes_sent", "gauge", "Bytes sent to each connected client.",
+               [({"client": c.address, **c.labels}, c.bytes_sent) for c in clients])
+        family("client_lag_seconds", "gauge", "How far each connected client is behind live.",
+               [({"client": c.address, **c.labels}, round(c.lag_seconds, 4))
+                for c in clients])
+        family("encoder_cpu_seconds_total", "counter", "Encoder CPU time.",
+               [(labels, round(c["encoder_cpu_seconds"], 4)) for labels, c in counters])
+        family("capture_overflows_total", "counter", "Input overflows reported by the capture device.",
+               [({"source": cap.name}, cap.input_overflows) for cap in captures])
+        family("capture_up", "gauge", "1 while the capture source delivers audio, 0 while silence stands in.",
+               [({"source": cap.name}, int(cap.up)) for cap in captures])
+        family("capture_restarts_total", "counter", "Times the capture source was reopened after a loss.",
+               [({"source": cap.name}, cap.restarts) for cap in captures])
+        family("sample_rate_hz", "gauge", "Stream sample rate.", [({}, SAMPLE_RATE)])
+        dsps = [(cap.name, cap.dsp.stages) for cap in captures if cap.dsp is not None]
+        family("loudness_lufs", "gauge", "Short-term loudness measured by the normalizer.",
+               [({"source": name}, round(stages["loudness"].loudness, 2)) for name, stages in dsps
+                if "loudness" in stages and stages["loudness"].loudness is not None])
+        family("loudness_gain_db", "gauge", "Gain the loudness normalizer currently applies.",
+               [({"source": name}, round(stages["loudness"].gain_db, 2)) for name, stages in dsps if "loudness" in stages])
+        family("limiter_gain_reduction_db", "gauge", "Deepest limiter gain reduction in the last block.",
+               [({"source": name}, round(abs(stages["limiter"].reduction_db), 2)) for name, stages in dsps if "limiter" in stages])
+        drifts = [(cap.name, cap.drift) for cap in captures if cap.drift is not None]
+        family("capture_clock_drift_ppm", "gauge", "Estimated capture clock drift against the host clock.",
+               [({"source": name}, round(drift.ppm, 2)) for name, drift in drifts])
+        family("capture_resample_ratio", "gauge", "Current drift-correction resampling ratio (output/input).",
+               [({"source": name}, round(drift.ratio, 8)) for name, drift in drifts])
+        family("pcm_overflows_total", "counter", "PCM blocks dropped because an encoder fell behind.",
+               [(labels, c["pcm_overflows"]) for labels, c in counters])
+        family("pcm_underruns_total", "counter", "Times an encoder ran out of captured PCM.",
+               [(labels, c["pcm_underruns"]) for labels, c in counters])
+        family("pcm_ring_fill_ratio", "gauge", "Fill level of the PCM ring between capture and encoder.",
+               [(labels, round(c["pcm_ring_fill"], 4)) for labels, c in counters])
+        family("frame_ring_fill_ratio", "gauge", "Fill level of the encoded frame ring.",
+               [(labels, round(c["frame_ring_fill"], 4)) for labels, c in counters])
+        family("timeshift_seconds", "gauge", "Audio held in the timeshift file.",
+               [(hub.labels, round((hub.timeshift.head - hub.timeshift.oldest) * hub.frame_seconds, 3))
+                for hub in hubs if hub.timeshift is not None])
+        family("encoder_suspended", "gauge", "1 while the encoder is idle-suspended on silence.",
+               [(hub.labels, int(hub.suspended)) for hub in hubs])
+        family("encoder_suspended_seconds_total", "counter", "Audio time served as prebuilt silent frames.",
+               [(hub.labels, round(hub.suspended_seconds, 3)) for hub in hubs])
+        family("stage_seconds_total", "counter", "Time spent per pipeline stage.",
+               [({"stage": "capture", "source": cap.name}, round(cap.deliver_seconds, 6)) for cap in captures]
+               + [({"stage": "encode", **hub.labels}, round(hub.encode_seconds, 6)) for hub in hubs])
+        family("stage_calls_total", "counter", "Calls per pipeline stage.",
+               [({"stage": "capture", "source": cap.name}, cap.deliver_blocks) for cap in captures]
+               + [({"stage": "encode", **hub.labels}, hub.encode_calls) for hub in hubs])
+        family("startup_phase_seconds", "gauge", "Wall time of each startup phase.",
+               [({"phase": name}, round(seconds, 6)) for name, seconds in STARTUP.phases])
+
+        by_name: dict[str, list] = {}
+        for (name, labels), value in counter_items:
+            by_name.setdefault(name, []).append((dict(labels), value))
+        for name, samples in by_name.items():
+            family(name, "counter", METRIC_HELP.get(name, name), samples)
+
+        seen: set[str] = set()
+        for (name, labels), buckets, counts, total, count in histograms:
+            full = METRICS_PREFIX + name
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {full} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {full} histogram")
+            labels = dict(labels)
+            for bound, bucket_count in zip(buckets, counts):
+                lines.append(f"{full}_bucket{_format_labels({**labels, 'le': bound})} {bucket_count}")
+            lines.append(f"{full}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{full}_sum{_format_labels(labels)} {round(total, 6)}")
+            lines.append(f"{full}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+# --- HTTP server ---
+# One asyncio event loop serves every client over non-blocking sockets, so the
+# thread count stays fixed however many listeners connect. A stream client holds
+# nothing but its ring cursor plus whatever its kernel send buffer accepts.
+
+REQUEST_TIMEOUT = 10.0       # seconds allowed to receive the request head
+MAX_REQUEST_BYTES = 16384
+SEND_TIMEOUT = 10.0          # a client that accepts nothing for this long is dropped
+ICY_METAINT = 16000          # audio bytes between ICY metadata blocks
+# Segment URLs: <playlist base>-<sequence>.<ext>, e.g. /stream.aac-812345.aac next to /stream.aac.m3u8.
+HLS_SEGMENT_PATH = re.compile(r"^(.+)-(\d+)\.(mp3|aac)$")
+
+def icy_metadata_block(title: Optional[str]) -> bytes:
+    """One ICY metadata block: a length byte (in 16-byte units) and the padded text; None sends b"\\x00"."""
+    if title is None:
+        return b"\x00"
+    # A quote would end the value early; players don't unescape.
+    text = f"StreamTitle='{title.replace(chr(39), chr(8217))}';".encode("utf-8")[:255 * 16]
+    blocks = -(-len(text) // 16)
+    return bytes([blocks]) + text.ljust(blocks * 16, b"\x00")
+
+class IcyInterleaver:
+    """Shoutcast-style metadata: after every `metaint` body bytes, insert a metadata block.
+
+    The title is sent in the first block and again whenever it changes; other blocks are empty.
+    """
+
+    def __init__(self, title, metaint: int = ICY_METAINT):
+        self._title = title  # callable returning the current title
+        self._metaint = metaint
+        self._until_meta = metaint
+        self._sent_title: Optional[str] = None
+
+    def wrap(self, buffers: list) -> list:
+        """`buffers` with metadata blocks inserted; the audio is sliced as views, not copied."""
+        out = []
+        for data in buffers:
+            view = memoryview(data)
+            pos = 0
+            while len(view) - pos >= self._until_meta:
+                out.append(view[pos:pos + self._until_meta])
+                pos += self._until_meta
+                title = self._title()
+                out.append(icy_metadata_block(title if title != self._sent_title else None))
+                self._sent_title = title
+                self._until_meta = self._metaint
+            if pos < len(view):
+                out.append(view[pos:] if pos else data)
+                self._until_meta -= len(view) - pos
+        return out
+
+# sendmsg() takes at most IOV_MAX buffers (1024 on Linux and macOS); Windows has no sendmsg.
+SEND_MAX_BUFFERS = 512
+USE_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+class StreamSender:
+    """Writes batches of encoded frames to one client's non-blocking socket.
+
+    A batch goes to the kernel in one scatter-gather sendmsg() straight from the ring's
+    shared frame objects, with no join and no copy, and only waits on the event loop when
+    the send buffer is full. With `chunked`, each batch is one HTTP/1.1 chunk (the size line
+    and trailer are two more buffers in the same call). Without sendmsg it falls back to
+    joining the batch and loop.sock_sendall().
+    """
+
+    def __init__(self, sock: socket.socket, chunked: bool = False):
+        self._sock = sock
+        self._chunked = chunked
+        self.syscalls = 0  # send calls made, including ones that found the buffer full
+
+    async def send(self, buffers: list) -> int:
+        """Send `buffers` in order and return the body bytes sent (framing not included)."""
+        size = sum(len(b) for b in buffers)
+        if not size:
+            return 0
+        if self._chunked:
+            buffers = [b"%x\r\n" % size, *buffers, b"\r\n"]
+        await self._send_all(buffers)
+        return size
+
+    async def finish(self) -> None:
+        """End the body; a chunked response needs its zero-length last chunk."""
+        if self._chunked:
+            await self._send_all([b"0\r\n\r\n"])
+
+    async def _send_all(self, buffers: list) -> None:
+        sock = self._sock
+        if not USE_SENDMSG:
+            self.syscalls += 1
+            data = buffers[0] if len(buffers) == 1 else b"".join(buffers)
+            await asyncio.wait_for(asyncio.get_running_loop().sock_sendall(sock, data), SEND_TIMEOUT)
+            return
+        pending = list(buffers)
+        while pending:
+            batch = pending[:SEND_MAX_BUFFERS]
+            self.syscalls += 1
+            try:
+                sent = sock.sendmsg(batch)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            done = 0
+            while done < len(batch) and sent >= len(batch[done]):
+                sent -= len(batch[done])
+                done += 1
+            del pending[:done]
+            if done < len(batch):
+                if sent:
+                    pending[0] = memoryview(pending[0])[sent:]
+                await self._writable()
+
+    async def _writable(self) -> None:
+        """Wait until the socket accepts more; raises asyncio.TimeoutError after SEND_TIMEOUT."""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self._sock.fileno()
+        loop.add_writer(fd, _resolve_future, ready)
+        try:
+            await asyncio.wait_for(ready, SEND_TIMEOUT)
+        finally:
+            loop.remove_writer(fd)
+
+class HttpRequest:
+    def __init__(self, method: str, target: str, headers: dict[str, str], version: str = "HTTP/1.0"):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        parts = urllib.parse.urlsplit(target)
+        self.path = parts.path
+        self.query = {k: v[-1] for k, v in urllib.parse.parse_qs(parts.query).items()}
+
+class AsyncStreamServer:
+    """Minimal HTTP/1.0 server for the stream endpoints and /metrics."""
+
+    def __init__(self, address: tuple[str, int]):
+        self._address = address
+        self._listener: Optional[socket.socket] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def address(self) -> tuple:
+        """Bound (host, port); useful after binding to port 0."""
+        return self._listener.getsockname()
+
+    def bind(self) -> None:
+        """Claim the port now; connections queue in the backlog until serve_forever() runs."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self._address)
+        listener.listen(128)
+        listener.setblocking(False)
+        self._listener = listener
+
+    async def serve_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._listener is None:
+            self.bind()
+        listener = self._listener
+        with listener:
+            while True:
+                sock, addr = await loop.sock_accept(listener)
+                task = loop.create_task(self._handle(sock, addr))
+                # Keep a reference until done; the loop only holds weak references to tasks.
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def shutdown(self) -> None:
+        """Drop every open connection and HLS segmenter and wait for them to finish."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for segmenter in HLS.values():
+            await segmenter.stop()
+
+    async def _handle(self, sock: socket.socket, addr) -> None:
+        requested_at = time.perf_counter()
+        sock.setblocking(False)
+        try:
+            if SEND_BUFFER_BYTES:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+            if TCP_NODELAY:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            request = await asyncio.wait_for(self._read_request(sock), REQUEST_TIMEOUT)
+            if request is None:
+                return
+            if request.method != "GET":
+                await self._send_error(sock, HTTPStatus.METHOD_NOT_ALLOWED)
+                return
+            if request.path == "/metrics":
+                await self._send_metrics(sock)
+                return
+            hub = find_hub(request.path, request.query.get("q"))
+            if hub is not None:
+                # Chunked framing needs an HTTP/1.1 client; older ones get the raw body either way.
+                chunked = STREAM_FRAMING == "chunked" and request.version == "HTTP/1.1"
+                await self._stream(sock, addr, hub, requested_at, icy=request.headers.get("icy-metadata") == "1",
+                                   offset=request.query.get("offset"), chunked=chunked)
+                return
+            await self._send_hls(sock, request.path)
+        except (asyncio.TimeoutError, BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            # Slow or vanished client.
+            pass
+        except Exception as e:
+            # Treat common client disconnects as normal.
+            msg = str(e)
+            if "10053" in msg or "10054" in msg:
+                pass
+            else:
+                print("Client disconnected:", e)
+        finally:
+            sock.close()
+
+    @staticmethod
+    async def _read_request(sock: socket.socket) -> Optional[HttpRequest]:
+        loop = asyncio.get_running_loop()
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = await loop.sock_recv(sock, 4096)
+            if not chunk or len(data) + len(chunk) > MAX_REQUEST_BYTES:
+                return None
+            data += chunk
+        lines = data.split(b"\r\n\r\n", 1)[0].decode("latin-1").split("\r\n")
+        parts = lines[0].split()
+        if len(parts) != 3:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return HttpRequest(parts[0], parts[1], headers, parts[2])
+
+    @staticmethod
+    def _response_head(status: HTTPStatus, headers: dict[str, str], version: str = "HTTP/1.0") -> bytes:
+        lines = [f"{version} {status.value} {status.phrase}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append("Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _send_error(self, sock: socket.socket, status: HTTPStatus) -> None:
+        body = f"{status.value} {status.phrase}\n".encode("latin-1")
+        head = self._response_head(status, {"Content-Type": "text/plain", "Content-Length": str(len(body))})
+        await asyncio.wait_for(asyncio.get_running_loop().sock_sendall(sock, head + body), SEND_TIMEOUT)
+
+    async def _send_body(self, sock: socket.socket, content_type: str, body: bytes, cache_control: str) -> None:
+        head = self._response_head(HTTPStatus.OK, {
+            "Content-Type": content_type,
+            "Content-Length": str(len(body)),
+            "Cache-Control": cache_control,
+        })
+        await asyncio.wait_for(asyncio.get_running_loop().sock_sendall(sock, head + body), SEND_TIMEOUT)
+
+    async def _send_hls(self, sock: socket.socket, path: str) -> None:
+        segmenter = HLS.get(path)
+        if segmenter is not None:
+            playlist = await segmenter.playlist()
+            if playlist is None:
+                await self._send_error(sock, HTTPStatus.SERVICE_UNAVAILABLE)
+                return
+            METRICS.inc("hls_requests_total", kind="playlist", **segmenter.hub.labels)
+            # Changes every segment; a cache may hold it for less than that.
+            await self._send_body(sock, "application/vnd.apple.mpegurl", playlist, "max-age=1")
+            return
+        match = HLS_SEGMENT_PATH.match(path)
+        segmenter = HLS.get(match.group(1) + ".m3u8") if match else None
+        if segmenter is None or match.group(3) != segmenter.extension:
+            await self._send_error(sock, HTTPStatus.NOT_FOUND)
+            return
+        segment = segmenter.segment(int(match.group(2)))
+        if segment is None:
+            await self._send_error(sock, HTTPStatus.NOT_FOUND)
+            return
+        labels = segmenter.hub.labels
+        METRICS.inc("hls_requests_total", kind="segment", **labels)
+        # A segment never changes once cut, so it can be cached for as long as it stays listed.
+        max_age = int(HLS_KEPT_SEGMENTS * HLS_SEGMENT_SECONDS)
+        await self._send_body(sock, segmenter.hub.codec["content_type"], segment, f"max-age={max_age}")
+        METRICS.inc("bytes_sent_total", len(segment), **labels)
+
+    async def _send_metrics(self, sock: socket.socket) -> None:
+        body = METRICS.render().encode("utf-8")
+        head = self._response_head(HTTPStatus.OK, {
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+            "Content-Length": str(len(body)),
+        })
+        await asyncio.wait_for(asyncio.get_running_loop().sock_sendall(sock, head + body), SEND_TIMEOUT)
+
+    async def _stream(
+        self, sock: socket.socket, addr, hub: BroadcastHub, requested_at: float, icy: bool = False,
+        offset: Optional[str] = None, chunked: bool = False,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        # The burst must stay inside the lag budget, or the client would be skipped straight away.
+        burst_seconds = max(0.0, min(BURST_SECONDS, LAG_BUDGET_SECONDS - hub.frame_seconds))
+        try:
+            # Starting an encoder/capture can block for a moment; keep it off the event loop.
+            ring, cursor = await loop.run_in_executor(None, hub.subscribe, burst_seconds)
+        except Exception as e:
+            print("Audio capture error:", e)
+            await self._send_error(sock, HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+
+        labels = hub.labels
+        client = ClientStats(f"{addr[0]}:{addr[1]}", labels)
+        METRICS.add_client(client)
+        profile = get_latency_profile()
+        send_max_frames = profile["send_max_frames"]
+        send_interval = profile["send_interval"]
+        frame_seconds = hub.frame_seconds
+        budget_frames = max(1, int(LAG_BUDGET_SECONDS / frame_seconds))
+        store = hub.timeshift
+        # A timeshifted client is behind live on purpose: it reads from the store and is
+        # exempt from the lag budget (falling off the end of the store moves it forward).
+        timeshifted = False
+        if store is not None and offset:
+            start = self._timeshift_start(store, ring, offset, addr[0], frame_seconds)
+            if start is not None:
+                cursor = start
+                timeshifted = ring.head - cursor > budget_frames
+        # A read from the timeshift file is sent straight out of the mapping, which can take
+        # SEND_TIMEOUT per stalled write; keep that and the read itself clear of the writer.
+        bytes_per_second = codec_bytes_per_second(hub.codec)
+        guard_seconds = TIMESHIFT_GUARD_SECONDS + SEND_TIMEOUT + TIMESHIFT_READ_BYTES / bytes_per_second
+        guard_frames = int(guard_seconds / frame_seconds)
+        guard_bytes = int(guard_seconds * bytes_per_second)
+        cushion_frames = int(SKIP_TO_LIVE_CUSHION_SECONDS / frame_seconds)
+        disconnect_slow = (SLOW_CLIENT_POLICY or "").lower().strip() == "disconnect"
+        # ICY metadata only when the player asks for it (Icy-MetaData: 1), since it is interleaved into the body.
+        interleaver = IcyInterleaver(lambda: hub.title) if icy else None
+        sender = StreamSender(sock, chunked)
+        # What the kernel may still hold after a write (for ?offset=resume).
+        send_buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        sent_frames = 0
+        try:
+            headers = {
+                "Content-Type": hub.codec["content_type"],
+                "Cache-Control": "no-cache",
+                "icy-name": hub.title,
+            }
+            if interleaver is not None:
+                headers["icy-metaint"] = str(ICY_METAINT)
+            if chunked:
+                headers["Transfer-Encoding"] = "chunked"
+            head = self._response_head(HTTPStatus.OK, headers, "HTTP/1.1" if chunked else "HTTP/1.0")
+            await asyncio.wait_for(loop.sock_sendall(sock, head), SEND_TIMEOUT)
+
+            header_sent = False
+            while True:
+                lag_frames = ring.head - cursor
+                if lag_frames > budget_frames and not timeshifted:
+                    if disconnect_slow:
+                        METRICS.inc("slow_client_actions_total", action="disconnect", **labels)
+                        break
+                    # Every ring entry is a whole frame (or Ogg page), so any cursor is a clean cut.
+                    live = ring.head - cushion_frames
+                    METRICS.inc("slow_client_actions_total", action="skip", **labels)
+                    METRICS.inc("skipped_frames_total", live - cursor, **labels)
+                    cursor = live
+                requested = cursor
+                # Near the ring's tail too, where the writer could drop frames between check and take.
+                if timeshifted and cursor < ring.oldest + guard_frames:
+                    # Older than the in-memory ring: a view straight into the timeshift file.
+                    view, first, cursor = store.read(cursor, TIMESHIFT_READ_BYTES, guard_bytes)
+                    frames = [view] if view is not None else []
+                    overrun = first - requested
+                else:
+                    # The first write carries the whole backlog burst in one go.
+                    max_frames = send_max_frames if header_sent else send_max_frames + budget_frames
+                    frames, cursor = ring.take(cursor, max_frames)
+                    overrun = cursor - len(frames) - requested
+                if not frames:
+                    if ring.closed:
+                        await sender.finish()
+                        break
+                    await ring.wait_async(cursor)
+                    continue
+                if overrun > 0:
+                    # Fell out of the ring entirely (only possible with a budget larger than the
+                    # ring) or off the end of the timeshift file.
+                    METRICS.inc("slow_client_actions_total", action="overrun", **labels)
+                    METRICS.inc("skipped_frames_total", overrun, **labels)
+                if not header_sent:
+                    # Ogg/FLAC headers are only known once the encoder has produced them.
+                    frames.insert(0, hub.header)
+                if interleaver is not None:
+                    frames = interleaver.wrap(frames)
+                started = time.perf_counter()
+                calls = sender.syscalls
+                try:
+                    sent = await sender.send(frames)
+                except asyncio.TimeoutError:
+                    METRICS.inc("slow_client_actions_total", action="timeout", **labels)
+                    raise
+                finished = time.perf_counter()
+                METRICS.inc("send_syscalls_total", sender.syscalls - calls, **labels)
+                if not header_sent:
+                    METRICS.observe("time_to_first_byte_seconds", finished - requested_at, TTFB_BUCKETS, **labels)
+                    header_sent = True
+                METRICS.inc("send_seconds_total", finished - started, **labels)
+                METRICS.inc("bytes_sent_total", sent, **labels)
+                client.bytes_sent += sent
+                client.lag_seconds = (ring.head - cursor) * frame_seconds
+                sent_frames += cursor - requested - max(overrun, 0)
+                if send_interval and ring.head - cursor < send_max_frames:
+                    # Caught up: let a few encoder batches gather for the next write.
+                    await asyncio.sleep(send_interval)
+        finally:
+            METRICS.remove_client(client)
+            if store is not None and hub.ring is ring:
+                # Where ?offset=resume picks up for this address: what was handed to the kernel,
+                # less what may still have sat in the socket buffer (Linux reports SO_SNDBUF doubled,
+                # which also stands in for the player's receive buffer).
+                in_flight = send_buffer * sent_frames // max(1, client.bytes_sent)
+                store.positions[addr[0]] = (cursor - in_flight, time.monotonic())
+            await loop.run_in_executor(None, hub.unsubscribe)
+
+    @staticmethod
+    def _timeshift_start(
+        store: TimeshiftStore, ring: FrameRing, offset: str, address: str, frame_seconds: float
+    ) -> Optional[int]:
+        """Starting sequence for ?offset=: where `address` last dropped ("resume") or a time behind live."""
+        if offset.strip().lower() == "resume":
+            position = store.positions.get(address)
+            if position is None or time.monotonic() - position[1] > TIMESHIFT_RESUME_SECONDS:
+                return None
+            return max(position[0], store.oldest)
+        seconds = parse_timeshift_offset(offset)
+        if seconds is None:
+            return None
+        return max(ring.head - int(seconds / frame_seconds), store.oldest)
+
+
+async def serve_until_signalled(server: AsyncStreamServer) -> None:
+    """Serve until SIGINT/SIGTERM, then close clients, encoders and capture cleanly."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: Ctrl+C still raises KeyboardInterrupt
+    serving = loop.create_task(server.serve_forever())
+    stopping = loop.create_task(stop.wait())
+    try:
+        await asyncio.wait({serving, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        serving.cancel()
+        stopping.cancel()
+        await server.shutdown()
+        for hub in HUBS.values():
+            await loop.run_in_executor(None, hub.shutdown)
+    if serving.done() and not serving.cancelled() and serving.exception() is not None:
+        raise serving.exception()
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Stream this computer's audio to Sonos over HTTP.")
+    parser.add_argument("--headless", action="store_true",
+                        help="no tray icon or settings dialog (default on Linux without a display)")
+    parser.add_argument("--config", metavar="FILE",
+                        help="read settings from this JSON file instead of the user config")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--audio-mode", choices=AUDIO_MODES)
+    parser.add_argument("--device", help="capture device: input index or name, or the output to monitor")
+    parser.add_argument("--source", action="append", default=[], metavar="NAME=[MODE:]DEVICE",
+                        help="extra source served on /stream/NAME, e.g. tv=monitor:HDMI (repeatable)")
+    parser.add_argument("--latency-profile", choices=list(LATENCY_PROFILES))
+    parser.add_argument("--sample-rate", choices=["44100", "48000", "auto"])
+    parser.add_argument("--list-devices", action="store_true", help="list capture devices and exit")
+    parser.add_argument("--list-zones", action="store_true", help="search for Sonos zones, list them and exit")
+    parser.add_argument("--play-on", action="append", default=[], metavar="ZONE",
+                        help="start the stream on this Sonos room (name, name prefix or IP) once serving (repeatable)")
+    return parser.parse_args(argv)
+
+def apply_startup_config(args: argparse.Namespace) -> None:
+    """Apply the user config, or --config FILE instead of it, then the flags that override either."""
+    if args.config:
+        apply_config(json.loads(Path(args.config).read_text(encoding="utf-8")))
+    else:
+        apply_config(load_config())
+    apply_config({
+        key: value for key, value in (
+            ("audio_mode", args.audio_mode), ("device", args.device), ("latency_profile", args.latency_profile),
+            ("sample_rate", args.sample_rate),
+        ) if value is not None
+    })
+    if args.source:
+        extra = dict(spec.split("=", 1) for spec in args.source)
+        apply_config({"sources": {**SOURCES, **parse_sources(extra)}})
+
+if __name__ == "__main__":
+    args = parse_args()
+    for spec in args.source:
+        if "=" not in spec:
+            sys.exit(f"--source expects NAME=[MODE:]DEVICE, got '{spec}'")
+    if args.list_devices:
+        list_audio_devices()
+        sys.exit(0)
+    if args.list_zones:
+        for zone in discover_zones():
+            print(f"{zone.name:<24} {zone.ip:<16} {zone.model:<20} via {zone.local_ip}")
+        if not SONOS_ZONES:
+            print("No Sonos zones found.")
+        sys.exit(0)
+    headless = args.headless or (
+        not IS_WINDOWS and not IS_MAC and not os.environ.get("DISPLAY") and not os.environ.get("WAYLAND_DISPLAY")
+    )
+    PORT = args.port
+
+    # Claim the port before anything slow, so a player that connects early queues instead of failing.
+    server = AsyncStreamServer(("", PORT))
+    with STARTUP.phase("bind"):
+        server.bind()
+    with STARTUP.phase("config"):
+        apply_startup_config(args)
+
+    # Show settings if not configured (public mode needs the DDNS details; a headless box just runs locally)
+    if not headless and (DDNS_DOMAIN == 'yourdomain.com' or not DDNS_PASSWORD):
+        show_settings()
+        # Reload from the same place as at startup: with --config FILE, the user config the
+        # dialog saved to must not leak into settings the file replaces.
+        apply_startup_config(args)
+    configure_sources(SOURCES)
+    
+    # The host name often resolves to the wrong interface (or 127.0.1.1); ask the routing table.
+    local_ip = local_address() or socket.gethostbyname(socket.gethostname())
+    print(f"Streaming at http://{local_ip}:{PORT}/stream")
+    if PUBLIC_ENABLED and DDNS_DOMAIN != 'yourdomain.com':
+        public_url = f"http://{DDNS_HOST}.{DDNS_DOMAIN}:{PORT}/stream" if DDNS_HOST != '@' else f"http://{DDNS_DOMAIN}:{PORT}/stream"
+        print(f"Public URL: {public_url}")
+    with STARTUP.phase("devices"):
+        try:
+            _, _, device_mode_label, device_setup_hint, _ = get_audio_source()
+            resolve_sample_rate()
+        except Exception as e:
+            # Not fatal: the server keeps running and a stream request reports the problem.
+            device_mode_label, device_setup_hint = "unavailable", f"Audio capture error: {e}"
+    print(f"Audio capture: {device_mode_label} at {SAMPLE_RATE} Hz"
+          + (", drift correction on" if DRIFT_CORRECTION else ""))
+    for name, capture in CAPTURES.items():
+        if name != DEFAULT_SOURCE:
+            print(f"Source '{name}': http://{local_ip}:{PORT}{stream_path(name, 'mp3')}"
+                  f" ({capture.audio_mode or AUDIO_MODE}, {capture.device or 'default device'})")
+    print(f"MP3 encoder: {'in-process LAME' if use_lame_encoder(CODECS['mp3']) else 'ffmpeg'}")
+    print(f"Latency profile: {LATENCY_PROFILE} (~{estimate_pipeline_latency_ms(get_latency_profile()):.0f} ms server buffering)")
+    print(device_setup_hint)
+    print(f"Startup: {STARTUP.summary()}", flush=True)
+    
+    # The port is bound, so a player told to play now queues until the server loop runs.
+    for zone_spec in args.play_on:
+        threading.Thread(target=play_on, args=(zone_spec,), daemon=True).start()
+
+    # Start DDNS update thread (public mode only)
+    if PUBLIC_ENABLED:
+        DDNS_UPDATER.start()
+    
+    # Start tray icon
+    if not headless:
+        threading.Thread(target=setup_tray, daemon=True).start()
+    
+    try:
+        asyncio.run(serve_until_signalled(server))
+    except KeyboardInterrupt:
+        pass